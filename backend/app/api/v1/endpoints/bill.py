@@ -1,34 +1,376 @@
-from fastapi import APIRouter, HTTPException, UploadFile
+import asyncio
+import contextlib
+import json
+import logging
+from collections.abc import AsyncIterator
 
-from app.schemas.bill import OCRBill, Outing, OutingSplit
+from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile
+from fastapi.responses import Response, StreamingResponse
+
+from app.core.middleware import get_client_id
+from app.core.settings import settings
+from app.core.sse import format_sse_event
+from app.schemas.bill import (
+    Bill,
+    OCRBatchResult,
+    OCRBill,
+    OCRBillItem,
+    OCRBillTotals,
+    Outing,
+    OutingSplit,
+    SplitBatchResult,
+)
+from app.schemas.ocr_job import OCRJob
+from app.schemas.outing import BillUpdate, NewOuting, StoredBill, StoredOuting
+from app.services.admission import AdmissionRejectedError, ocr_admission, ocr_client_quota
 from app.services.bill import (
-    calculate_balance,
-    calculate_outing_split_with_minimal_transactions,
-    get_bill_details_from_image,
+    aget_bill_details_from_image,
+    astream_bill_details_from_image,
+    calculate_outing_split,
 )
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.llm_usage import TokenBudgetExceededError
+from app.services.ocr_jobs import ocr_job_backend
+from app.services.outing_store import outing_store
+from app.services.settlement import SettlementStrategy
+from app.services.split_pool import split_pool
+from app.services.stage_timing import stage_timing
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+INVALID_FILE_TYPE_DETAIL = "Invalid file type. Please upload an image file."
+FILE_TOO_LARGE_DETAIL = "File too large. Please upload a smaller image."
+OCR_JOB_NOT_FOUND_DETAIL = "OCR job not found."
+INVALID_SPLIT_BATCH_DETAIL = "Invalid request body. Please submit a JSON array of outings."
+OUTING_NOT_FOUND_DETAIL = "Outing not found."
+BILL_NOT_FOUND_DETAIL = "Bill not found."
+
+
+def _get_image_content_type(file: UploadFile) -> str | None:
+    content_type = file.content_type
+    if not content_type or not content_type.startswith("image/"):
+        return None
+    return content_type
+
+
+async def _read_image(file: UploadFile) -> bytes:
+    """
+    Read an uploaded image into a single buffer, refusing images above the configured size.
+
+    Starlette spools big uploads to disk while parsing the request, so at most one byte more than the limit
+    is ever read into memory.
+    """
+    if file.size is not None and file.size > settings.OCR_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=FILE_TOO_LARGE_DETAIL)
+
+    content = await file.read(settings.OCR_MAX_UPLOAD_BYTES + 1)
+    await file.close()
+    if len(content) > settings.OCR_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=FILE_TOO_LARGE_DETAIL)
+
+    return content
+
+
+async def _take_ocr_quota(request: Request, images: int) -> None:
+    """
+    Take one request per image from the quota of the client of the request.
+    """
+    if ocr_client_quota.enabled:
+        await asyncio.to_thread(ocr_client_quota.acquire, get_client_id(request.scope), images)
+
+
+async def _take_ocr_request_quota(request: Request) -> None:
+    """
+    Take a request from the quota of its client, for requests whose image is extracted by the OCR job workers, which
+    hold the OCR slots of this worker themselves.
+    """
+    await _take_ocr_quota(request, 1)
+
+
+async def _admit_ocr_request(request: Request) -> AsyncIterator[None]:
+    """
+    Hold one of the OCR slots of this worker while the request is handled, within the quota of its client.
+
+    The slot is held until the response is sent, including for streamed responses. Taking the quota and waiting for
+    the slot are timed as the queue stage.
+    """
+    async with contextlib.AsyncExitStack() as stack:
+        with stage_timing.stage("queue"):
+            await _take_ocr_quota(request, 1)
+            await stack.enter_async_context(ocr_admission.admit())
+        yield
+
 
-@router.post("/ocr")
-async def extract_bill_details_from_image(file: UploadFile) -> OCRBill:
+@router.post("/ocr", dependencies=[Depends(_admit_ocr_request)])
+@stage_timing.endpoint
+async def extract_bill_details_from_image(file: UploadFile, tiled: bool = False) -> OCRBill:
     """
     Extract bill details from an uploaded image file.
+
+    With `tiled`, a very long receipt is split into overlapping tiles, which are extracted concurrently, so that its
+    small text stays legible.
     """
-    content_type = file.content_type
-    if not content_type or not content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image file.")
+    content_type = _get_image_content_type(file)
+    if content_type is None:
+        raise HTTPException(status_code=400, detail=INVALID_FILE_TYPE_DETAIL)
+
+    # Not kept in a local variable, so that the service can release the original image once it is preprocessed
+    return await aget_bill_details_from_image(await _read_image(file), content_type, tiled=tiled)
+
+
+@router.post("/ocr/stream", response_class=StreamingResponse, dependencies=[Depends(_admit_ocr_request)])
+async def stream_bill_details_from_image(file: UploadFile) -> StreamingResponse:
+    """
+    Extract bill details from an uploaded image file, streamed as server-sent events while the LLM extracts them.
+
+    An `item` event is sent for each item of the bill as soon as it is extracted, followed by a `totals` event with
+    the tax rate, service charge and amount paid. If the extraction fails, an `error` event is sent instead of the
+    totals, unless the LLM provider is unavailable or the token budget is exhausted, which are answered with a 503 or a
+    429 like the other OCR endpoints.
+    """
+    content_type = _get_image_content_type(file)
+    if content_type is None:
+        raise HTTPException(status_code=400, detail=INVALID_FILE_TYPE_DETAIL)
+
+    # Only the stream holds on to the upload, so that it can be freed once preprocessed
+    results = astream_bill_details_from_image(await _read_image(file), content_type)
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            async for result in results:
+                if isinstance(result, OCRBillItem):
+                    yield format_sse_event("item", result.model_dump_json())
+                else:
+                    totals = OCRBillTotals.model_validate(result.model_dump(exclude={"items"}))
+                    yield format_sse_event("totals", totals.model_dump_json())
+        except (CircuitOpenError, TokenBudgetExceededError):
+            # Only raised before the LLM call, so before the first event, which is pulled before responding below
+            raise
+        except Exception as e:
+            logger.exception("Could not extract bill details from %s", file.filename)
+            yield format_sse_event("error", json.dumps({"detail": f"Could not extract bill details: {e}"}))
+
+    # The stream is started before the response, so that its errors without an event go through the exception
+    # handlers of the app, with their status code and Retry-After header, instead of failing a 200 response
+    stream = events()
+    first_event = await anext(stream)
+
+    async def started_events() -> AsyncIterator[str]:
+        yield first_event
+        async for event in stream:
+            yield event
+
+    return StreamingResponse(started_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.post("/ocr/batch")
+@stage_timing.endpoint
+async def extract_bill_details_from_images(request: Request, files: list[UploadFile]) -> list[OCRBatchResult]:
+    """
+    Extract bill details from several uploaded image files at once.
+
+    The images are extracted concurrently, and a failure of one image does not fail the others.
+    The results are in the same order as the uploaded files. Each image counts as a request against the quota of the
+    client, and holds one of the OCR slots of this worker while it is extracted.
+    """
+    if len(files) > settings.OCR_BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=400, detail=f"Too many files. Please upload at most {settings.OCR_BATCH_MAX_FILES} images."
+        )
+    await _take_ocr_quota(request, len(files))
+
+    semaphore = asyncio.Semaphore(settings.OCR_BATCH_CONCURRENCY)
+
+    async def extract(file: UploadFile) -> OCRBatchResult:
+        content_type = _get_image_content_type(file)
+        if content_type is None:
+            return OCRBatchResult(filename=file.filename, error=INVALID_FILE_TYPE_DETAIL)
+
+        try:
+            content = await _read_image(file)
+        except HTTPException as e:
+            return OCRBatchResult(filename=file.filename, error=e.detail)
+
+        async with semaphore:
+            try:
+                async with ocr_admission.admit():
+                    bill = await aget_bill_details_from_image(content, content_type)
+            except AdmissionRejectedError as e:
+                return OCRBatchResult(filename=file.filename, error=str(e))
+            except Exception as e:
+                logger.exception("Could not extract bill details from %s", file.filename)
+                return OCRBatchResult(filename=file.filename, error=f"Could not extract bill details: {e}")
+
+        return OCRBatchResult(filename=file.filename, bill=bill)
 
-    with file.file as f:
-        content = f.read()
-        return get_bill_details_from_image(content, content_type)
+    return list(await asyncio.gather(*(extract(file) for file in files)))
+
+
+@router.post("/ocr/jobs", status_code=202, dependencies=[Depends(_take_ocr_request_quota)])
+async def submit_ocr_job(file: UploadFile) -> OCRJob:
+    """
+    Queue the extraction of bill details from an uploaded image file, and return immediately.
+
+    Poll the returned job, or subscribe to its events, to get the extracted bill once it is ready.
+    """
+    content_type = _get_image_content_type(file)
+    if content_type is None:
+        raise HTTPException(status_code=400, detail=INVALID_FILE_TYPE_DETAIL)
+
+    content = await _read_image(file)
+    return await asyncio.to_thread(ocr_job_backend.submit, content, content_type)
+
+
+async def _get_ocr_job(job_id: str) -> OCRJob:
+    job = await asyncio.to_thread(ocr_job_backend.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=OCR_JOB_NOT_FOUND_DETAIL)
+    return job
+
+
+@router.get("/ocr/jobs/{job_id}")
+async def get_ocr_job(job_id: str) -> OCRJob:
+    """
+    Get the status of an OCR job, along with the extracted bill once it succeeded.
+    """
+    return await _get_ocr_job(job_id)
+
+
+@router.get("/ocr/jobs/{job_id}/events", response_class=StreamingResponse)
+async def stream_ocr_job_events(job_id: str) -> StreamingResponse:
+    """
+    Subscribe to server-sent events of an OCR job.
+
+    A `status` event with the job is sent right away and whenever its status changes. The stream ends once the job
+    succeeded or failed.
+    """
+    job = await _get_ocr_job(job_id)
+
+    async def events(job: OCRJob) -> AsyncIterator[str]:
+        yield format_sse_event("status", job.model_dump_json())
+        while not job.is_finished:
+            await asyncio.sleep(settings.OCR_JOB_POLL_INTERVAL_SECONDS)
+            latest_job = await asyncio.to_thread(ocr_job_backend.get, job_id)
+            if latest_job is None:
+                return
+            if latest_job.status != job.status:
+                yield format_sse_event("status", latest_job.model_dump_json())
+            job = latest_job
+
+    return StreamingResponse(events(job), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
 @router.post("/split")
-async def split(outing: Outing) -> OutingSplit:
+@stage_timing.endpoint
+async def split(outing: Outing, strategy: SettlementStrategy = "greedy") -> OutingSplit:
     """
     Calculate the optimal split of expenses for an outing.
+
+    With the `exact` strategy, people whose balances net to zero among themselves settle separately, which can take
+    fewer transactions than the default `greedy` strategy, at the cost of more computation for large groups.
+    """
+    return calculate_outing_split(outing, strategy)
+
+
+@router.post(
+    "/split/batch",
+    response_model=list[SplitBatchResult],
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {"schema": {"type": "array", "items": {"$ref": "#/components/schemas/Outing"}}}
+            },
+            "required": True,
+        }
+    },
+)
+async def split_batch(request: Request, strategy: SettlementStrategy = "greedy") -> Response:
+    """
+    Calculate the optimal split of expenses for many outings at once, e.g. for a nightly reconciliation.
+
+    The outings are validated and split in parallel by a pool of processes, and an invalid outing does not fail the
+    others. The results are in the same order as the outings.
+    """
+    # Parsed but not validated here, so that the workers validate the outings in parallel
+    try:
+        outings = json.loads(await request.body())
+    except ValueError:
+        outings = None
+    if not isinstance(outings, list):
+        raise HTTPException(status_code=422, detail=INVALID_SPLIT_BATCH_DETAIL)
+    if len(outings) > settings.SPLIT_BATCH_MAX_OUTINGS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many outings. Please submit at most {settings.SPLIT_BATCH_MAX_OUTINGS} outings.",
+        )
+
+    results = await split_pool.split(outings, strategy)
+    return Response(content=b"[" + b",".join(results) + b"]", media_type="application/json")
+
+
+@router.post("/outings", status_code=201)
+async def create_outing(outing: NewOuting) -> StoredOuting:
+    """
+    Store an outing, with its first bills if any, to edit it one bill at a time instead of uploading it whole to
+    /split on every change.
+    """
+    return await asyncio.to_thread(outing_store.create, outing.bills)
+
+
+@router.get("/outings/{outing_id}")
+async def get_outing(outing_id: str) -> StoredOuting:
+    """
+    Get an outing with its bills.
+    """
+    outing = await asyncio.to_thread(outing_store.get, outing_id)
+    if outing is None:
+        raise HTTPException(status_code=404, detail=OUTING_NOT_FOUND_DETAIL)
+    return outing
+
+
+@router.post("/outings/{outing_id}/bills", status_code=201)
+async def add_outing_bill(outing_id: str, bill: Bill) -> StoredBill:
+    """
+    Add a bill to an outing.
+    """
+    stored_bill = await asyncio.to_thread(outing_store.add_bill, outing_id, bill)
+    if stored_bill is None:
+        raise HTTPException(status_code=404, detail=OUTING_NOT_FOUND_DETAIL)
+    return stored_bill
+
+
+@router.patch("/outings/{outing_id}/bills/{bill_id}")
+async def update_outing_bill(outing_id: str, bill_id: int, update: BillUpdate) -> StoredBill:
+    """
+    Change some fields of a bill of an outing.
+    """
+    stored_bill = await asyncio.to_thread(outing_store.update_bill, outing_id, bill_id, update)
+    if stored_bill is None:
+        raise HTTPException(status_code=404, detail=BILL_NOT_FOUND_DETAIL)
+    return stored_bill
+
+
+@router.delete("/outings/{outing_id}/bills/{bill_id}", status_code=204)
+async def remove_outing_bill(outing_id: str, bill_id: int) -> None:
+    """
+    Remove a bill from an outing.
+    """
+    if not await asyncio.to_thread(outing_store.remove_bill, outing_id, bill_id):
+        raise HTTPException(status_code=404, detail=BILL_NOT_FOUND_DETAIL)
+
+
+@router.get("/outings/{outing_id}/split")
+@stage_timing.endpoint
+async def split_outing(outing_id: str, strategy: SettlementStrategy = "greedy") -> OutingSplit:
+    """
+    Calculate the optimal split of expenses for a stored outing, like /split.
+
+    Only the bills which changed since the last split are taken into account again, and the split of an unchanged
+    outing is not calculated again.
     """
-    balance = calculate_balance(outing)
-    outing_split = calculate_outing_split_with_minimal_transactions(balance)
+    outing_split = await asyncio.to_thread(outing_store.split, outing_id, strategy)
+    if outing_split is None:
+        raise HTTPException(status_code=404, detail=OUTING_NOT_FOUND_DETAIL)
     return outing_split
@@ -0,0 +1,37 @@
+import asyncio
+
+from fastapi import APIRouter
+
+from app.schemas.metrics import MetricsResponse
+from app.services.admission import ocr_admission, ocr_client_quota
+from app.services.bill import ocr_single_flight
+from app.services.image_preprocessing import image_preprocessor
+from app.services.litellm_service import circuit_breakers, ocr_hedger, retry_budget
+from app.services.llm_http_client import llm_http_client
+from app.services.llm_usage import llm_usage_tracker
+from app.services.near_duplicates import near_duplicate_index
+from app.services.ocr_cache import ocr_cache
+from app.services.stage_timing import stage_timing
+
+router = APIRouter()
+
+
+@router.get("/")
+async def get_metrics() -> MetricsResponse:
+    """
+    In-process counters of this worker, to observe caches and provider usage.
+    """
+    return MetricsResponse(
+        ocr_cache=ocr_cache.stats(),
+        image_preprocessing=image_preprocessor.stats(),
+        llm_http_pool=llm_http_client.stats(),
+        ocr_single_flight=ocr_single_flight.stats(),
+        ocr_near_duplicates=near_duplicate_index.stats(),
+        ocr_hedging=ocr_hedger.stats(),
+        llm_usage=await asyncio.to_thread(llm_usage_tracker.stats),
+        llm_circuit_breakers={api_base: breaker.stats() for api_base, breaker in list(circuit_breakers.items())},
+        llm_retry_budget=retry_budget.stats(),
+        ocr_admission=ocr_admission.stats(),
+        ocr_client_quota=ocr_client_quota.stats(),
+        stage_timing=stage_timing.stats(),
+    )
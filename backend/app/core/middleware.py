@@ -0,0 +1,120 @@
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.services.llm_usage import track_request, usage_headers
+from app.services.stage_timing import StageTiming, server_timing_header
+
+REQUEST_TOO_LARGE_DETAIL = "Request too large. Please upload a smaller image."
+
+
+class RequestSizeLimitMiddleware:
+    """
+    Reject request bodies above a per-path size limit, before they are parsed.
+
+    Requests which declare a too large Content-Length are rejected without reading their body. For the others,
+    the body is counted as it is streamed in, and the request is aborted as soon as it crosses the limit.
+    """
+
+    def __init__(self, app: ASGIApp, limits: dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                response = JSONResponse({"detail": REQUEST_TOO_LARGE_DETAIL}, status_code=413)
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI re-raises HTTP exceptions raised while reading the body, instead of turning them into 400s
+                    raise HTTPException(status_code=413, detail=REQUEST_TOO_LARGE_DETAIL)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def get_client_id(scope: Scope) -> str | None:
+    """
+    Identify the client a request is made for, for its quota and token budget, by the IP address it connects from.
+
+    A header set by the client is not trusted, since changing it would give the client a fresh quota. Behind a
+    reverse proxy, run uvicorn with --proxy-headers and --forwarded-allow-ips, so that the address is that of the
+    client rather than that of the proxy.
+    """
+    client = scope.get("client")
+    return client[0] if client else None
+
+
+class LLMUsageMiddleware:
+    """
+    Attribute the LLM calls made while serving a request to its client, and report them in the response headers.
+
+    Headers are only added for calls made before the response starts, so never for streamed responses.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with track_request(get_client_id(scope)) as calls:
+
+            async def send_with_usage(message: Message) -> None:
+                if message["type"] == "http.response.start" and calls:
+                    headers = MutableHeaders(scope=message)
+                    for name, value in usage_headers(calls).items():
+                        headers.append(name, value)
+                await send(message)
+
+            await self.app(scope, receive, send_with_usage)
+
+
+class StageTimingMiddleware:
+    """
+    Report the time spent in each stage of serving a request in its Server-Timing header.
+
+    The serialization of the response is timed from the return of the endpoint, if it is decorated with
+    `StageTiming.endpoint`. Stages run once the response started, such as those of streamed responses, are not
+    reported in the header, but are still added up for /metrics.
+    """
+
+    def __init__(self, app: ASGIApp, timing: StageTiming):
+        self.app = app
+        self.timing = timing
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.timing.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        with self.timing.track_request() as stages:
+
+            async def send_with_timing(message: Message) -> None:
+                if message["type"] == "http.response.start" and stages is not None:
+                    if stages.endpoint_returned is not None:
+                        self.timing.record("serialize", time.perf_counter() - stages.endpoint_returned)
+                    if stages.durations:
+                        MutableHeaders(scope=message).append("Server-Timing", server_timing_header(stages.durations))
+                await send(message)
+
+            await self.app(scope, receive, send_with_timing)
@@ -1,19 +1,131 @@
 from pathlib import Path
+from typing import Literal
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-
 BACKEND_DIR = Path(__file__).resolve().parents[2]
 
 
 class Settings(BaseSettings):
     CORS_ALLOW_HOSTS: list[str] = []
 
+    # Directory for local state shared by all workers (caches, queues, ...)
+    DATA_DIR: Path = BACKEND_DIR / ".data"
+
+    # Engine extracting bill details from images: "litellm" calls the LLM provider, "local" needs no network
+    OCR_ENGINE: Literal["litellm", "local"] = "litellm"
+    OCR_LOCAL_FIXTURES_DIR: Path | None = None  # Receipt images with the JSON of their bill, e.g. lunch.jpg, lunch.json
+    OCR_LOCAL_LATENCY_SECONDS: float = 0.0  # Simulated latency of each extraction
+    OCR_LOCAL_LATENCY_JITTER_SECONDS: float = 0.0  # Up to this much latency is added at random
+
     # LiteLLM configuration
     LITELLM_MODEL: str  # e.g., "gemini/gemini-3.1-flash-lite-preview", "openai/gpt-4o"
     LITELLM_API_BASE: str  # Base URL for your LLM API
     LITELLM_API_KEY: str  # API key for your LLM API
 
+    # Hedged OCR requests: also ask a secondary model when the primary one is slow to answer
+    LITELLM_HEDGE_MODEL: str | None = None  # Hedging is disabled unless set
+    LITELLM_HEDGE_API_BASE: str | None = None  # Defaults to LITELLM_API_BASE
+    LITELLM_HEDGE_API_KEY: str | None = None  # Defaults to LITELLM_API_KEY
+    LITELLM_HEDGE_DELAY_SECONDS: float = 5.0  # Until enough latencies of the primary model were observed
+    LITELLM_HEDGE_DELAY_PERCENTILE: float | None = 0.9  # Of the latencies of the primary model, None for a fixed delay
+
+    # Circuit breaker around each LLM provider, tripped by the rate of failed or slow calls among the most recent ones
+    LLM_CIRCUIT_BREAKER_ENABLED: bool = True
+    LLM_CIRCUIT_BREAKER_WINDOW: int = 20  # Number of most recent calls the rates are computed from
+    LLM_CIRCUIT_BREAKER_MIN_CALLS: int = 10  # Before the breaker can trip
+    LLM_CIRCUIT_BREAKER_FAILURE_RATE: float = 0.5
+    LLM_CIRCUIT_BREAKER_SLOW_CALL_SECONDS: float = 30
+    LLM_CIRCUIT_BREAKER_SLOW_CALL_RATE: float = 0.8
+    LLM_CIRCUIT_BREAKER_OPEN_SECONDS: float = 30  # Before probe calls are let through
+    LLM_CIRCUIT_BREAKER_HALF_OPEN_CALLS: int = 1  # Probe calls which must succeed to close the breaker
+
+    # Retries of transient LLM errors, with jittered exponential backoff
+    LLM_MAX_RETRIES: int = 2
+    LLM_RETRY_BACKOFF_SECONDS: float = 0.5
+    LLM_RETRY_MAX_BACKOFF_SECONDS: float = 5
+    LLM_RETRY_BUDGET_RATIO: float = 0.1  # Retries allowed per call, in the long run
+    LLM_RETRY_BUDGET_MAX_TOKENS: float = 10  # Retries allowed at once, after a quiet period
+
+    # Daily LLM token budgets, shared by all workers through a SQLite database in DATA_DIR
+    LLM_DAILY_TOKEN_BUDGET: int | None = None  # For all clients together, unlimited if not set
+    LLM_CLIENT_DAILY_TOKEN_BUDGET: int | None = None  # For each client, unlimited if not set
+    LLM_BUDGET_EXCEEDED_ACTION: Literal["reject", "downgrade"] = "reject"
+    LLM_BUDGET_DOWNGRADE_MODEL: str | None = None  # Model used once a budget is exceeded, to downgrade calls
+
+    # Admission control of OCR requests, per worker process
+    OCR_MAX_IN_FLIGHT: int = 8
+    OCR_MAX_QUEUED: int = 32  # Requests waiting for a slot, beyond which they are rejected at once
+    OCR_QUEUE_TIMEOUT_SECONDS: float = 30  # Requests which waited this long for a slot are rejected
+
+    # OCR request quota of each client, shared by all workers through a SQLite database in DATA_DIR
+    OCR_CLIENT_REQUESTS_PER_MINUTE: float | None = None  # Unlimited if not set
+    OCR_CLIENT_BURST: int = 10  # Requests a client can make at once, after a quiet period
+
+    # Pooled HTTP client for calls to the LLM provider
+    LLM_HTTP_MAX_CONNECTIONS: int = 20  # Per worker process
+    LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 10
+    LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS: float = 60
+    LLM_HTTP_TIMEOUT_SECONDS: float = 120
+    LLM_HTTP2_ENABLED: bool = True
+
+    # OCR result cache
+    OCR_CACHE_ENABLED: bool = True
+    OCR_CACHE_MEMORY_MAX_ENTRIES: int = 256  # Per worker process
+    OCR_CACHE_DISK_MAX_ENTRIES: int = 10_000  # Shared by all worker processes
+    OCR_CACHE_TTL_SECONDS: int = 7 * 24 * 60 * 60
+
+    # Reuse of OCR results for re-photographed receipts, found by a perceptual hash of the image. Off by default, since
+    # receipts of the same shop with other amounts hash alike too, and would be given the bill of an earlier one
+    OCR_NEAR_DUPLICATE_ENABLED: bool = False
+    OCR_NEAR_DUPLICATE_HASH_SIZE: int = 16  # The hash has HASH_SIZE² bits
+    OCR_NEAR_DUPLICATE_MAX_DISTANCE: int = 10  # Bits which may differ between hashes of photos of the same receipt
+    OCR_NEAR_DUPLICATE_MAX_ENTRIES: int = 50_000  # Per worker process
+
+    # Background OCR jobs
+    OCR_JOB_BACKEND: Literal["memory", "sqlite", "redis"] = "sqlite"
+    OCR_JOB_REDIS_URL: str = "redis://localhost:6379/0"
+    OCR_JOB_WORKERS: int = 2  # Per worker process
+    OCR_JOB_POLL_INTERVAL_SECONDS: float = 0.5
+    OCR_JOB_LEASE_SECONDS: int = 300  # Jobs claimed longer ago than this are assumed lost, and retried
+    OCR_JOB_RETENTION_SECONDS: int = 24 * 60 * 60  # How long finished jobs can be fetched
+
+    # Largest image accepted for OCR, in bytes
+    OCR_MAX_UPLOAD_BYTES: int = 15 * 1024 * 1024
+
+    # Image preprocessing before OCR
+    OCR_PREPROCESS_ENABLED: bool = True
+    OCR_IMAGE_MAX_EDGE: int = 2048  # Longest edge of the image sent to the LLM, in pixels
+    OCR_IMAGE_FORMAT: Literal["JPEG", "WEBP"] = "JPEG"
+    OCR_IMAGE_QUALITY: int = 85
+
+    # Tiled OCR of very long receipts, split into overlapping horizontal tiles extracted concurrently
+    OCR_TILE_ASPECT_RATIO: float = 1.5  # Height of a tile relative to its width, shorter receipts are not split
+    OCR_TILE_OVERLAP: float = 0.15  # Fraction of the height of a tile shared with the next one
+    OCR_TILE_MAX_TILES: int = 6
+
+    # Batch OCR
+    OCR_BATCH_MAX_FILES: int = 20
+    OCR_BATCH_CONCURRENCY: int = 5  # Receipts of a batch extracted at the same time
+
+    # Batch split, on a pool of worker processes in every worker process, 0 meaning one per core
+    SPLIT_BATCH_MAX_OUTINGS: int = 10_000
+    SPLIT_BATCH_WORKERS: int = 0
+
+    # Outings with at least this many items are balanced with the NumPy engine, which gives the same results
+    BALANCE_VECTORIZED_MIN_ITEMS: int = 100
+
+    # Exact settlement, which takes time and memory doubling with each person, falls back to the greedy one beyond
+    # this many people or once out of time
+    SETTLEMENT_EXACT_MAX_PEOPLE: int = 20
+    SETTLEMENT_EXACT_TIME_BUDGET_SECONDS: float = 0.5
+
+    # Outings edited one bill at a time (/bills/outings)
+    OUTING_STORE_BACKEND: Literal["memory", "sqlite"] = "sqlite"
+
+    # Time spent in each stage of serving a request, in its Server-Timing header and added up in /metrics
+    STAGE_TIMING_ENABLED: bool = True
+
     model_config = SettingsConfigDict(env_file=BACKEND_DIR / ".env", env_file_encoding="utf-8", extra="ignore")
 
 
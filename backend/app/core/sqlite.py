@@ -0,0 +1,38 @@
+import sqlite3
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class SQLiteDatabase:
+    """
+    SQLite database on local disk, shared by all the worker processes started by gunicorn.
+
+    A new connection is opened for every unit of work, since connections can not be shared between threads,
+    and the schema is created on first use.
+    """
+
+    def __init__(self, path: Path, schema: str):
+        self.path = path
+        self.schema = schema
+        self._schema_ready = False
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """
+        Open a connection, and commit (or roll back on error) when the block exits.
+        """
+        if not self._schema_ready:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        connection = sqlite3.connect(self.path, timeout=5)
+        try:
+            if not self._schema_ready:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(self.schema)
+                self._schema_ready = True
+
+            with connection:
+                yield connection
+        finally:
+            connection.close()
@@ -0,0 +1,10 @@
+def format_sse_event(event: str, data: str) -> str:
+    """
+    Format a server-sent event, see https://html.spec.whatwg.org/multipage/server-sent-events.html
+
+    :param event: Name of the event, which clients listen to
+    :param data: Payload of the event, usually JSON
+    :return: The event, ready to be written to a `text/event-stream` response
+    """
+    data_lines = "".join(f"data: {line}\n" for line in data.splitlines() or [""])
+    return f"event: {event}\n{data_lines}\n"
@@ -1,20 +1,88 @@
-from fastapi import FastAPI
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 
 from app.api.v1.api import router
+from app.core.middleware import LLMUsageMiddleware, RequestSizeLimitMiddleware, StageTimingMiddleware
 from app.core.settings import settings
+from app.services.admission import AdmissionRejectedError
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.llm_http_client import llm_http_client
+from app.services.llm_usage import TokenBudgetExceededError
+from app.services.ocr_jobs import ocr_job_workers
+from app.services.split_pool import split_pool
+from app.services.stage_timing import stage_timing
+
+# Room for the multipart boundaries and headers around the uploaded images
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    llm_http_client.start()
+    ocr_job_workers.start()
+    split_pool.start()
+    yield
+    await split_pool.stop()
+    await ocr_job_workers.stop()
+    await llm_http_client.stop()
+
 
 app = FastAPI(
     title="Bill Splitter",
     description="A small utility to split bills amongst friends",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
-    CORSMiddleware,  # type: ignore
+    CORSMiddleware,
     allow_origins=settings.CORS_ALLOW_HOSTS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "X-LLM-Calls",
+        "X-LLM-Prompt-Tokens",
+        "X-LLM-Completion-Tokens",
+        "X-LLM-Latency-Ms",
+        "X-LLM-Cost-USD",
+        "Retry-After",
+        "Server-Timing",
+    ],
+)
+
+app.add_middleware(LLMUsageMiddleware)
+
+app.add_middleware(
+    RequestSizeLimitMiddleware,
+    limits={
+        "/api/v1/bills/ocr": settings.OCR_MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+        "/api/v1/bills/ocr/jobs": settings.OCR_MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+        "/api/v1/bills/ocr/stream": settings.OCR_MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+        "/api/v1/bills/ocr/batch": (settings.OCR_MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES)
+        * settings.OCR_BATCH_MAX_FILES,
+    },
 )
 
+app.add_middleware(StageTimingMiddleware, timing=stage_timing)
+
+
+@app.exception_handler(TokenBudgetExceededError)
+async def token_budget_exceeded_handler(_: Request, exc: TokenBudgetExceededError) -> JSONResponse:
+    return JSONResponse({"detail": str(exc)}, status_code=429, headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.exception_handler(AdmissionRejectedError)
+async def admission_rejected_handler(_: Request, exc: AdmissionRejectedError) -> JSONResponse:
+    return JSONResponse({"detail": str(exc)}, status_code=429, headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(_: Request, exc: CircuitOpenError) -> JSONResponse:
+    return JSONResponse({"detail": str(exc)}, status_code=503, headers={"Retry-After": str(exc.retry_after)})
+
+
 app.include_router(router, prefix="/api/v1")
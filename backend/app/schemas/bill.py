@@ -14,6 +14,18 @@ class OCRBill(BaseModel):
     amount_paid: float = Field(gt=0.0)
 
 
+class OCRBillTotals(BaseModel):
+    tax_rate: float
+    service_charge: float
+    amount_paid: float
+
+
+class OCRBatchResult(BaseModel):
+    filename: str | None
+    bill: OCRBill | None = None
+    error: str | None = None
+
+
 class Item(BaseModel):
     name: str = Field(min_length=1)
     price: float = Field(gt=0.0)
@@ -55,3 +67,8 @@ class PaymentPlan(BaseModel):
 
 class OutingSplit(BaseModel):
     payment_plans: list[PaymentPlan]
+
+
+class SplitBatchResult(BaseModel):
+    split: OutingSplit | None = None
+    error: str | None = None
@@ -0,0 +1,132 @@
+from typing import Literal
+
+from pydantic import BaseModel
+
+
+class OCRCacheStats(BaseModel):
+    enabled: bool
+    memory_hits: int
+    disk_hits: int
+    misses: int
+    memory_entries: int
+
+
+class ImagePreprocessingStats(BaseModel):
+    enabled: bool
+    images: int = 0
+    original_bytes: int = 0
+    processed_bytes: int = 0
+    stage_seconds: dict[str, float] = {}
+
+
+class LLMHTTPPoolStats(BaseModel):
+    started: bool
+    http2: bool
+    max_connections: int
+    requests: int = 0
+    requests_waiting: int = 0  # Requests waiting for a connection from the pool, or for it to connect
+    connections_open: int = 0
+    connections_idle: int = 0
+    connections_opened: int = 0
+    connections_reused: int = 0  # Requests sent over a connection which was already open
+
+
+class SingleFlightStats(BaseModel):
+    in_flight: int
+    calls: int  # Calls which actually ran
+    coalesced: int  # Calls which waited for an identical one in flight instead
+
+
+class NearDuplicateStats(BaseModel):
+    enabled: bool
+    entries: int
+    lookups: int
+    hits: int
+
+
+class HedgingStats(BaseModel):
+    enabled: bool
+    delay_seconds: float  # Delay before the latest hedge decision
+    requests: int = 0
+    hedged: int = 0  # Requests also sent to the secondary model, each one an extra LLM call
+    decisions: dict[str, int] = {}  # e.g. primary_only, primary_slow_secondary_won, primary_failed_secondary_won
+
+
+class CircuitBreakerStats(BaseModel):
+    enabled: bool
+    state: Literal["closed", "open", "half_open"]
+    trips: int  # Times the breaker opened
+    rejected: int  # Calls failed fast while it was open
+    failure_rate: float  # Among the most recent calls while closed
+    slow_call_rate: float
+
+
+class RetryBudgetStats(BaseModel):
+    tokens: float  # Retries which can be made right now
+    retries: int
+    exhausted: int  # Retries not made for lack of budget
+
+
+class AdmissionStats(BaseModel):
+    max_in_flight: int
+    max_queued: int
+    in_flight: int
+    waiting: int
+    admitted: int
+    queued: int  # Admitted or rejected requests which had to wait for a slot
+    rejected_queue_full: int
+    rejected_timeout: int  # Requests which waited for a slot until the deadline
+
+
+class ClientQuotaStats(BaseModel):
+    requests_per_minute: float | None
+    burst: int
+    rejected: int
+
+
+class LLMModelUsage(BaseModel):
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    image_bytes: int = 0
+    latency_seconds: float = 0.0
+    cost_usd: float = 0.0  # Estimated, excludes calls to models LiteLLM does not know the price of
+
+
+class TokenBudgetStats(BaseModel):
+    daily_tokens: int | None
+    client_daily_tokens: int | None
+    used_tokens_today: int  # By all clients together, in all worker processes
+    rejected: int
+    downgraded: int
+
+
+class LLMUsageStats(BaseModel):
+    models: dict[str, LLMModelUsage]
+    budget: TokenBudgetStats
+
+
+class StageStats(BaseModel):
+    count: int
+    total_seconds: float
+    max_seconds: float
+
+
+class StageTimingStats(BaseModel):
+    enabled: bool
+    stages: dict[str, StageStats]  # e.g. parse, balances, settlement, llm, ocr_validation, serialize
+
+
+class MetricsResponse(BaseModel):
+    ocr_cache: OCRCacheStats
+    image_preprocessing: ImagePreprocessingStats
+    llm_http_pool: LLMHTTPPoolStats
+    ocr_single_flight: SingleFlightStats
+    ocr_near_duplicates: NearDuplicateStats
+    ocr_hedging: HedgingStats
+    llm_usage: LLMUsageStats
+    llm_circuit_breakers: dict[str, CircuitBreakerStats]  # By API base of the provider
+    llm_retry_budget: RetryBudgetStats
+    ocr_admission: AdmissionStats
+    ocr_client_quota: ClientQuotaStats
+    stage_timing: StageTimingStats
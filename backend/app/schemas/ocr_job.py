@@ -0,0 +1,26 @@
+from datetime import datetime
+from enum import StrEnum
+
+from pydantic import BaseModel
+
+from app.schemas.bill import OCRBill
+
+
+class OCRJobStatus(StrEnum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class OCRJob(BaseModel):
+    id: str
+    status: OCRJobStatus
+    created_at: datetime
+    updated_at: datetime
+    result: OCRBill | None = None
+    error: str | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (OCRJobStatus.SUCCEEDED, OCRJobStatus.FAILED)
@@ -0,0 +1,38 @@
+from datetime import datetime
+
+from pydantic import BaseModel, Field
+
+from app.schemas.bill import Bill, Item
+
+
+class NewOuting(BaseModel):
+    bills: list[Bill] = Field(default_factory=list)
+
+
+class StoredBill(Bill):
+    id: int
+
+
+class StoredOuting(BaseModel):
+    id: str
+    created_at: datetime
+    updated_at: datetime
+    bills: list[StoredBill]
+
+
+class BillUpdate(BaseModel):
+    """
+    Fields of a bill to change, the others (unset or null) being kept as they are.
+    """
+
+    items: list[Item] | None = Field(default=None, min_length=1)
+    paid_by: str | None = Field(default=None, min_length=1)
+    amount_paid: float | None = Field(default=None, gt=0.0)
+    tax_rate: float | None = Field(default=None, ge=0.0, le=1.0)
+    service_charge: float | None = Field(default=None, ge=0.0, le=1.0)
+
+    def apply(self, bill: Bill) -> Bill:
+        """
+        :return: A copy of the bill with the fields of the update, validated again
+        """
+        return Bill.model_validate({**bill.model_dump(), **self.model_dump(exclude_unset=True, exclude_none=True)})
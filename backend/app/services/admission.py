@@ -0,0 +1,251 @@
+"""
+Admission control and per-client quotas for OCR requests.
+
+Each worker process only extracts a bounded number of bills at a time. Requests beyond that wait in a bounded queue,
+in arrival order, for at most a deadline, and requests arriving while the queue is full are rejected at once, so that
+a burst can not pile up multi-second LLM calls and make every other user wait.
+
+Each client is also limited by a token bucket, so that a single client can not take all the capacity. The buckets
+are kept in a SQLite database in DATA_DIR, so that the quota holds across all the worker processes.
+"""
+
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from app.core.settings import settings
+from app.core.sqlite import SQLiteDatabase
+from app.schemas.metrics import AdmissionStats, ClientQuotaStats
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS client_quota (
+    client TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS client_quota_updated_at ON client_quota (updated_at);
+"""
+
+# Buckets of clients idle for long enough to be full again are deleted every this many requests
+_QUOTA_PRUNE_INTERVAL = 1000
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the requests of this worker process in flight, with a bounded FIFO queue of requests waiting for a slot.
+    """
+
+    def __init__(self, max_in_flight: int, max_queued: int, queue_timeout_seconds: float):
+        """
+        :param max_in_flight: Requests handled at the same time
+        :param max_queued: Requests waiting for a slot, beyond which requests are rejected at once
+        :param queue_timeout_seconds: How long a request waits for a slot before it is rejected
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout_seconds = queue_timeout_seconds
+
+        # Only used from the event loop, the lock guards the counters read by the stats
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters: deque[asyncio.Future[None]] = deque()
+        # Moving average of how long requests hold a slot, to tell rejected clients when to retry
+        self._average_seconds = 1.0
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    def _retry_after(self) -> int:
+        # Time for the requests ahead to be served, if they leave the slots at the average pace
+        backlog = (len(self._waiters) + self._in_flight) / self.max_in_flight
+        return max(1, math.ceil(backlog * self._average_seconds))
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """
+        Hold a slot for the duration of the block, waiting in the queue for one if needed.
+
+        :raises AdmissionRejectedError: If the queue is full, or no slot was free before the deadline
+        """
+        await self._acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._average_seconds = 0.9 * self._average_seconds + 0.1 * (time.perf_counter() - start)
+            self._release()
+
+    async def _acquire(self) -> None:
+        if self._in_flight < self.max_in_flight and not self._waiters:
+            with self._lock:
+                self._in_flight += 1
+                self.admitted += 1
+            return
+
+        if len(self._waiters) >= self.max_queued:
+            with self._lock:
+                self.rejected_queue_full += 1
+            raise AdmissionRejectedError("Too many requests, please try again later.", self._retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        with self._lock:
+            self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout_seconds)
+        except TimeoutError:
+            if not waiter.done():
+                self._waiters.remove(waiter)
+                with self._lock:
+                    self.rejected_timeout += 1
+                raise AdmissionRejectedError("Too many requests, please try again later.", self._retry_after())
+        except asyncio.CancelledError:
+            if waiter.done():
+                # The slot was handed over just as the request was cancelled, pass it on
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+        # The slot was handed over by `_release`, which already counted it in flight
+        with self._lock:
+            self.admitted += 1
+
+    def _release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # Hand the slot over to the oldest waiting request, so it stays in flight
+                waiter.set_result(None)
+                return
+        with self._lock:
+            self._in_flight -= 1
+
+    def stats(self) -> AdmissionStats:
+        with self._lock:
+            return AdmissionStats(
+                max_in_flight=self.max_in_flight,
+                max_queued=self.max_queued,
+                in_flight=self._in_flight,
+                waiting=len(self._waiters),
+                admitted=self.admitted,
+                queued=self.queued,
+                rejected_queue_full=self.rejected_queue_full,
+                rejected_timeout=self.rejected_timeout,
+            )
+
+
+class ClientQuota:
+    """
+    Token bucket of each client, shared by all the worker processes.
+    """
+
+    def __init__(self, path: Path, requests_per_minute: float | None, burst: int):
+        """
+        :param path: Path of the SQLite database holding the buckets
+        :param requests_per_minute: Rate at which the bucket of a client refills, or None for no quota
+        :param burst: Size of the bucket of a client, i.e. how many requests it can make at once after a quiet period
+        """
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+
+        self._database = SQLiteDatabase(path, _SCHEMA)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests_per_minute is not None
+
+    def acquire(self, client_id: str | None, count: int = 1) -> None:
+        """
+        Take tokens from the bucket of a client. This hits the disk, so call it from a worker thread in async code.
+
+        :param client_id: Identifies the client, requests of unidentified clients are not limited
+        :param count: Tokens to take, e.g. one per image of a batch. More tokens than the burst can be taken from a
+            full bucket, which then goes into debt, so that the client waits for it to refill before its next request
+        :raises AdmissionRejectedError: If the bucket of the client does not hold enough tokens
+        """
+        if self.requests_per_minute is None or client_id is None:
+            return
+
+        rate = self.requests_per_minute / 60
+        now = time.time()
+        needed = min(count, self.burst)
+        parameters = {
+            "client": client_id,
+            "now": now,
+            "rate": rate,
+            "burst": self.burst,
+            "count": count,
+            "needed": needed,
+        }
+        with self._database.connect() as connection:
+            # A single statement, so that two workers can never take the last token of a client
+            taken = connection.execute(
+                """
+                INSERT INTO client_quota (client, tokens, updated_at) VALUES (:client, :burst - :count, :now)
+                ON CONFLICT (client) DO UPDATE
+                SET tokens = MIN(:burst, tokens + (:now - updated_at) * :rate) - :count, updated_at = :now
+                WHERE MIN(:burst, tokens + (:now - updated_at) * :rate) >= :needed
+                RETURNING tokens
+                """,
+                parameters,
+            ).fetchone()
+            if taken is None:
+                row = connection.execute(
+                    "SELECT MIN(:burst, tokens + (:now - updated_at) * :rate) FROM client_quota WHERE client = :client",
+                    parameters,
+                ).fetchone()
+
+            with self._lock:
+                self._requests += 1
+                prune = self._requests % _QUOTA_PRUNE_INTERVAL == 0
+            if prune:
+                connection.execute("DELETE FROM client_quota WHERE updated_at < ?", (now - self.burst / rate,))
+
+        if taken is None:
+            with self._lock:
+                self.rejected += 1
+            retry_after = (needed - row[0]) / rate if row is not None else 1
+            raise AdmissionRejectedError(
+                "Request quota exceeded, please try again later.", retry_after=max(1, math.ceil(retry_after))
+            )
+
+    def clear(self) -> None:
+        with self._database.connect() as connection:
+            connection.execute("DELETE FROM client_quota")
+        with self._lock:
+            self.rejected = 0
+
+    def stats(self) -> ClientQuotaStats:
+        with self._lock:
+            return ClientQuotaStats(
+                requests_per_minute=self.requests_per_minute, burst=self.burst, rejected=self.rejected
+            )
+
+
+ocr_admission = AdmissionController(
+    max_in_flight=settings.OCR_MAX_IN_FLIGHT,
+    max_queued=settings.OCR_MAX_QUEUED,
+    queue_timeout_seconds=settings.OCR_QUEUE_TIMEOUT_SECONDS,
+)
+
+ocr_client_quota = ClientQuota(
+    path=settings.DATA_DIR / "client_quota.sqlite3",
+    requests_per_minute=settings.OCR_CLIENT_REQUESTS_PER_MINUTE,
+    burst=settings.OCR_CLIENT_BURST,
+)
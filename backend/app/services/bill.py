@@ -1,23 +1,200 @@
+import asyncio
+import logging
 from collections import defaultdict
+from collections.abc import AsyncIterator, Sequence
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
-from app.schemas.bill import OCRBill, Outing, OutingSplit, Payment, PaymentPlan
-from app.services import litellm_service
+from app.core.settings import settings
+from app.schemas.bill import Bill, OCRBill, OCRBillItem, Outing, OutingSplit, Payment, PaymentPlan
+from app.services.compact_outing import CompactOuting
+from app.services.image_preprocessing import image_preprocessor
+from app.services.json_stream import IncrementalArrayParser
+from app.services.money import allocate, from_cents, to_cents
+from app.services.near_duplicates import near_duplicate_index
+from app.services.ocr_cache import make_cache_key, ocr_cache
+from app.services.ocr_engines import ocr_engine
+from app.services.settlement import SettlementStrategy, zero_sum_groups
+from app.services.single_flight import SingleFlight
+from app.services.stage_timing import stage_timing
+from app.services.tiling import merge_tiles
+from app.services.vectorized_balance import net_balances
+
+logger = logging.getLogger(__name__)
+
+# Identical images in flight at the same time, e.g. after a double-tapped upload, share a single LLM call
+ocr_single_flight: SingleFlight[OCRBill] = SingleFlight()
 
 
 def get_bill_details_from_image(image_bytes: bytes, mime_type: str) -> OCRBill:
-    bill_data = litellm_service.get_bill_details_from_image(
-        image_bytes=image_bytes,
-        mime_type=mime_type,
-    )
+    # The cache key identifies the image, model and prompt, so it also identifies identical calls in flight
+    cache_key = make_cache_key(image_bytes, ocr_engine.model, ocr_engine.prompt_version)
+    return ocr_single_flight.do(cache_key, lambda: _get_bill_details_from_image(cache_key, image_bytes, mime_type))
 
+
+@stage_timing.timed("ocr_validation")
+def _validate_ocr_bill(bill_data: str | bytes) -> OCRBill:
     return OCRBill.model_validate_json(bill_data)
 
 
+def _find_near_duplicate(image_bytes: bytes, prompt_version: str) -> tuple[int | None, str | None]:
+    """
+    Look up the OCR result of an earlier photo of the same receipt, extracted with the same prompt.
+
+    :return: The perceptual hash of the image, if it could be computed, and the OCR result of a near-duplicate
+    """
+    image_hash = near_duplicate_index.hash_image(image_bytes)
+    if image_hash is None:
+        return None, None
+
+    duplicate_cache_key = near_duplicate_index.find(image_hash, prompt_version)
+    if duplicate_cache_key is None:
+        return image_hash, None
+    return image_hash, ocr_cache.get(duplicate_cache_key)
+
+
+def _get_bill_details_from_image(cache_key: str, image_bytes: bytes, mime_type: str) -> OCRBill:
+    # Re-uploads of the same receipt are served from the cache instead of calling the LLM again
+    cached_bill_data = ocr_cache.get(cache_key)
+    if cached_bill_data is not None:
+        return _validate_ocr_bill(cached_bill_data)
+
+    # And so are re-photographs of a receipt, which only differ slightly from the earlier photo
+    image_hash, cached_bill_data = _find_near_duplicate(image_bytes, ocr_engine.prompt_version)
+    if cached_bill_data is not None:
+        return _validate_ocr_bill(cached_bill_data)
+
+    image = image_preprocessor.preprocess(image_bytes, mime_type)
+    bill_data = ocr_engine.get_bill_details_from_image(
+        image_bytes=image.content,
+        mime_type=image.mime_type,
+    )
+
+    ocr_bill = _validate_ocr_bill(bill_data)
+    ocr_cache.set(cache_key, ocr_bill.model_dump_json())
+    if image_hash is not None:
+        near_duplicate_index.add(image_hash, ocr_engine.prompt_version, cache_key)
+    return ocr_bill
+
+
+async def aget_bill_details_from_image(image_bytes: bytes, mime_type: str, tiled: bool = False) -> OCRBill:
+    """
+    Async version of `get_bill_details_from_image`, for use from the event loop.
+
+    The cache tiers are queried and the image is preprocessed in worker threads, since both are blocking.
+
+    :param tiled: Whether to split a tall receipt into overlapping tiles, which are extracted concurrently
+    """
+    # Tiled extractions are cached apart, since they may read a long receipt differently
+    prompt_version = f"{ocr_engine.prompt_version}-tiled" if tiled else ocr_engine.prompt_version
+    cache_key = make_cache_key(image_bytes, ocr_engine.model, prompt_version)
+    extraction = _aget_bill_details_from_image(cache_key, prompt_version, image_bytes, mime_type, tiled)
+    # Only the extraction holds on to the upload from here on, so that it can free it once preprocessed
+    del image_bytes
+    return await ocr_single_flight.ado(cache_key, extraction)
+
+
+async def _aget_bill_details_from_image(
+    cache_key: str, prompt_version: str, image_bytes: bytes, mime_type: str, tiled: bool
+) -> OCRBill:
+    cached_bill_data = await asyncio.to_thread(ocr_cache.get, cache_key)
+    if cached_bill_data is not None:
+        return _validate_ocr_bill(cached_bill_data)
+
+    image_hash, cached_bill_data = await asyncio.to_thread(_find_near_duplicate, image_bytes, prompt_version)
+    if cached_bill_data is not None:
+        return _validate_ocr_bill(cached_bill_data)
+
+    if tiled:
+        images = await asyncio.to_thread(
+            image_preprocessor.preprocess_tiles,
+            image_bytes,
+            mime_type,
+            tile_aspect_ratio=settings.OCR_TILE_ASPECT_RATIO,
+            overlap=settings.OCR_TILE_OVERLAP,
+            max_tiles=settings.OCR_TILE_MAX_TILES,
+        )
+    else:
+        images = [await asyncio.to_thread(image_preprocessor.preprocess, image_bytes, mime_type)]
+    # Only the preprocessed image is needed from here on, let the original upload be freed during the LLM call
+    del image_bytes
+
+    if len(images) == 1:
+        ocr_bill = _validate_ocr_bill(
+            await ocr_engine.aget_bill_details_from_image(image_bytes=images[0].content, mime_type=images[0].mime_type)
+        )
+    else:
+        # The tiles are extracted concurrently, and if any of them fails, the others are cancelled. Only the items of
+        # the tiles above the last one are merged, so their totals need not be valid.
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                tasks = [
+                    task_group.create_task(
+                        ocr_engine.aget_bill_details_from_image(
+                            tile.content, tile.mime_type, items_only=index < len(images) - 1
+                        )
+                    )
+                    for index, tile in enumerate(images)
+                ]
+        except ExceptionGroup as group:
+            # Raise the error of the first tile which failed, as for an untiled receipt, so that the app handles it,
+            # e.g. an open circuit with a 503
+            raise group.exceptions[0]
+        with stage_timing.stage("ocr_validation"):
+            ocr_bill = merge_tiles([task.result() for task in tasks])
+
+    await asyncio.to_thread(ocr_cache.set, cache_key, ocr_bill.model_dump_json())
+    if image_hash is not None:
+        near_duplicate_index.add(image_hash, prompt_version, cache_key)
+    return ocr_bill
+
+
+async def astream_bill_details_from_image(image_bytes: bytes, mime_type: str) -> AsyncIterator[OCRBillItem | OCRBill]:
+    """
+    Streaming version of `aget_bill_details_from_image`, which yields each item of the bill as soon as the LLM has
+    extracted it, and then the whole bill once it is complete and valid.
+
+    Cached results are replayed the same way. Identical streams in flight at the same time are not coalesced.
+    """
+    cache_key = make_cache_key(image_bytes, ocr_engine.model, ocr_engine.prompt_version)
+    image_hash = None
+    cached_bill_data = await asyncio.to_thread(ocr_cache.get, cache_key)
+    if cached_bill_data is None:
+        image_hash, cached_bill_data = await asyncio.to_thread(
+            _find_near_duplicate, image_bytes, ocr_engine.prompt_version
+        )
+    if cached_bill_data is not None:
+        ocr_bill = _validate_ocr_bill(cached_bill_data)
+        for item in ocr_bill.items:
+            yield item
+        yield ocr_bill
+        return
+
+    image = await asyncio.to_thread(image_preprocessor.preprocess, image_bytes, mime_type)
+    del image_bytes
+
+    parser = IncrementalArrayParser("items")
+    async for chunk in ocr_engine.astream_bill_details_from_image(
+        image_bytes=image.content,
+        mime_type=image.mime_type,
+    ):
+        for item_data in parser.feed(chunk):
+            try:
+                yield OCRBillItem.model_validate(item_data)
+            except ValidationError:
+                # Only valid items are streamed, an invalid one fails the validation of the whole bill below anyway
+                continue
+
+    ocr_bill = _validate_ocr_bill(parser.document)
+    await asyncio.to_thread(ocr_cache.set, cache_key, ocr_bill.model_dump_json())
+    if image_hash is not None:
+        near_duplicate_index.add(image_hash, ocr_engine.prompt_version, cache_key)
+    yield ocr_bill
+
+
 class PersonBalance(BaseModel):
     name: str
-    amount: float
+    amount: int  # In cents
 
 
 class OutingPaymentBalance(BaseModel):
@@ -27,42 +204,69 @@ class OutingPaymentBalance(BaseModel):
 
 def calculate_balance(outing: Outing) -> OutingPaymentBalance:
     """
-    Calculate how much each person in the outing owes / is owed.
+    Calculate how much each person in the outing owes / is owed, in cents.
+
+    The amount paid for each bill is shared among its items in proportion to their price, so that tax, service charge
+    and discount are shared in the same proportion, then the cost of each item is split equally among its consumers.
+    Leftover cents are allocated with the largest remainder method, so the balances sum to exactly zero.
 
     :param outing: Contains the bills of the outing
     :return: List of creditors and debtors
     """
-    balance = defaultdict(float)
+    people, balances = _outing_balances(outing)
+    return payment_balance(dict(zip(people, balances)))
 
-    for bill in outing.bills:
-        balance[bill.paid_by] += round(bill.amount_paid, 2)
 
-        # Apply tax and service charge multiplier to the item cost
-        additional_charge_rate = 1 + bill.tax_rate + bill.service_charge
+def calculate_outing_split(outing: Outing, strategy: SettlementStrategy = "greedy") -> OutingSplit:
+    """
+    Calculate the optimal split of expenses for an outing, like `calculate_balance` followed by
+    `calculate_outing_split_with_minimal_transactions`, without building a model per person in between.
+
+    :param outing: Contains the bills of the outing
+    :param strategy: How to find the transactions
+    :return: An OutingSplit containing a list of payment plans for each debtor
+    """
+    people, balances = _outing_balances(outing)
+    return settle_balances(people, balances, strategy)
 
-        # Calculate total price, and if the amount paid is less than total price, calculate discount applied
-        total_price = round(sum(item.price * item.quantity for item in bill.items) * additional_charge_rate, 2)
-        discount_rate = round(bill.amount_paid, 2) / total_price
-        print(f"Total price: {total_price}, Amount paid: {bill.amount_paid}, Discount rate: {discount_rate}")
 
-        for item in bill.items:
-            # Calculate actual cost for the item after applying additional charges and discount
-            cost = item.price * item.quantity * additional_charge_rate * discount_rate
+@stage_timing.timed("balances")
+def _outing_balances(outing: Outing) -> tuple[list[str], list[int]]:
+    """
+    Calculate the net balance of each person in the outing.
 
-            # Split cost equally among consumers and round to avoid floating-point precision issues
-            cost_per_person = cost / len(item.consumed_by)
+    Outings with at least BALANCE_VECTORIZED_MIN_ITEMS items are computed with the NumPy engine on their
+    `CompactOuting`, which gives the same results. Smaller ones are computed item by item, straight from the models.
 
-            for consumer in item.consumed_by:
-                balance[consumer] -= cost_per_person
+    :return: The people of the outing, in the order they first appear, and their balances, in cents
+    """
+    if sum(len(bill.items) for bill in outing.bills) >= settings.BALANCE_VECTORIZED_MIN_ITEMS:
+        try:
+            compact = CompactOuting.from_outing(outing)
+            return compact.people, net_balances(compact)
+        except OverflowError:
+            # Amounts too large for 64-bit integers, which Python's integers handle
+            pass
 
+    balance = _net_balances(outing)
+    return list(balance), list(balance.values())
+
+
+def payment_balance(balance: dict[str, int]) -> OutingPaymentBalance:
+    """
+    Sort people into creditors and debtors by their balance.
+
+    :param balance: Balance of each person, in cents
+    :return: List of creditors and debtors
+    """
     creditors = []
     debtors = []
 
-    for key, value in dict(balance).items():
+    for key, value in balance.items():
         if value > 0:
-            creditors.append(PersonBalance(name=key, amount=round(value, 2)))
+            creditors.append(PersonBalance(name=key, amount=value))
         else:
-            debtors.append(PersonBalance(name=key, amount=round(value, 2) * -1))
+            debtors.append(PersonBalance(name=key, amount=-value))
 
     # Sort by amount descending to match largest debts/credits first for optimal settlement
     creditors.sort(key=lambda x: x.amount, reverse=True)
@@ -71,50 +275,149 @@ def calculate_balance(outing: Outing) -> OutingPaymentBalance:
     return OutingPaymentBalance(creditors=creditors, debtors=debtors)
 
 
+def _net_balances(outing: Outing) -> dict[str, int]:
+    balance: defaultdict[str, int] = defaultdict(int)
+    for bill in outing.bills:
+        add_bill_balances(balance, bill)
+    return dict(balance)
+
+
+def add_bill_balances(balance: defaultdict[str, int], bill: Bill) -> None:
+    """
+    Add what each person paid minus what they consumed in a bill to their balance.
+
+    :param balance: Balance of each person, in cents, updated in place
+    :param bill: The bill to add
+    """
+    amount_paid = to_cents(bill.amount_paid)
+    balance[bill.paid_by] += amount_paid
+
+    # Tax, service charge and discount apply to every item alike, so the amount paid is shared by item price
+    item_prices = [to_cents(item.price) * item.quantity for item in bill.items]
+    if not any(item_prices):
+        # Items which are all free to the cent weigh the same
+        item_prices = [1] * len(item_prices)
+
+    for item, item_cost in zip(bill.items, allocate(amount_paid, item_prices)):
+        # Split the cost equally among consumers, the leftover cents going to the first ones
+        cost, leftover = divmod(item_cost, len(item.consumed_by))
+        for index, consumer in enumerate(item.consumed_by):
+            balance[consumer] -= cost + 1 if index < leftover else cost
+
+
 def calculate_outing_split_with_minimal_transactions(
     balance: OutingPaymentBalance,
+    strategy: SettlementStrategy = "greedy",
 ) -> OutingSplit:
     """
     Calculate the minimal number of transactions needed to settle all debts.
 
-    This function uses a greedy algorithm to match debtors with creditors,
-    settling debts in the order of largest amounts first. It minimizes the
-    number of transactions by matching debtors and creditors until all balances
-    are settled to zero.
+    The greedy strategy matches debtors with creditors, settling debts in the
+    order of largest amounts first. Each transaction settles at least one
+    debtor or creditor, and the balances sum to zero, so n people are settled
+    in at most n - 1 transactions.
+
+    The exact strategy first splits people into as many groups as possible
+    whose balances sum to zero, each of which is settled greedily on its own,
+    which saves a transaction per group. It falls back to the greedy strategy
+    for too many people, or if it runs out of time.
 
-    :param balance: Contains lists of creditors and debtors with their amounts
+    :param balance: Contains lists of creditors and debtors with their amounts, in cents
+    :param strategy: How to find the transactions
     :return: An OutingSplit containing a list of payment plans for each debtor
     """
-    all_payments = defaultdict(lambda: defaultdict(float))
+    people = [person.name for person in balance.creditors] + [person.name for person in balance.debtors]
+    return _settle(
+        people,
+        [person.amount for person in balance.creditors],
+        [-person.amount for person in balance.debtors],
+        strategy,
+    )
 
-    debtor_index = 0
-    creditor_index = 0
 
-    while debtor_index < len(balance.debtors) and creditor_index < len(balance.creditors):
-        debtor = balance.debtors[debtor_index]
-        creditor = balance.creditors[creditor_index]
+def settle_balances(people: list[str], balances: Sequence[int], strategy: SettlementStrategy = "greedy") -> OutingSplit:
+    """
+    Calculate the minimal number of transactions needed to settle all debts, like
+    `calculate_outing_split_with_minimal_transactions` on the `payment_balance` of the balances.
 
-        # Match the smaller of the two amounts to settle as much as possible in one transaction
-        amount_to_settle = min(debtor.amount, creditor.amount)
-        if amount_to_settle > 0:
-            all_payments[debtor.name][creditor.name] = amount_to_settle
+    :param people: Name of each person
+    :param balances: Balance of each person, in cents
+    :param strategy: How to find the transactions
+    :return: An OutingSplit containing a list of payment plans for each debtor
+    """
+    # Sort by amount descending to match largest debts/credits first for optimal settlement
+    creditors = sorted((person for person, amount in enumerate(balances) if amount > 0), key=lambda p: -balances[p])
+    debtors = sorted((person for person, amount in enumerate(balances) if amount <= 0), key=balances.__getitem__)
+    return _settle(
+        [people[person] for person in creditors] + [people[person] for person in debtors],
+        [balances[person] for person in creditors],
+        [balances[person] for person in debtors],
+        strategy,
+    )
 
-        # Reduce both balances by the settled amount
-        debtor.amount -= amount_to_settle
-        creditor.amount -= amount_to_settle
 
-        # Move to the next debtor/creditor once their balance is fully settled
-        if round(debtor.amount, 2) == 0:
-            debtor_index += 1
-        if round(creditor.amount, 2) == 0:
-            creditor_index += 1
+@stage_timing.timed("settlement")
+def _settle(people: list[str], credits: list[int], debts: list[int], strategy: SettlementStrategy) -> OutingSplit:
+    """
+    :param people: Name of each person, the creditors first, then the debtors
+    :param credits: Balance of each creditor, in order
+    :param debts: Balance of each debtor, in order, which are negative
+    """
+    balances = credits + debts
+    payments: defaultdict[int, dict[int, int]] = defaultdict(dict)
+
+    groups = None
+    if strategy == "exact":
+        groups = zero_sum_groups(
+            balances,
+            max_people=settings.SETTLEMENT_EXACT_MAX_PEOPLE,
+            time_budget_seconds=settings.SETTLEMENT_EXACT_TIME_BUDGET_SECONDS,
+        )
+        if groups is None:
+            logger.info("Exact settlement of %d people out of budget, settling greedily", len(people))
+        else:
+            for group in groups:
+                # The creditors come first, then the debtors, each still sorted by amount
+                _settle_greedily(
+                    [person for person in group if person >= len(credits)],
+                    [person for person in group if person < len(credits)],
+                    balances,
+                    payments,
+                )
+    if groups is None:
+        _settle_greedily(list(range(len(credits), len(people))), list(range(len(credits))), balances, payments)
 
     return OutingSplit(
         payment_plans=[
             PaymentPlan(
-                name=name,
-                payments=[Payment(to=to, amount=amount) for to, amount in payments.items()],
+                name=people[debtor],
+                payments=[Payment(to=people[creditor], amount=from_cents(amount)) for creditor, amount in to.items()],
             )
-            for name, payments in all_payments.items()
+            for debtor, to in payments.items()
         ]
     )
+
+
+def _settle_greedily(
+    debtors: list[int], creditors: list[int], balances: list[int], payments: defaultdict[int, dict[int, int]]
+) -> None:
+    debts = [-balances[debtor] for debtor in debtors]
+    credits = [balances[creditor] for creditor in creditors]
+    debtor_index = 0
+    creditor_index = 0
+
+    while debtor_index < len(debts) and creditor_index < len(credits):
+        # Match the smaller of the two amounts to settle as much as possible in one transaction
+        amount_to_settle = min(debts[debtor_index], credits[creditor_index])
+        if amount_to_settle > 0:
+            payments[debtors[debtor_index]][creditors[creditor_index]] = amount_to_settle
+
+        # Reduce both balances by the settled amount
+        debts[debtor_index] -= amount_to_settle
+        credits[creditor_index] -= amount_to_settle
+
+        # Move to the next debtor/creditor once their balance is fully settled
+        if debts[debtor_index] == 0:
+            debtor_index += 1
+        if credits[creditor_index] == 0:
+            creditor_index += 1
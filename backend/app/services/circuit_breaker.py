@@ -0,0 +1,248 @@
+"""
+Circuit breaker and retry budget, to fail fast while the LLM provider is degraded.
+
+The breaker watches the outcome and latency of the most recent calls. While the provider answers, it is closed and
+lets calls through. Once too many of them fail or are slow, it opens: calls fail immediately, instead of each one
+waiting out the provider timeout. After a while it is half-open, and lets a few probe calls through, which either
+close it again or open it for another while.
+
+Transient errors are retried with jittered exponential backoff, as long as the retry budget allows. The budget is a
+token bucket which every call tops up by a fraction of a token, and every retry spends a whole token from, so that
+retries can never more than multiply the load on a provider which is already struggling.
+"""
+
+import math
+import random
+import threading
+import time
+from collections import deque
+from typing import Literal
+
+from app.schemas.metrics import CircuitBreakerStats, RetryBudgetStats
+
+CircuitState = Literal["closed", "open", "half_open"]
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open circuit breaker, tripped by the rate of failed or slow calls among the most recent ones.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window: int = 20,
+        min_calls: int = 10,
+        failure_rate_threshold: float = 0.5,
+        slow_call_seconds: float = 30.0,
+        slow_call_rate_threshold: float = 0.8,
+        open_seconds: float = 30.0,
+        half_open_calls: int = 1,
+        enabled: bool = True,
+    ):
+        """
+        :param name: Names what the breaker protects, in the error raised while it is open
+        :param window: Number of most recent calls the rates are computed from
+        :param min_calls: Number of calls to observe before the breaker can trip
+        :param failure_rate_threshold: Rate of failed calls at which the breaker trips
+        :param slow_call_seconds: Calls which take longer than this are slow
+        :param slow_call_rate_threshold: Rate of slow calls at which the breaker trips
+        :param open_seconds: How long the breaker stays open before letting probe calls through
+        :param half_open_calls: Number of probe calls let through while half-open, which must all succeed to close it
+        :param enabled: Whether the breaker ever trips
+        """
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        # Whether each of the most recent calls failed, and whether it was slow
+        self._outcomes: deque[tuple[bool, bool]] = deque(maxlen=window)
+        self._state: CircuitState = "closed"
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probes_succeeded = 0
+
+        self.trips = 0
+        self.rejected = 0
+
+    def _current_state(self, now: float) -> CircuitState:
+        if self._state == "open" and now - self._opened_at >= self.open_seconds:
+            self._state = "half_open"
+            self._probes_in_flight = self._probes_succeeded = 0
+        return self._state
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def before_call(self) -> None:
+        """
+        Let a call through, or fail it fast.
+
+        :raises CircuitOpenError: If the breaker is open, or half-open with all its probe calls in flight
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == "closed":
+                return
+            if state == "half_open" and self._probes_in_flight + self._probes_succeeded < self.half_open_calls:
+                self._probes_in_flight += 1
+                return
+
+            self.rejected += 1
+            retry_after = self.open_seconds - (now - self._opened_at) if state == "open" else self.open_seconds
+        raise CircuitOpenError(
+            f"{self.name} is unavailable, please try again later.", retry_after=max(1, math.ceil(retry_after))
+        )
+
+    def release(self) -> None:
+        """
+        Forget a call let through by `before_call` which ended without an outcome, e.g. because it was cancelled.
+        """
+        with self._lock:
+            if self._state == "half_open":
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def record(self, failed: bool, latency_seconds: float) -> None:
+        """
+        Record the outcome of a call let through by `before_call`.
+
+        :param failed: Whether the call failed in a way that shows the provider is degraded, e.g. a timeout or 5xx
+        :param latency_seconds: How long the call took
+        """
+        if not self.enabled:
+            return
+
+        slow = latency_seconds > self.slow_call_seconds
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == "half_open":
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed or slow:
+                    self._trip(now)
+                else:
+                    self._probes_succeeded += 1
+                    if self._probes_succeeded >= self.half_open_calls:
+                        self._state = "closed"
+                        self._outcomes.clear()
+                return
+            if state == "open":
+                # A call let through before the breaker tripped
+                return
+
+            self._outcomes.append((failed, slow))
+            if len(self._outcomes) >= self.min_calls:
+                failure_rate, slow_call_rate = self._rates()
+                if failure_rate >= self.failure_rate_threshold or slow_call_rate >= self.slow_call_rate_threshold:
+                    self._trip(now)
+
+    def _trip(self, now: float) -> None:
+        self._state = "open"
+        self._opened_at = now
+        self._outcomes.clear()
+        self.trips += 1
+
+    def _rates(self) -> tuple[float, float]:
+        if not self._outcomes:
+            return 0.0, 0.0
+        failures = sum(failed for failed, _ in self._outcomes)
+        slow_calls = sum(slow for _, slow in self._outcomes)
+        return failures / len(self._outcomes), slow_calls / len(self._outcomes)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._state = "closed"
+            self._outcomes.clear()
+            self._probes_in_flight = self._probes_succeeded = 0
+            self.trips = self.rejected = 0
+
+    def stats(self) -> CircuitBreakerStats:
+        with self._lock:
+            failure_rate, slow_call_rate = self._rates()
+            return CircuitBreakerStats(
+                enabled=self.enabled,
+                state=self._current_state(time.monotonic()),
+                trips=self.trips,
+                rejected=self.rejected,
+                failure_rate=failure_rate,
+                slow_call_rate=slow_call_rate,
+            )
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a fraction of calls.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float):
+        """
+        :param ratio: Tokens added by each call, i.e. the fraction of calls which can be retried in the long run
+        :param max_tokens: Size of the bucket, i.e. how many retries a burst of errors can use up at once
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+
+        self._lock = threading.Lock()
+        self._tokens = max_tokens
+        self.retries = 0
+        self.exhausted = 0
+
+    def deposit(self) -> None:
+        """
+        Top up the budget for a call.
+        """
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """
+        Spend a token on a retry.
+
+        :return: Whether the retry is within budget
+        """
+        with self._lock:
+            if self._tokens < 1:
+                self.exhausted += 1
+                return False
+            self._tokens -= 1
+            self.retries += 1
+            return True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._tokens = self.max_tokens
+            self.retries = self.exhausted = 0
+
+    def stats(self) -> RetryBudgetStats:
+        with self._lock:
+            return RetryBudgetStats(tokens=self._tokens, retries=self.retries, exhausted=self.exhausted)
+
+
+def backoff_delay(attempt: int, base_seconds: float, max_seconds: float) -> float:
+    """
+    Delay before a retry, with exponential backoff and full jitter, so that clients which failed together do not
+    retry together.
+
+    :param attempt: Number of the retry, from 0
+    :param base_seconds: Upper bound of the delay of the first retry
+    :param max_seconds: Upper bound of the delay of any retry
+    """
+    return random.uniform(0, min(max_seconds, base_seconds * 2**attempt))
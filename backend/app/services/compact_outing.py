@@ -0,0 +1,92 @@
+"""
+Compact representation of a large outing, for the NumPy balance engine.
+
+The validated `Outing` is walked once, to number people in the order they first appear, and to gather its amounts
+into flat arrays of 64-bit integers, one entry per bill, per item or per share of an item, i.e. (item, consumer) pair.
+The NumPy engine reads the arrays without copying them, and an entry takes 8 bytes, instead of a boxed Python integer
+and a pointer to it in a list. The balances come out as a plain list of cents indexed by person id, which the
+settlement works on until the `OutingSplit` is built.
+"""
+
+from array import array
+
+from app.schemas.bill import Outing
+from app.services.money import to_cents
+
+
+class _PersonIndex(dict[str, int]):
+    """
+    Numbers people in the order they first appear.
+    """
+
+    def __missing__(self, name: str) -> int:
+        index = self[name] = len(self)
+        return index
+
+
+class CompactOuting:
+    __slots__ = ("bill_sizes", "item_consumers", "item_weights", "paid", "payers", "people", "share_people")
+
+    def __init__(
+        self,
+        people: list[str],
+        payers: array,
+        paid: array,
+        bill_sizes: array,
+        item_weights: array,
+        item_consumers: array,
+        share_people: array,
+    ):
+        # Name of each person id
+        self.people = people
+        # Per bill: who paid, how much in cents, and how many items it has
+        self.payers = payers
+        self.paid = paid
+        self.bill_sizes = bill_sizes
+        # Per item: its weight in the share of the amount paid for its bill, and how many people consumed it
+        self.item_weights = item_weights
+        self.item_consumers = item_consumers
+        # Per share: who consumed the item
+        self.share_people = share_people
+
+    @classmethod
+    def from_outing(cls, outing: Outing) -> "CompactOuting":
+        """
+        :raises OverflowError: If the amounts are too large for 64-bit integers
+        """
+        people = _PersonIndex()
+        person_id = people.__getitem__
+        payers = array("q")
+        paid = array("q")
+        bill_sizes = array("q")
+        item_weights = array("q")
+        item_consumers = array("q")
+        share_people = array("q")
+        # Appended straight into the arrays, so that the amounts are never held as lists of Python integers
+        for bill in outing.bills:
+            items = bill.items
+            payers.append(person_id(bill.paid_by))
+            paid.append(to_cents(bill.amount_paid))
+            bill_sizes.append(len(items))
+
+            # Tax, service charge and discount apply to every item alike, so the amount paid is shared by item price
+            weights = [to_cents(item.price) * item.quantity for item in items]
+            # Items which are all free to the cent weigh the same
+            item_weights.extend(weights if any(weights) else [1] * len(weights))
+            for item in items:
+                item_consumers.append(len(item.consumed_by))
+                share_people.extend(map(person_id, item.consumed_by))
+
+        return cls(
+            people=list(people),
+            payers=payers,
+            paid=paid,
+            bill_sizes=bill_sizes,
+            item_weights=item_weights,
+            item_consumers=item_consumers,
+            share_people=share_people,
+        )
+
+    @property
+    def item_count(self) -> int:
+        return len(self.item_weights)
@@ -0,0 +1,128 @@
+"""
+Hedged requests, to cut the tail latency of a slow provider.
+
+A request is sent to the primary, and if it has not answered after a delay, the same request is sent to a secondary
+as well. The first valid answer wins, and the other request is cancelled. The delay follows a percentile of the
+latencies observed from the primary, so only its slowest requests are hedged, which bounds the extra cost.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+
+from app.schemas.metrics import HedgingStats
+
+logger = logging.getLogger(__name__)
+
+
+class Hedger:
+    """
+    Races a primary and a secondary request, and records how each race was decided.
+    """
+
+    def __init__(
+        self,
+        delay_seconds: float,
+        delay_percentile: float | None = None,
+        window: int = 200,
+        min_samples: int = 20,
+        enabled: bool = True,
+    ):
+        """
+        :param delay_seconds: Delay before hedging, until enough latencies of the primary were observed
+        :param delay_percentile: Percentile of the observed latencies of the primary to use as the delay, or None to
+            always use `delay_seconds`
+        :param window: Number of most recent latencies the percentile is computed from
+        :param min_samples: Number of latencies to observe before the percentile is used
+        :param enabled: Whether requests should be hedged, only reported in the stats
+        """
+        self.delay_seconds = delay_seconds
+        self.delay_percentile = delay_percentile
+        self.min_samples = min_samples
+        self.enabled = enabled
+
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._stats = HedgingStats(enabled=enabled, delay_seconds=delay_seconds)
+
+    def delay(self) -> float:
+        """
+        How long to wait for the primary before hedging.
+        """
+        with self._lock:
+            if self.delay_percentile is None or len(self._latencies) < self.min_samples:
+                return self.delay_seconds
+            latencies = sorted(self._latencies)
+        return latencies[round(self.delay_percentile * (len(latencies) - 1))]
+
+    def _record(self, decision: str, delay: float, primary_latency: float | None) -> None:
+        with self._lock:
+            if primary_latency is not None:
+                self._latencies.append(primary_latency)
+            self._stats.requests += 1
+            self._stats.decisions[decision] = self._stats.decisions.get(decision, 0) + 1
+            if decision != "primary_only":
+                self._stats.hedged += 1
+            self._stats.delay_seconds = delay
+
+    async def run[T](self, primary: Callable[[], Awaitable[T]], secondary: Callable[[], Awaitable[T]]) -> T:
+        """
+        Send a request to the primary, and to the secondary as well if the primary is slow or fails.
+
+        :param primary: Makes the request to the primary, raises if its answer is not valid
+        :param secondary: Makes the same request to the secondary, raises if its answer is not valid
+        :return: The first valid answer
+        """
+        delay = self.delay()
+        start = time.perf_counter()
+        primary_latency: list[float] = []
+
+        async def timed_primary() -> T:
+            result = await primary()
+            primary_latency.append(time.perf_counter() - start)
+            return result
+
+        primary_task = asyncio.ensure_future(timed_primary())
+
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=delay)
+            if primary_task in done and primary_task.exception() is None:
+                self._record("primary_only", delay, primary_latency[0])
+                return primary_task.result()
+
+            reason = "primary_failed" if done else "primary_slow"
+            logger.info("Hedging request to secondary after %.3fs, primary %s", time.perf_counter() - start, reason)
+            secondary_task = asyncio.ensure_future(secondary())
+        except BaseException:
+            primary_task.cancel()
+            raise
+
+        tasks = {"primary": primary_task, "secondary": secondary_task}
+        winner = None
+        try:
+            pending = set(tasks.values())
+            while winner is None and pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((name for name, task in tasks.items() if task in done and task.exception() is None), None)
+        finally:
+            # Cancel the loser, or both requests if the caller was cancelled
+            for task in tasks.values():
+                task.cancel()
+
+        if winner is None:
+            self._record(f"{reason}_both_failed", delay, None)
+            # Neither answer is valid, report the error of the primary
+            return primary_task.result()
+
+        # A cancelled primary was at least this slow, which keeps the percentile from underestimating its latency
+        latency = primary_latency[0] if primary_latency else time.perf_counter() - start
+        self._record(f"{reason}_{winner}_won", delay, latency if reason == "primary_slow" else None)
+        logger.info("Hedged request won by %s after %.3fs", winner, time.perf_counter() - start)
+        return tasks[winner].result()
+
+    def stats(self) -> HedgingStats:
+        with self._lock:
+            return self._stats.model_copy(deep=True)
@@ -0,0 +1,278 @@
+"""
+Local image preprocessing before an image of a bill is sent for OCR.
+
+Phone photos of receipts are several megabytes, most of which is irrelevant to the LLM. Shrinking them
+locally cuts the request size, upload time and vision-token cost of every OCR call.
+"""
+
+import io
+import logging
+import threading
+import time
+
+from PIL import Image, ImageFilter, ImageOps, UnidentifiedImageError
+from pydantic import BaseModel
+
+from app.core.settings import settings
+from app.schemas.metrics import ImagePreprocessingStats
+from app.services.tiling import tile_boxes
+
+logger = logging.getLogger(__name__)
+
+# Side of the thumbnail used to locate the receipt, small enough to make cropping negligible in cost
+_CROP_PROBE_SIZE = 256
+# Padding kept around the receipt, as a fraction of the image size
+_CROP_MARGIN = 0.02
+# Only crop if the receipt covers at most this fraction of the image, else there is nothing to gain
+_CROP_MAX_AREA = 0.9
+# A detected receipt smaller than this fraction of the image is most likely noise
+_CROP_MIN_AREA = 0.1
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+class PreprocessedImage(BaseModel):
+    content: bytes
+    mime_type: str
+    original_size: int
+    stage_durations: dict[str, float] = {}
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_size - len(self.content)
+
+
+class _StageTimer:
+    def __init__(self):
+        self.durations: dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.durations[stage] = now - self._start
+        self._start = now
+
+
+def _otsu_threshold(image: Image.Image) -> int:
+    """
+    Find the gray level which best separates the bright receipt from the background.
+    """
+    histogram = image.histogram()
+    total = sum(histogram)
+    weighted_total = sum(level * count for level, count in enumerate(histogram))
+
+    background_count = 0
+    background_weighted = 0
+    best_threshold, best_variance = 0, -1.0
+
+    for level, count in enumerate(histogram):
+        background_count += count
+        if background_count == 0:
+            continue
+        foreground_count = total - background_count
+        if foreground_count == 0:
+            break
+
+        background_weighted += level * count
+        background_mean = background_weighted / background_count
+        foreground_mean = (weighted_total - background_weighted) / foreground_count
+
+        variance = background_count * foreground_count * (background_mean - foreground_mean) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = level, variance
+
+    return best_threshold
+
+
+def _find_receipt_bounding_box(image: Image.Image) -> tuple[int, int, int, int] | None:
+    """
+    Locate the receipt in a grayscale image, as the bounding box of all its bright pixels, once specks smaller than
+    the median filter are removed. Other bright objects around the receipt widen the box, possibly until it covers too
+    much of the image to be worth cropping.
+
+    :param image: Grayscale image of the bill
+    :return: The box to crop the image to, or None if cropping would not help
+    """
+    probe = image.copy()
+    probe.thumbnail((_CROP_PROBE_SIZE, _CROP_PROBE_SIZE))
+
+    threshold = _otsu_threshold(probe)
+    mask = probe.point(lambda level: 255 if level > threshold else 0).filter(ImageFilter.MedianFilter(5))
+    box = mask.getbbox()
+    if box is None:
+        return None
+
+    left, top, right, bottom = box
+    area = (right - left) * (bottom - top) / (probe.width * probe.height)
+    if not _CROP_MIN_AREA <= area <= _CROP_MAX_AREA:
+        return None
+
+    # Scale the box back up to the full image, with some margin around the receipt
+    scale_x, scale_y = image.width / probe.width, image.height / probe.height
+    margin_x, margin_y = image.width * _CROP_MARGIN, image.height * _CROP_MARGIN
+    return (
+        max(0, int(left * scale_x - margin_x)),
+        max(0, int(top * scale_y - margin_y)),
+        min(image.width, int(right * scale_x + margin_x)),
+        min(image.height, int(bottom * scale_y + margin_y)),
+    )
+
+
+class ImagePreprocessor:
+    """
+    Shrinks images of bills: EXIF auto-rotate, grayscale, downscale, crop to the receipt and re-encode.
+    """
+
+    def __init__(self, max_edge: int, image_format: str, quality: int, enabled: bool = True):
+        self.max_edge = max_edge
+        self.image_format = image_format
+        self.quality = quality
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._stats = ImagePreprocessingStats(enabled=enabled)
+
+    def preprocess(self, image_bytes: bytes, mime_type: str) -> PreprocessedImage:
+        """
+        Preprocess an image of a bill. This is CPU bound, so call it from a worker thread in async code.
+
+        If the image can not be decoded, is too big to be safely decoded, or preprocessing would make it bigger, the
+        original image is returned.
+
+        :param image_bytes: The image bytes of the bill
+        :param mime_type: The MIME type of the image (e.g., "image/jpeg")
+        :return: The image to send for OCR, along with how long each stage took
+        """
+        original = PreprocessedImage(content=image_bytes, mime_type=mime_type, original_size=len(image_bytes))
+        if not self.enabled:
+            return original
+
+        timer = _StageTimer()
+        try:
+            image = Image.open(io.BytesIO(image_bytes))
+            # JPEGs can be decoded straight to grayscale at a fraction of their size, which avoids holding the
+            # full resolution color image in memory. This is a no-op for other formats.
+            image.draft("L", (self.max_edge, self.max_edge))
+            image.load()
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+            logger.warning("Could not decode %s image, sending it for OCR as is", mime_type)
+            return original
+        timer.lap("decode")
+
+        image = ImageOps.exif_transpose(image)
+        timer.lap("rotate")
+
+        image = image.convert("L")
+        timer.lap("grayscale")
+
+        image.thumbnail((self.max_edge, self.max_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        timer.lap("downscale")
+
+        box = _find_receipt_bounding_box(image)
+        if box is not None:
+            image = image.crop(box)
+        timer.lap("crop")
+
+        content = self._encode(image)
+        timer.lap("encode")
+
+        processed = PreprocessedImage(
+            content=content,
+            mime_type=_MIME_TYPES[self.image_format],
+            original_size=len(image_bytes),
+            stage_durations=timer.durations,
+        )
+        if processed.bytes_saved <= 0:
+            processed = original.model_copy(update={"stage_durations": timer.durations})
+
+        self._record(processed)
+        return processed
+
+    def preprocess_tiles(
+        self, image_bytes: bytes, mime_type: str, tile_aspect_ratio: float, overlap: float, max_tiles: int
+    ) -> list[PreprocessedImage]:
+        """
+        Preprocess a tall image of a bill into overlapping horizontal tiles, from top to bottom. The receipt is
+        cropped at full resolution, and each tile is downscaled on its own, so that its small text stays legible.
+
+        Images which can not be decoded, or are not taller than a tile, are preprocessed as a whole. Tiles are
+        preprocessed even if preprocessing is disabled, since they have to be cut out and encoded anyway.
+
+        :param image_bytes: The image bytes of the bill
+        :param mime_type: The MIME type of the image (e.g., "image/jpeg")
+        :param tile_aspect_ratio: Height of a tile relative to its width
+        :param overlap: Fraction of the height of a tile shared with the next one
+        :param max_tiles: Most tiles to split the image into
+        :return: The images to send for OCR, one per tile
+        """
+        timer = _StageTimer()
+        try:
+            image = Image.open(io.BytesIO(image_bytes))
+            image.draft("L", (self.max_edge * max_tiles, self.max_edge * max_tiles))
+            image.load()
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+            return [self.preprocess(image_bytes, mime_type)]
+        timer.lap("decode")
+
+        image = ImageOps.exif_transpose(image).convert("L")
+        timer.lap("grayscale")
+
+        box = _find_receipt_bounding_box(image)
+        if box is not None:
+            image = image.crop(box)
+        timer.lap("crop")
+
+        boxes = tile_boxes(image.width, image.height, tile_aspect_ratio, overlap, max_tiles)
+        if len(boxes) == 1:
+            return [self.preprocess(image_bytes, mime_type)]
+
+        tiles = []
+        for tile_box in boxes:
+            tile = image.crop(tile_box)
+            tile.thumbnail((self.max_edge, self.max_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            tiles.append(
+                PreprocessedImage(
+                    content=self._encode(tile),
+                    mime_type=_MIME_TYPES[self.image_format],
+                    # Share the original size between the tiles, so that the stats add up
+                    original_size=len(image_bytes) // len(boxes),
+                )
+            )
+        timer.lap("tile")
+
+        tiles[0].stage_durations = timer.durations
+        for tile in tiles:
+            self._record(tile)
+        return tiles
+
+    def _encode(self, image: Image.Image) -> bytes:
+        buffer = io.BytesIO()
+        image.save(buffer, format=self.image_format, quality=self.quality, optimize=True)
+        return buffer.getvalue()
+
+    def _record(self, image: PreprocessedImage) -> None:
+        logger.info(
+            "Preprocessed bill image from %d to %d bytes in %s",
+            image.original_size,
+            len(image.content),
+            ", ".join(f"{stage}={duration * 1000:.1f}ms" for stage, duration in image.stage_durations.items()),
+        )
+
+        with self._lock:
+            self._stats.images += 1
+            self._stats.original_bytes += image.original_size
+            self._stats.processed_bytes += len(image.content)
+            for stage, duration in image.stage_durations.items():
+                self._stats.stage_seconds[stage] = self._stats.stage_seconds.get(stage, 0.0) + duration
+
+    def stats(self) -> ImagePreprocessingStats:
+        with self._lock:
+            return self._stats.model_copy(deep=True)
+
+
+image_preprocessor = ImagePreprocessor(
+    max_edge=settings.OCR_IMAGE_MAX_EDGE,
+    image_format=settings.OCR_IMAGE_FORMAT,
+    quality=settings.OCR_IMAGE_QUALITY,
+    enabled=settings.OCR_PREPROCESS_ENABLED,
+)
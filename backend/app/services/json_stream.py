@@ -0,0 +1,99 @@
+"""
+Incremental parsing of a JSON object streamed by an LLM, token by token.
+"""
+
+import json
+
+
+class IncrementalArrayParser:
+    """
+    Picks the elements of an array of objects out of a JSON object while it is still being streamed, e.g. the items
+    of a bill, so that each one can be used as soon as it is complete.
+
+    Each call only scans the characters fed since the previous one. Anything around the JSON object, like the
+    markdown fences some models wrap it in, is ignored.
+    """
+
+    def __init__(self, key: str):
+        """
+        :param key: Key of the array in the top level object
+        """
+        self.key = key
+
+        self._text = ""
+        self._position = 0
+
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._last_string: str | None = None
+
+        self._document_start: int | None = None
+        self._document_end: int | None = None
+        self._array_depth: int | None = None
+        self._element_start: int | None = None
+
+    def feed(self, chunk: str) -> list[dict]:
+        """
+        Parse the next chunk of the response.
+
+        :param chunk: Text streamed since the last call
+        :return: The elements of the array completed in this chunk
+        """
+        self._text += chunk
+        elements = []
+
+        text = self._text
+        for position in range(self._position, len(text)):
+            char = text[position]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = text[self._string_start + 1 : position]
+                continue
+
+            if self._document_start is None:
+                if char == "{":
+                    self._document_start = position
+                    self._depth = 1
+                continue
+            if self._document_end is not None:
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = position
+            elif char in "{[":
+                self._depth += 1
+                if char == "[" and self._depth == 2 and self._last_string == self.key:
+                    self._array_depth = 2
+                elif char == "{" and self._array_depth is not None and self._depth == self._array_depth + 1:
+                    self._element_start = position
+            elif char in "}]":
+                self._depth -= 1
+                if char == "}" and self._element_start is not None and self._depth == self._array_depth:
+                    elements.append(json.loads(text[self._element_start : position + 1]))
+                    self._element_start = None
+                elif char == "]" and self._depth == 1:
+                    self._array_depth = None
+                elif self._depth == 0:
+                    self._document_end = position + 1
+
+        self._position = len(text)
+        return elements
+
+    @property
+    def document(self) -> str:
+        """
+        The JSON object streamed so far, without anything around it.
+        """
+        if self._document_start is None:
+            return self._text
+        return self._text[self._document_start : self._document_end]
@@ -0,0 +1,137 @@
+"""
+Incremental ledger of an outing, for outings edited one bill at a time.
+
+The ledger keeps the net balance of each person, and what each bill contributes to them, computed with the same math
+as `calculate_balance`. Adding, editing or removing a bill only applies the difference it makes, in time proportional
+to the items of that bill rather than of the whole outing. The settlement is only computed again once the balances
+have changed.
+"""
+
+from collections import defaultdict
+
+from app.schemas.bill import Bill, Outing, OutingSplit
+from app.services.bill import (
+    OutingPaymentBalance,
+    add_bill_balances,
+    payment_balance,
+    settle_balances,
+)
+from app.services.settlement import SettlementStrategy
+
+
+def bill_contribution(bill: Bill) -> dict[str, int]:
+    """
+    What each person paid minus what they consumed in a bill, in cents.
+    """
+    contribution: defaultdict[str, int] = defaultdict(int)
+    add_bill_balances(contribution, bill)
+    return dict(contribution)
+
+
+def update_balances(
+    balances: dict[str, int], appearances: dict[str, int], added: dict[str, int], removed: dict[str, int]
+) -> bool:
+    """
+    Apply the contribution of a bill being added and/or of one being removed to the balances of an outing.
+
+    :param balances: Balance of each person, in cents, updated in place
+    :param appearances: Number of bills each person appears in, updated in place, people being forgotten along with
+        their last bill
+    :param added: Contribution of the bill added, if any
+    :param removed: Contribution of the bill removed, if any
+    :return: Whether the balances changed, i.e. whether the settlement must be computed again
+    """
+    changed = False
+    changes: defaultdict[str, int] = defaultdict(int)
+    for person, amount in added.items():
+        appearances[person] = appearances.get(person, 0) + 1
+        balances.setdefault(person, 0)
+        changes[person] += amount
+    for person, amount in removed.items():
+        changes[person] -= amount
+
+    for person, change in changes.items():
+        if change:
+            balances[person] += change
+            changed = True
+
+    for person in removed:
+        appearances[person] -= 1
+        if appearances[person] == 0:
+            del appearances[person]
+            del balances[person]
+            changed = True
+    return changed
+
+
+class OutingLedger:
+    """
+    Net balances of the people of an outing, kept up to date as its bills change.
+    """
+
+    def __init__(self):
+        self._contributions: dict[int, dict[str, int]] = {}
+        self._balances: dict[str, int] = {}
+        self._appearances: dict[str, int] = {}
+        self._next_bill_id = 0
+        self._splits: dict[SettlementStrategy, OutingSplit] = {}
+
+    @classmethod
+    def from_outing(cls, outing: Outing) -> "OutingLedger":
+        ledger = cls()
+        for bill in outing.bills:
+            ledger.add_bill(bill)
+        return ledger
+
+    @property
+    def bill_ids(self) -> list[int]:
+        return list(self._contributions)
+
+    @property
+    def net_balances(self) -> dict[str, int]:
+        """
+        The balance of each person, in cents, paid minus consumed.
+        """
+        return dict(self._balances)
+
+    def add_bill(self, bill: Bill) -> int:
+        """
+        :return: The id of the bill in the ledger, to edit or remove it
+        """
+        bill_id = self._next_bill_id
+        self._next_bill_id += 1
+        self._contributions[bill_id] = contribution = bill_contribution(bill)
+        self._update(contribution, {})
+        return bill_id
+
+    def replace_bill(self, bill_id: int, bill: Bill) -> None:
+        """
+        :raises KeyError: If there is no bill with this id
+        """
+        previous = self._contributions[bill_id]
+        self._contributions[bill_id] = contribution = bill_contribution(bill)
+        self._update(contribution, previous)
+
+    def remove_bill(self, bill_id: int) -> None:
+        """
+        :raises KeyError: If there is no bill with this id
+        """
+        self._update({}, self._contributions.pop(bill_id))
+
+    def _update(self, added: dict[str, int], removed: dict[str, int]) -> None:
+        if update_balances(self._balances, self._appearances, added, removed):
+            self._splits.clear()
+
+    def balance(self) -> OutingPaymentBalance:
+        """
+        How much each person owes / is owed, in cents, like `calculate_balance` on the bills of the ledger.
+        """
+        return payment_balance(self._balances)
+
+    def split(self, strategy: SettlementStrategy = "greedy") -> OutingSplit:
+        """
+        The transactions settling all debts, computed again only if the balances changed since the last time.
+        """
+        if strategy not in self._splits:
+            self._splits[strategy] = settle_balances(list(self._balances), list(self._balances.values()), strategy)
+        return self._splits[strategy]
@@ -5,12 +5,57 @@ This service provides a unified interface to multiple LLM providers (OpenAI, Ant
 using LiteLLM. It supports custom proxy endpoints via LITELLM_API_BASE.
 """
 
+import asyncio
 import base64
+import logging
+import threading
+import time
+from collections.abc import AsyncIterator
 
-from litellm import completion
+import httpx
+import litellm
+from litellm import acompletion, completion
 
 from app.core.settings import settings
 from app.schemas.bill import OCRBill
+from app.services.circuit_breaker import CircuitBreaker, RetryBudget, backoff_delay
+from app.services.hedging import Hedger
+from app.services.llm_http_client import llm_http_client
+from app.services.llm_usage import llm_usage_tracker, token_budget
+from app.services.stage_timing import stage_timing
+from app.services.tiling import validate_tile_items
+
+# Multiple of 3, so that base64 encoded chunks can be concatenated without padding in between
+_BASE64_CHUNK_SIZE = 3 * 256 * 1024
+
+# Bump whenever BILL_OCR_PROMPT changes, so that cached OCR results of the old prompt are not reused
+BILL_OCR_PROMPT_VERSION = "1"
+
+logger = logging.getLogger(__name__)
+
+# Errors showing that the provider is degraded, which are retried and count against its circuit breaker
+_TRANSIENT_ERRORS = (
+    litellm.Timeout,
+    litellm.APIConnectionError,
+    litellm.RateLimitError,
+    litellm.InternalServerError,
+    litellm.BadGatewayError,
+    litellm.ServiceUnavailableError,
+    httpx.TransportError,
+)
+
+# One circuit breaker per provider, by API base, so that a degraded hedge provider does not cut off the primary one
+circuit_breakers: dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+retry_budget = RetryBudget(ratio=settings.LLM_RETRY_BUDGET_RATIO, max_tokens=settings.LLM_RETRY_BUDGET_MAX_TOKENS)
+
+# Races the primary model against LITELLM_HEDGE_MODEL, when the primary one is slow
+ocr_hedger = Hedger(
+    delay_seconds=settings.LITELLM_HEDGE_DELAY_SECONDS,
+    delay_percentile=settings.LITELLM_HEDGE_DELAY_PERCENTILE,
+    enabled=settings.LITELLM_HEDGE_MODEL is not None,
+)
 
 BILL_OCR_PROMPT = """
 You are an expert at extracting information from bills and receipts.
@@ -35,23 +80,32 @@ Please analyze the bill image and extract the information now.
 """
 
 
-def get_bill_details_from_image(image_bytes: bytes, mime_type: str) -> str:
+def _encode_image_data_url(image_bytes: bytes, mime_type: str) -> str:
     """
-    Use LiteLLM to extract bill details from an image.
+    Encode an image to a base64 data URL.
 
-    Supports multiple LLM providers via a unified interface. Can be configured
-    to use a custom proxy endpoint via LITELLM_API_BASE.
-
-    :param image_bytes: The image bytes of the bill
-    :param mime_type: The MIME type of the image (e.g., "image/jpeg")
-    :return: Extracted bill details as a JSON string
+    The image is encoded chunk by chunk into a buffer of the final size, so only the buffer and the returned
+    string are ever allocated at full size, instead of the encoded bytes, their decoded string and the URL.
     """
-    # Encode image to base64 data URL
-    base64_image = base64.b64encode(image_bytes).decode("utf-8")
-    image_url = f"data:{mime_type};base64,{base64_image}"
+    prefix = f"data:{mime_type};base64,".encode()
+    buffer = bytearray(len(prefix) + 4 * ((len(image_bytes) + 2) // 3))
+    buffer[: len(prefix)] = prefix
+
+    offset = len(prefix)
+    image_view = memoryview(image_bytes)
+    for start in range(0, len(image_view), _BASE64_CHUNK_SIZE):
+        encoded_chunk = base64.b64encode(image_view[start : start + _BASE64_CHUNK_SIZE])
+        buffer[offset : offset + len(encoded_chunk)] = encoded_chunk
+        offset += len(encoded_chunk)
+
+    return buffer.decode("ascii")
+
+
+def _build_messages(image_bytes: bytes, mime_type: str) -> list[dict]:
+    image_url = _encode_image_data_url(image_bytes, mime_type)
 
     # Build message with vision content
-    messages = [
+    return [
         {
             "role": "user",
             "content": [
@@ -64,17 +118,133 @@ def get_bill_details_from_image(image_bytes: bytes, mime_type: str) -> str:
         }
     ]
 
-    # Build completion kwargs
-    kwargs: dict = {
-        "model": settings.LITELLM_MODEL,
+
+def _build_completion_kwargs(messages: list[dict], is_async: bool, model: str, api_base: str, api_key: str) -> dict:
+    return {
+        "model": model,
         "messages": messages,
         "response_format": OCRBill,
-        "api_base": settings.LITELLM_API_BASE,
-        "api_key": settings.LITELLM_API_KEY,
+        "api_base": api_base,
+        "api_key": api_key,
+        **llm_http_client.completion_kwargs(model, is_async),
     }
 
-    response = completion(**kwargs)
 
+def _build_primary_completion_kwargs(messages: list[dict], is_async: bool) -> dict:
+    # Calls are rejected, or made with a cheaper model, once the token budget of the day is spent
+    model = token_budget.select_model(settings.LITELLM_MODEL)
+    return _build_completion_kwargs(messages, is_async, model, settings.LITELLM_API_BASE, settings.LITELLM_API_KEY)
+
+
+async def _abuild_primary_completion_kwargs(messages: list[dict]) -> dict:
+    model = await token_budget.aselect_model(settings.LITELLM_MODEL)
+    return _build_completion_kwargs(messages, True, model, settings.LITELLM_API_BASE, settings.LITELLM_API_KEY)
+
+
+def get_circuit_breaker(api_base: str) -> CircuitBreaker:
+    with _circuit_breakers_lock:
+        if api_base not in circuit_breakers:
+            circuit_breakers[api_base] = CircuitBreaker(
+                name="The LLM provider",
+                window=settings.LLM_CIRCUIT_BREAKER_WINDOW,
+                min_calls=settings.LLM_CIRCUIT_BREAKER_MIN_CALLS,
+                failure_rate_threshold=settings.LLM_CIRCUIT_BREAKER_FAILURE_RATE,
+                slow_call_seconds=settings.LLM_CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+                slow_call_rate_threshold=settings.LLM_CIRCUIT_BREAKER_SLOW_CALL_RATE,
+                open_seconds=settings.LLM_CIRCUIT_BREAKER_OPEN_SECONDS,
+                half_open_calls=settings.LLM_CIRCUIT_BREAKER_HALF_OPEN_CALLS,
+                enabled=settings.LLM_CIRCUIT_BREAKER_ENABLED,
+            )
+        return circuit_breakers[api_base]
+
+
+def _should_retry(attempt: int, error: Exception) -> bool:
+    if attempt >= settings.LLM_MAX_RETRIES or not retry_budget.withdraw():
+        return False
+    logger.warning("Retrying LLM call after transient error (attempt %d): %r", attempt + 1, error)
+    return True
+
+
+def _call_provider(kwargs: dict, **extra_kwargs):
+    """
+    Call the provider through its circuit breaker, and retry transient errors within the retry budget.
+
+    :raises CircuitOpenError: If the provider is considered unavailable
+    """
+    circuit_breaker = get_circuit_breaker(kwargs["api_base"])
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        circuit_breaker.before_call()
+        start = time.perf_counter()
+        try:
+            response = completion(**kwargs, **extra_kwargs)
+        except _TRANSIENT_ERRORS as e:
+            circuit_breaker.record(failed=True, latency_seconds=time.perf_counter() - start)
+            if not _should_retry(attempt, e):
+                raise
+            time.sleep(
+                backoff_delay(attempt, settings.LLM_RETRY_BACKOFF_SECONDS, settings.LLM_RETRY_MAX_BACKOFF_SECONDS)
+            )
+            attempt += 1
+            continue
+        except BaseException:
+            # Any other error is the answer of a provider which works, e.g. a bad request
+            circuit_breaker.record(failed=False, latency_seconds=time.perf_counter() - start)
+            raise
+        circuit_breaker.record(failed=False, latency_seconds=time.perf_counter() - start)
+        return response
+
+
+async def _acall_provider(kwargs: dict, **extra_kwargs):
+    """
+    Async version of `_call_provider`.
+    """
+    circuit_breaker = get_circuit_breaker(kwargs["api_base"])
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        circuit_breaker.before_call()
+        start = time.perf_counter()
+        try:
+            response = await acompletion(**kwargs, **extra_kwargs)
+        except _TRANSIENT_ERRORS as e:
+            circuit_breaker.record(failed=True, latency_seconds=time.perf_counter() - start)
+            if not _should_retry(attempt, e):
+                raise
+            await asyncio.sleep(
+                backoff_delay(attempt, settings.LLM_RETRY_BACKOFF_SECONDS, settings.LLM_RETRY_MAX_BACKOFF_SECONDS)
+            )
+            attempt += 1
+            continue
+        except asyncio.CancelledError:
+            # e.g. the loser of a hedged request, which says nothing about the provider
+            circuit_breaker.release()
+            raise
+        except BaseException:
+            circuit_breaker.record(failed=False, latency_seconds=time.perf_counter() - start)
+            raise
+        circuit_breaker.record(failed=False, latency_seconds=time.perf_counter() - start)
+        return response
+
+
+@stage_timing.timed("llm")
+def _complete(kwargs: dict, image_bytes: int):
+    start = time.perf_counter()
+    response = _call_provider(kwargs)
+    llm_usage_tracker.record(kwargs["model"], response, image_bytes, time.perf_counter() - start)
+    return response
+
+
+@stage_timing.timed("llm")
+async def _acomplete(kwargs: dict, image_bytes: int):
+    start = time.perf_counter()
+    response = await _acall_provider(kwargs)
+    await llm_usage_tracker.arecord(kwargs["model"], response, image_bytes, time.perf_counter() - start)
+    return response
+
+
+def _get_response_content(response) -> str:
     if not response.choices or len(response.choices) == 0:
         raise ValueError("No response from LiteLLM")
 
@@ -83,3 +253,84 @@ def get_bill_details_from_image(image_bytes: bytes, mime_type: str) -> str:
         raise ValueError("No content in LiteLLM response")
 
     return content
+
+
+def get_bill_details_from_image(image_bytes: bytes, mime_type: str) -> str:
+    """
+    Use LiteLLM to extract bill details from an image.
+
+    Supports multiple LLM providers via a unified interface. Can be configured
+    to use a custom proxy endpoint via LITELLM_API_BASE.
+
+    :param image_bytes: The image bytes of the bill
+    :param mime_type: The MIME type of the image (e.g., "image/jpeg")
+    :return: Extracted bill details as a JSON string
+    """
+    kwargs = _build_primary_completion_kwargs(_build_messages(image_bytes, mime_type), is_async=False)
+    return _get_response_content(_complete(kwargs, len(image_bytes)))
+
+
+async def aget_bill_details_from_image(image_bytes: bytes, mime_type: str, items_only: bool = False) -> str:
+    """
+    Async version of `get_bill_details_from_image`, which does not block the event loop while waiting for the LLM.
+
+    If LITELLM_HEDGE_MODEL is set, the request is also sent to that model when the primary one is slow to answer,
+    and the first answer which is a valid bill is returned.
+
+    :param image_bytes: The image bytes of the bill
+    :param mime_type: The MIME type of the image (e.g., "image/jpeg")
+    :param items_only: Whether only the items of the answer are used, e.g. for a tile above the last one of a receipt,
+        whose totals the receipt does not show there, so that only they need to be valid to win the race
+    :return: Extracted bill details as a JSON string
+    """
+    messages = _build_messages(image_bytes, mime_type)
+    if settings.LITELLM_HEDGE_MODEL is None:
+        response = await _acomplete(await _abuild_primary_completion_kwargs(messages), len(image_bytes))
+        return _get_response_content(response)
+
+    async def complete(kwargs: dict) -> str:
+        content = _get_response_content(await _acomplete(kwargs, len(image_bytes)))
+        # An answer only wins the race if it is a valid bill
+        with stage_timing.stage("ocr_validation"):
+            if items_only:
+                validate_tile_items(content)
+            else:
+                OCRBill.model_validate_json(content)
+        return content
+
+    primary_kwargs = await _abuild_primary_completion_kwargs(messages)
+    hedge_kwargs = _build_completion_kwargs(
+        messages,
+        is_async=True,
+        model=settings.LITELLM_HEDGE_MODEL,
+        api_base=settings.LITELLM_HEDGE_API_BASE or settings.LITELLM_API_BASE,
+        api_key=settings.LITELLM_HEDGE_API_KEY or settings.LITELLM_API_KEY,
+    )
+    return await ocr_hedger.run(
+        lambda: complete(primary_kwargs),
+        lambda: complete(hedge_kwargs),
+    )
+
+
+async def astream_bill_details_from_image(image_bytes: bytes, mime_type: str) -> AsyncIterator[str]:
+    """
+    Streaming version of `aget_bill_details_from_image`, which yields the response as the LLM generates it.
+
+    Requests are not hedged, since the first tokens of the primary model are already streamed to the client. Only
+    errors before the stream starts are retried, and count against the circuit breaker.
+
+    :param image_bytes: The image bytes of the bill
+    :param mime_type: The MIME type of the image (e.g., "image/jpeg")
+    :return: Chunks of the extracted bill details, which concatenate to a JSON string
+    """
+    messages = _build_messages(image_bytes, mime_type)
+    kwargs = await _abuild_primary_completion_kwargs(messages)
+    start = time.perf_counter()
+    # The usage of a streamed call is only reported with its last chunk, if requested
+    response = await _acall_provider(kwargs, stream=True, stream_options={"include_usage": True})
+    last_chunk = None
+    async for chunk in response:
+        last_chunk = chunk
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+    await llm_usage_tracker.arecord(kwargs["model"], last_chunk, len(image_bytes), time.perf_counter() - start)
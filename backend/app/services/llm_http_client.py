@@ -0,0 +1,250 @@
+"""
+Pooled HTTP client shared by every call to the LLM provider.
+
+Without it, LiteLLM may open a fresh TLS connection to LITELLM_API_BASE for each receipt. One client per process,
+created in the app lifespan, keeps connections alive between calls (and multiplexes them over HTTP/2 where the
+provider supports it), and reports how well the pool is reused.
+"""
+
+import threading
+from importlib.util import find_spec
+from typing import Any
+
+import httpx
+import litellm
+from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler, HTTPHandler
+
+from app.core.settings import settings
+from app.schemas.metrics import LLMHTTPPoolStats
+
+# Providers whose LiteLLM integration builds an OpenAI SDK client, which picks up the shared sessions set on the
+# litellm module. All the others accept an HTTP handler per call instead.
+_OPENAI_SDK_PROVIDERS = {"openai", "azure", "text-completion-openai", *litellm.openai_compatible_providers}
+
+
+class _PooledAsyncHTTPHandler(AsyncHTTPHandler):
+    """
+    LiteLLM async handler which sends requests through an existing client, instead of creating its own.
+    """
+
+    def __init__(self, client: httpx.AsyncClient):
+        self._pooled_client = client
+        super().__init__(timeout=client.timeout)
+
+    def create_client(self, *args, **kwargs) -> httpx.AsyncClient:
+        return self._pooled_client
+
+
+class _RequestTrace:
+    """
+    Follows a single request through the connection pool, using httpcore trace events.
+    """
+
+    def __init__(self, stats: "_PoolCounters"):
+        self._stats = stats
+        self._waiting = True
+        self._connected = False
+        stats.add(requests=1, waiting=1)
+
+    def _on_event(self, event_name: str) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            self._connected = True
+            self._stats.add(connections_opened=1)
+        elif event_name.endswith(".send_request_headers.started") and self._waiting:
+            self._waiting = False
+            self._stats.add(waiting=-1)
+
+    def trace(self, event_name: str, info: dict) -> None:
+        self._on_event(event_name)
+
+    async def atrace(self, event_name: str, info: dict) -> None:
+        self._on_event(event_name)
+
+    def done(self) -> None:
+        if self._waiting:
+            self._waiting = False
+            self._stats.add(waiting=-1)
+        if not self._connected:
+            self._stats.add(connections_reused=1)
+
+
+class _PoolCounters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.waiting = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def add(self, **increments: int) -> None:
+        with self._lock:
+            for name, increment in increments.items():
+                setattr(self, name, getattr(self, name) + increment)
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "requests_waiting": self.waiting,
+                "connections_opened": self.connections_opened,
+                "connections_reused": self.connections_reused,
+            }
+
+
+class _TracedAsyncTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncHTTPTransport, counters: _PoolCounters):
+        self.transport = transport
+        self._counters = counters
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        trace = _RequestTrace(self._counters)
+        request.extensions = {**request.extensions, "trace": trace.atrace}
+        try:
+            return await self.transport.handle_async_request(request)
+        finally:
+            trace.done()
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class _TracedTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.HTTPTransport, counters: _PoolCounters):
+        self.transport = transport
+        self._counters = counters
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        trace = _RequestTrace(self._counters)
+        request.extensions = {**request.extensions, "trace": trace.trace}
+        try:
+            return self.transport.handle_request(request)
+        finally:
+            trace.done()
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class LLMHTTPClient:
+    """
+    A sync and an async `httpx` client with bounded, keep-alive connection pools, plugged into LiteLLM.
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        timeout: float,
+        http2: bool = True,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout)
+        # HTTP/2 needs the optional h2 package; connections fall back to HTTP/1.1 if the server does not support it
+        self.http2 = http2 and find_spec("h2") is not None
+
+        self._counters = _PoolCounters()
+        self._client: httpx.Client | None = None
+        self._async_client: httpx.AsyncClient | None = None
+        self._handler: HTTPHandler | None = None
+        self._async_handler: AsyncHTTPHandler | None = None
+
+    @property
+    def started(self) -> bool:
+        return self._async_client is not None
+
+    def start(self) -> None:
+        """
+        Create the clients, and make LiteLLM send its requests through them.
+        """
+        if self.started:
+            return
+
+        transport = httpx.HTTPTransport(limits=self.limits, http2=self.http2)
+        async_transport = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+        self._client = httpx.Client(
+            transport=_TracedTransport(transport, self._counters), timeout=self.timeout, follow_redirects=True
+        )
+        self._async_client = httpx.AsyncClient(
+            transport=_TracedAsyncTransport(async_transport, self._counters),
+            timeout=self.timeout,
+            follow_redirects=True,
+        )
+        self._handler = HTTPHandler(timeout=self.timeout, client=self._client)
+        self._async_handler = _PooledAsyncHTTPHandler(self._async_client)
+
+        litellm.client_session = self._client
+        litellm.aclient_session = self._async_client
+
+    async def stop(self) -> None:
+        """
+        Close every pooled connection, and let LiteLLM manage its own connections again.
+        """
+        if self._client is not None:
+            self._client.close()
+        if self._async_client is not None:
+            await self._async_client.aclose()
+
+        if litellm.client_session is self._client:
+            litellm.client_session = None
+        if litellm.aclient_session is self._async_client:
+            litellm.aclient_session = None
+
+        self._client = self._async_client = None
+        self._handler = self._async_handler = None
+
+    def completion_kwargs(self, model: str, is_async: bool) -> dict[str, Any]:
+        """
+        Extra arguments for a LiteLLM completion call, to send it through the pool.
+
+        Providers built on the OpenAI SDK already use the pool through the sessions set on the litellm module, and
+        must not be given a handler. Nothing is added before the client is started, e.g. outside of the app.
+
+        :param model: The model the completion is requested from
+        :param is_async: Whether the call is made with `acompletion`
+        :return: Keyword arguments to pass on to LiteLLM
+        """
+        handler = self._async_handler if is_async else self._handler
+        if handler is None:
+            return {}
+
+        try:
+            _, provider, _, _ = litellm.get_llm_provider(model)
+        except litellm.BadRequestError:
+            return {}
+        if provider in _OPENAI_SDK_PROVIDERS:
+            return {}
+        return {"client": handler}
+
+    def _pool_connections(self) -> list:
+        # The pools are only reachable through the transports, and are reported on a best effort basis
+        connections = []
+        for client in (self._client, self._async_client):
+            transport = getattr(client, "_transport", None)
+            pool = getattr(getattr(transport, "transport", None), "_pool", None)
+            connections.extend(getattr(pool, "connections", []))
+        return connections
+
+    def stats(self) -> LLMHTTPPoolStats:
+        connections = [connection for connection in self._pool_connections() if not connection.is_closed()]
+        return LLMHTTPPoolStats(
+            started=self.started,
+            http2=self.http2,
+            max_connections=self.limits.max_connections or 0,
+            connections_open=len(connections),
+            connections_idle=sum(connection.is_idle() for connection in connections),
+            **self._counters.snapshot(),
+        )
+
+
+llm_http_client = LLMHTTPClient(
+    max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    timeout=settings.LLM_HTTP_TIMEOUT_SECONDS,
+    http2=settings.LLM_HTTP2_ENABLED,
+)
@@ -0,0 +1,332 @@
+"""
+Accounting of every call to the LLM provider, with daily token budgets.
+
+Each call records its model, prompt and completion tokens, the image bytes sent, its latency and its estimated cost.
+Calls are aggregated into counters per model, and the calls made while serving a request are collected, so that
+they can be reported in its response headers.
+
+Token budgets are enforced per day (UTC), for all clients together and for each client. Usage is kept in a SQLite
+database in DATA_DIR, so that the budgets hold across all the worker processes. Once a budget is exceeded, calls are
+either rejected or downgraded to a cheaper model.
+"""
+
+import asyncio
+import datetime
+import logging
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Literal
+
+import litellm
+from pydantic import BaseModel
+
+from app.core.settings import settings
+from app.core.sqlite import SQLiteDatabase
+from app.schemas.metrics import LLMModelUsage, LLMUsageStats, TokenBudgetStats
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS token_usage (
+    day TEXT NOT NULL,
+    client TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    PRIMARY KEY (day, client)
+);
+"""
+
+# Client under which the usage of all clients together is recorded
+_ALL_CLIENTS = ""
+
+_client_id: ContextVar[str | None] = ContextVar("llm_usage_client_id", default=None)
+_request_calls: ContextVar[list["LLMCall"] | None] = ContextVar("llm_usage_request_calls", default=None)
+
+
+class LLMCall(BaseModel):
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    image_bytes: int = 0
+    latency_seconds: float
+    cost_usd: float | None = None  # None if LiteLLM does not know the price of the model
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+class TokenBudgetExceededError(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@contextmanager
+def track_request(client_id: str | None) -> Iterator[list[LLMCall]]:
+    """
+    Attribute the LLM calls made inside the block to a client, and collect them.
+
+    Tasks and threads started inside the block inherit it, so calls made there are collected as well.
+
+    :param client_id: Identifies the client the calls are made for, for its token budget
+    :return: The LLM calls made so far inside the block
+    """
+    calls: list[LLMCall] = []
+    client_token = _client_id.set(client_id)
+    calls_token = _request_calls.set(calls)
+    try:
+        yield calls
+    finally:
+        _request_calls.reset(calls_token)
+        _client_id.reset(client_token)
+
+
+def usage_headers(calls: list[LLMCall]) -> dict[str, str]:
+    """
+    Summarize the LLM calls made for a request as response headers.
+    """
+    headers = {
+        "X-LLM-Calls": str(len(calls)),
+        "X-LLM-Prompt-Tokens": str(sum(call.prompt_tokens for call in calls)),
+        "X-LLM-Completion-Tokens": str(sum(call.completion_tokens for call in calls)),
+        "X-LLM-Latency-Ms": str(round(sum(call.latency_seconds for call in calls) * 1000)),
+    }
+    costs = [call.cost_usd for call in calls if call.cost_usd is not None]
+    if costs and len(costs) == len(calls):
+        headers["X-LLM-Cost-USD"] = f"{sum(costs):.6f}"
+    return headers
+
+
+def _today() -> str:
+    return datetime.datetime.now(datetime.UTC).date().isoformat()
+
+
+def _seconds_until_tomorrow() -> int:
+    now = datetime.datetime.now(datetime.UTC)
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), datetime.UTC)
+    return int((tomorrow - now).total_seconds()) + 1
+
+
+class TokenBudget:
+    """
+    Daily token budgets for all clients together, and for each client.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        daily_tokens: int | None,
+        client_daily_tokens: int | None,
+        exceeded_action: Literal["reject", "downgrade"],
+        downgrade_model: str | None = None,
+    ):
+        self.daily_tokens = daily_tokens
+        self.client_daily_tokens = client_daily_tokens
+        self.exceeded_action = exceeded_action
+        self.downgrade_model = downgrade_model
+
+        self._database = SQLiteDatabase(path, _SCHEMA)
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.downgraded = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.daily_tokens is not None or self.client_daily_tokens is not None
+
+    def _used_tokens(self, client_id: str | None) -> tuple[int, int]:
+        clients = [_ALL_CLIENTS] if client_id is None else [_ALL_CLIENTS, client_id]
+        with self._database.connect() as connection:
+            rows = connection.execute(
+                f"SELECT client, tokens FROM token_usage WHERE day = ? AND client IN ({', '.join('?' * len(clients))})",
+                (_today(), *clients),
+            ).fetchall()
+        used = dict(rows)
+        return used.get(_ALL_CLIENTS, 0), used.get(client_id, 0)
+
+    def select_model(self, model: str) -> str:
+        """
+        Check the budgets of the current client before a call, which is made with the returned model.
+
+        :param model: The model the call would be made with, within budget
+        :return: The model to make the call with
+        :raises TokenBudgetExceededError: If a budget is exceeded, and calls are not downgraded
+        """
+        if not self.enabled:
+            return model
+
+        client_id = _client_id.get()
+        used, client_used = self._used_tokens(client_id)
+        if self.daily_tokens is not None and used >= self.daily_tokens:
+            exceeded = "Daily token budget exceeded."
+        elif self.client_daily_tokens is not None and client_id is not None and client_used >= self.client_daily_tokens:
+            exceeded = "Daily token budget of this client exceeded."
+        else:
+            return model
+
+        if self.exceeded_action == "downgrade" and self.downgrade_model is not None:
+            with self._lock:
+                self.downgraded += 1
+            logger.info("%s Downgrading call from %s to %s", exceeded, model, self.downgrade_model)
+            return self.downgrade_model
+
+        with self._lock:
+            self.rejected += 1
+        raise TokenBudgetExceededError(exceeded, retry_after=_seconds_until_tomorrow())
+
+    async def aselect_model(self, model: str) -> str:
+        """
+        Async version of `select_model`, which reads the budgets in a worker thread, off the event loop.
+        """
+        if not self.enabled:
+            return model
+        return await asyncio.to_thread(self.select_model, model)
+
+    def add(self, client_id: str | None, tokens: int) -> None:
+        """
+        Count tokens used by a call against the budgets.
+        """
+        if not self.enabled or tokens == 0:
+            return
+
+        day = _today()
+        clients = [_ALL_CLIENTS] if client_id is None else [_ALL_CLIENTS, client_id]
+        with self._database.connect() as connection:
+            connection.executemany(
+                """
+                INSERT INTO token_usage (day, client, tokens) VALUES (?, ?, ?)
+                ON CONFLICT (day, client) DO UPDATE SET tokens = tokens + excluded.tokens
+                """,
+                [(day, client, tokens) for client in clients],
+            )
+            connection.execute("DELETE FROM token_usage WHERE day < ?", (day,))
+
+    def clear(self) -> None:
+        with self._database.connect() as connection:
+            connection.execute("DELETE FROM token_usage")
+        with self._lock:
+            self.rejected = self.downgraded = 0
+
+    def stats(self) -> TokenBudgetStats:
+        used = self._used_tokens(None)[0] if self.enabled else 0
+        with self._lock:
+            return TokenBudgetStats(
+                daily_tokens=self.daily_tokens,
+                client_daily_tokens=self.client_daily_tokens,
+                used_tokens_today=used,
+                rejected=self.rejected,
+                downgraded=self.downgraded,
+            )
+
+
+def _token_count(usage, name: str) -> int:
+    count = getattr(usage, name, None)
+    return count if isinstance(count, int) else 0
+
+
+class LLMUsageTracker:
+    """
+    Aggregates the LLM calls of this worker process, per model.
+    """
+
+    def __init__(self, budget: TokenBudget):
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._models: dict[str, LLMModelUsage] = {}
+
+    def record(self, model: str, response, image_bytes: int, latency_seconds: float) -> LLMCall:
+        """
+        Record a call from the LiteLLM response, or from the last chunk of a streamed response.
+
+        :param model: The model the call was made with
+        :param response: The response of the call, with its token usage if the provider reported it
+        :param image_bytes: Size of the image sent in the call
+        :param latency_seconds: How long the call took
+        :return: The recorded call
+        """
+        call = self._record(model, response, image_bytes, latency_seconds)
+        self.budget.add(_client_id.get(), call.total_tokens)
+        return call
+
+    async def arecord(self, model: str, response, image_bytes: int, latency_seconds: float) -> LLMCall:
+        """
+        Async version of `record`, which counts the tokens against the budgets in a worker thread, off the event loop.
+        """
+        call = self._record(model, response, image_bytes, latency_seconds)
+        if self.budget.enabled and call.total_tokens:
+            await asyncio.to_thread(self.budget.add, _client_id.get(), call.total_tokens)
+        return call
+
+    def _record(self, model: str, response, image_bytes: int, latency_seconds: float) -> LLMCall:
+        usage = getattr(response, "usage", None)
+        call = LLMCall(
+            model=model,
+            prompt_tokens=_token_count(usage, "prompt_tokens"),
+            completion_tokens=_token_count(usage, "completion_tokens"),
+            image_bytes=image_bytes,
+            latency_seconds=latency_seconds,
+        )
+        if call.total_tokens:
+            try:
+                prompt_cost, completion_cost = litellm.cost_per_token(
+                    model=model, prompt_tokens=call.prompt_tokens, completion_tokens=call.completion_tokens
+                )
+                call.cost_usd = prompt_cost + completion_cost
+            except Exception:
+                # The price of models unknown to LiteLLM, e.g. behind a custom proxy, can not be estimated
+                logger.debug("Could not estimate the cost of a call to %s", model, exc_info=True)
+                call.cost_usd = None
+
+        logger.info(
+            "LLM call to %s: %d prompt tokens, %d completion tokens, %d image bytes, %.3fs, cost %s",
+            model,
+            call.prompt_tokens,
+            call.completion_tokens,
+            image_bytes,
+            latency_seconds,
+            "unknown" if call.cost_usd is None else f"${call.cost_usd:.6f}",
+        )
+
+        with self._lock:
+            totals = self._models.setdefault(model, LLMModelUsage())
+            totals.calls += 1
+            totals.prompt_tokens += call.prompt_tokens
+            totals.completion_tokens += call.completion_tokens
+            totals.image_bytes += image_bytes
+            totals.latency_seconds += latency_seconds
+            if call.cost_usd is not None:
+                totals.cost_usd += call.cost_usd
+
+        request_calls = _request_calls.get()
+        if request_calls is not None:
+            request_calls.append(call)
+        return call
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+
+    def stats(self) -> LLMUsageStats:
+        """
+        Blocking, since the tokens used today by all worker processes are read from the database of the budgets.
+        """
+        budget = self.budget.stats()
+        with self._lock:
+            return LLMUsageStats(
+                models={model: usage.model_copy() for model, usage in self._models.items()},
+                budget=budget,
+            )
+
+
+token_budget = TokenBudget(
+    path=settings.DATA_DIR / "token_usage.sqlite3",
+    daily_tokens=settings.LLM_DAILY_TOKEN_BUDGET,
+    client_daily_tokens=settings.LLM_CLIENT_DAILY_TOKEN_BUDGET,
+    exceeded_action=settings.LLM_BUDGET_EXCEEDED_ACTION,
+    downgrade_model=settings.LLM_BUDGET_DOWNGRADE_MODEL,
+)
+
+llm_usage_tracker = LLMUsageTracker(token_budget)
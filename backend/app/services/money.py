@@ -0,0 +1,61 @@
+"""
+Integer minor units (cents) for the split calculation.
+
+Amounts are converted to cents once, when an outing comes in, and back to currency units once, in the `OutingSplit`.
+In between, all arithmetic is on integers, so balances sum to exactly zero and settled amounts can be compared
+exactly. Amounts which do not divide evenly are allocated with the largest remainder method, so that the parts always
+add up to the whole, and leftover cents go to the largest fractional parts, ties going to the first ones.
+"""
+
+from collections.abc import Sequence
+
+CENTS_PER_UNIT = 100
+
+
+def to_cents(amount: float) -> int:
+    """
+    Convert an amount in currency units to cents, rounding to the nearest cent.
+    """
+    return round(amount * CENTS_PER_UNIT)
+
+
+def from_cents(cents: int) -> float:
+    """
+    Convert an amount in cents to currency units.
+    """
+    return cents / CENTS_PER_UNIT
+
+
+def allocate(total: int, weights: Sequence[int]) -> list[int]:
+    """
+    Split an amount in proportion to weights, with the largest remainder method.
+
+    :param total: Amount to split, in cents
+    :param weights: Non-negative weight of each part, which are split equally if they are all zero
+    :return: The amount of each part, in cents, which add up to the total
+    """
+    weight_sum = sum(weights)
+    if weight_sum == 0:
+        return split_evenly(total, len(weights))
+
+    scaled = [total * weight for weight in weights]
+    parts = [amount // weight_sum for amount in scaled]
+    leftover = total - sum(parts)
+    if leftover:
+        # Stable sort, so that ties go to the first parts
+        remainders = [amount % weight_sum for amount in scaled]
+        for index in sorted(range(len(weights)), key=remainders.__getitem__, reverse=True)[:leftover]:
+            parts[index] += 1
+    return parts
+
+
+def split_evenly(total: int, count: int) -> list[int]:
+    """
+    Split an amount in equal parts, the leftover cents going to the first parts.
+
+    :param total: Amount to split, in cents
+    :param count: Number of parts
+    :return: The amount of each part, in cents, which add up to the total
+    """
+    part, leftover = divmod(total, count)
+    return [part + 1] * leftover + [part] * (count - leftover)
@@ -0,0 +1,168 @@
+"""
+Near-duplicate detection of receipts, to reuse OCR results of re-photographed receipts.
+
+The OCR cache only matches identical bytes, so a second photo of the same receipt, at a slightly different angle or
+JPEG quality, still costs an LLM call. A perceptual hash (dHash) of each extracted image is kept in an index, and a
+new upload whose hash differs from an indexed one by at most a few bits reuses its OCR result. Like the cache keys,
+the index is partitioned by prompt version, so that a result is only reused for an extraction with the same prompt,
+e.g. not a tiled extraction for an untiled one.
+
+The hash only sees the layout of a receipt, not its text: another receipt of the same shop, whose items and amounts
+differ, is within a bit or two of the first one and gets its bill. Near-duplicate detection is therefore off unless
+OCR_NEAR_DUPLICATE_ENABLED is set, for deployments where the same receipt is often uploaded again.
+
+Lookups use multi-index hashing: the hash is split into one more chunk than the number of bits allowed to differ, so
+any hash within that distance shares at least one chunk exactly with the query, and only the hashes filed under the
+query's chunks need to be compared.
+"""
+
+import io
+import threading
+from collections import OrderedDict
+from itertools import pairwise
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from app.core.settings import settings
+from app.schemas.metrics import NearDuplicateStats
+
+
+def dhash(image_bytes: bytes, hash_size: int) -> int | None:
+    """
+    Compute the difference hash of an image: whether each pixel is brighter than its right neighbour, on a tiny
+    grayscale thumbnail. This is CPU bound, so call it from a worker thread in async code.
+
+    :param image_bytes: The image bytes of the bill
+    :param hash_size: Side of the thumbnail, the hash has `hash_size ** 2` bits
+    :return: The hash, or None if the image can not be decoded, or is too big to be safely decoded
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # JPEGs are decoded at a fraction of their size, the hash only needs a few pixels
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        image = ImageOps.exif_transpose(image).convert("L")
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        return None
+
+    pixels = image.resize((hash_size + 1, hash_size), Image.Resampling.BOX).tobytes()
+
+    image_hash = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for column in range(hash_size):
+            image_hash = (image_hash << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+    return image_hash
+
+
+class NearDuplicateIndex:
+    """
+    Bounded LRU index from perceptual hashes of extracted images to the cache keys of their OCR results, by prompt
+    version.
+    """
+
+    def __init__(self, hash_size: int, max_distance: int, max_entries: int, enabled: bool = True):
+        self.hash_size = hash_size
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.enabled = enabled
+
+        bits = hash_size**2
+        if not 0 <= max_distance < bits:
+            raise ValueError(f"The maximum distance must be between 0 and {bits - 1}")
+
+        chunks = max_distance + 1
+        boundaries = [bits * chunk // chunks for chunk in range(chunks + 1)]
+        # Shift and mask of each chunk, from the least significant bits
+        self._chunks = [(start, (1 << (end - start)) - 1) for start, end in pairwise(boundaries)]
+
+        # Keyed by prompt version and hash, and the buckets by prompt version and chunk value
+        self._entries: OrderedDict[tuple[str, int], str] = OrderedDict()
+        self._buckets: list[dict[tuple[str, int], set[int]]] = [{} for _ in self._chunks]
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.hits = 0
+
+    def hash_image(self, image_bytes: bytes) -> int | None:
+        """
+        Compute the perceptual hash of an image, or None if near-duplicate detection is disabled.
+        """
+        if not self.enabled:
+            return None
+        return dhash(image_bytes, self.hash_size)
+
+    def _chunk_values(self, image_hash: int) -> list[int]:
+        return [(image_hash >> shift) & mask for shift, mask in self._chunks]
+
+    def find(self, image_hash: int, prompt_version: str) -> str | None:
+        """
+        Find the closest indexed image within the maximum distance, extracted with the same prompt.
+
+        :param image_hash: Hash of the image, from `hash_image`
+        :param prompt_version: The version of the prompt of the extraction, as in its cache key
+        :return: The cache key of the OCR result of the closest image, or None if there is none
+        """
+        with self._lock:
+            self.lookups += 1
+
+            best_hash, best_distance = None, self.max_distance + 1
+            for bucket, value in zip(self._buckets, self._chunk_values(image_hash)):
+                for candidate in bucket.get((prompt_version, value), ()):
+                    distance = (candidate ^ image_hash).bit_count()
+                    if distance < best_distance:
+                        best_hash, best_distance = candidate, distance
+
+            if best_hash is None:
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end((prompt_version, best_hash))
+            return self._entries[prompt_version, best_hash]
+
+    def add(self, image_hash: int, prompt_version: str, cache_key: str) -> None:
+        """
+        Index an extracted image, evicting the least recently used ones beyond the maximum number of entries.
+
+        :param image_hash: Hash of the image, from `hash_image`
+        :param prompt_version: The version of the prompt of the extraction, as in its cache key
+        :param cache_key: Cache key of the OCR result of the image
+        """
+        with self._lock:
+            entry = (prompt_version, image_hash)
+            if entry not in self._entries:
+                for bucket, value in zip(self._buckets, self._chunk_values(image_hash)):
+                    bucket.setdefault((prompt_version, value), set()).add(image_hash)
+            self._entries[entry] = cache_key
+            self._entries.move_to_end(entry)
+
+            while len(self._entries) > self.max_entries:
+                (evicted_version, evicted), _ = self._entries.popitem(last=False)
+                for bucket, value in zip(self._buckets, self._chunk_values(evicted)):
+                    key = (evicted_version, value)
+                    bucket[key].discard(evicted)
+                    if not bucket[key]:
+                        del bucket[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            for bucket in self._buckets:
+                bucket.clear()
+            self.lookups = self.hits = 0
+
+    def stats(self) -> NearDuplicateStats:
+        with self._lock:
+            return NearDuplicateStats(
+                enabled=self.enabled,
+                entries=len(self._entries),
+                lookups=self.lookups,
+                hits=self.hits,
+            )
+
+
+near_duplicate_index = NearDuplicateIndex(
+    hash_size=settings.OCR_NEAR_DUPLICATE_HASH_SIZE,
+    max_distance=settings.OCR_NEAR_DUPLICATE_MAX_DISTANCE,
+    max_entries=settings.OCR_NEAR_DUPLICATE_MAX_ENTRIES,
+    enabled=settings.OCR_NEAR_DUPLICATE_ENABLED,
+)
@@ -0,0 +1,177 @@
+"""
+Content-addressed cache for OCR results.
+
+Results are keyed by a hash of the image bytes, the model and the prompt version, so re-uploading the same
+receipt never triggers another LLM call. The cache has two tiers: a bounded in-process LRU, and a SQLite
+database on disk that is shared by all the worker processes started by gunicorn.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from app.core.settings import settings
+from app.core.sqlite import SQLiteDatabase
+from app.schemas.metrics import OCRCacheStats
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ocr_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ocr_cache_accessed_at ON ocr_cache (accessed_at);
+"""
+
+
+def make_cache_key(image_bytes: bytes, model: str, prompt_version: str) -> str:
+    """
+    Build the cache key of an OCR result.
+
+    :param image_bytes: The image bytes of the bill
+    :param model: The model used to extract the bill details
+    :param prompt_version: The version of the prompt sent along with the image
+    :return: Hex digest identifying the OCR result
+    """
+    image_digest = hashlib.sha256(image_bytes).hexdigest()
+    return hashlib.sha256(f"{model}\0{prompt_version}\0{image_digest}".encode()).hexdigest()
+
+
+class OCRCache:
+    """
+    Two-tier LRU cache of OCR results, with TTL and size based eviction on both tiers.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        memory_max_entries: int,
+        disk_max_entries: int,
+        ttl_seconds: int,
+        enabled: bool = True,
+    ):
+        self.path = path
+        self.memory_max_entries = memory_max_entries
+        self.disk_max_entries = disk_max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+
+        self._memory: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._database = SQLiteDatabase(path, _SCHEMA)
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return now - created_at > self.ttl_seconds
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        with self._lock:
+            self._memory[key] = (value, created_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> str | None:
+        """
+        Look up an OCR result, first in memory and then on disk.
+
+        :param key: Cache key built with `make_cache_key`
+        :return: The cached OCR result, or None on a miss
+        """
+        if not self.enabled:
+            return None
+
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if not self._is_expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+        with self._database.connect() as connection:
+            row = connection.execute("SELECT value, created_at FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self._is_expired(row[1], now):
+                connection.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                connection.execute("UPDATE ocr_cache SET accessed_at = ? WHERE key = ?", (now, key))
+
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        value, created_at = row
+        self._remember(key, value, created_at)
+        with self._lock:
+            self.disk_hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Store an OCR result in both tiers, evicting expired and least recently used entries.
+
+        :param key: Cache key built with `make_cache_key`
+        :param value: The OCR result to cache
+        """
+        if not self.enabled:
+            return
+
+        now = time.time()
+        self._remember(key, value, now)
+
+        with self._database.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO ocr_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            connection.execute("DELETE FROM ocr_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            connection.execute(
+                """
+                DELETE FROM ocr_cache WHERE key IN (
+                    SELECT key FROM ocr_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.disk_max_entries,),
+            )
+
+    def clear(self) -> None:
+        """
+        Drop every entry from both tiers and reset the counters.
+        """
+        with self._lock:
+            self._memory.clear()
+            self.memory_hits = self.disk_hits = self.misses = 0
+
+        with self._database.connect() as connection:
+            connection.execute("DELETE FROM ocr_cache")
+
+    def stats(self) -> OCRCacheStats:
+        with self._lock:
+            return OCRCacheStats(
+                enabled=self.enabled,
+                memory_hits=self.memory_hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses,
+                memory_entries=len(self._memory),
+            )
+
+
+ocr_cache = OCRCache(
+    path=settings.DATA_DIR / "ocr_cache.sqlite3",
+    memory_max_entries=settings.OCR_CACHE_MEMORY_MAX_ENTRIES,
+    disk_max_entries=settings.OCR_CACHE_DISK_MAX_ENTRIES,
+    ttl_seconds=settings.OCR_CACHE_TTL_SECONDS,
+    enabled=settings.OCR_CACHE_ENABLED,
+)
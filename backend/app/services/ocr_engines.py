@@ -0,0 +1,203 @@
+"""
+OCR engines, which extract the details of a bill from its image.
+
+The engine is selected with OCR_ENGINE. The LiteLLM engine calls the configured LLM provider. The local engine needs
+no network: it answers from fixtures matched by a perceptual hash of the image, or else with a synthetic bill derived
+from the image, after a simulated latency. It lets the rest of the stack run, be tested and be benchmarked without
+a provider, and without its noise.
+"""
+
+import asyncio
+import hashlib
+import json
+import mimetypes
+import random
+import time
+from collections.abc import AsyncIterator
+from pathlib import Path
+from typing import Protocol
+
+from app.core.settings import settings
+from app.schemas.bill import OCRBill, OCRBillItem
+from app.services import litellm_service
+from app.services.image_preprocessing import ImagePreprocessor, image_preprocessor
+from app.services.near_duplicates import dhash
+
+_LOCAL_ITEM_NAMES = ["Fried Rice", "Iced Tea", "Noodle Soup", "Spring Rolls", "Coffee", "Dumplings", "Salad", "Cake"]
+
+
+class OCREngine(Protocol):
+    """
+    Extracts the details of a bill from its image, as the JSON of an `OCRBill`.
+    """
+
+    # Identify the results of the engine in the OCR cache, so that results of another engine, model or prompt are
+    # never reused
+    @property
+    def model(self) -> str: ...
+
+    @property
+    def prompt_version(self) -> str: ...
+
+    def get_bill_details_from_image(self, image_bytes: bytes, mime_type: str) -> str: ...
+
+    async def aget_bill_details_from_image(self, image_bytes: bytes, mime_type: str, items_only: bool = False) -> str:
+        """
+        :param items_only: Whether only the items of the bill are used, e.g. for a tile above the last one of a
+            receipt, so that its totals need not be valid
+        """
+        ...
+
+    def astream_bill_details_from_image(self, image_bytes: bytes, mime_type: str) -> AsyncIterator[str]: ...
+
+
+class LiteLLMEngine:
+    """
+    Extracts bill details with the LLM configured in the LITELLM_* settings.
+    """
+
+    prompt_version = litellm_service.BILL_OCR_PROMPT_VERSION
+
+    @property
+    def model(self) -> str:
+        return settings.LITELLM_MODEL
+
+    def get_bill_details_from_image(self, image_bytes: bytes, mime_type: str) -> str:
+        return litellm_service.get_bill_details_from_image(image_bytes, mime_type)
+
+    async def aget_bill_details_from_image(self, image_bytes: bytes, mime_type: str, items_only: bool = False) -> str:
+        return await litellm_service.aget_bill_details_from_image(image_bytes, mime_type, items_only=items_only)
+
+    def astream_bill_details_from_image(self, image_bytes: bytes, mime_type: str) -> AsyncIterator[str]:
+        return litellm_service.astream_bill_details_from_image(image_bytes, mime_type)
+
+
+class LocalOCREngine:
+    """
+    Extracts bill details without any network call, deterministically.
+
+    Fixtures are pairs of a receipt image and the JSON of its `OCRBill` with the same name, e.g. `lunch.jpg` and
+    `lunch.json`. An image is answered with the fixture whose image has the closest perceptual hash, within
+    `max_distance` bits, so that other photos of the receipt match as well. Fixture images are also hashed as the
+    preprocessor would send them for OCR, since cropping to the receipt changes their hash. Any other image is answered
+    with a synthetic bill, which is the same for the same image bytes.
+    """
+
+    model = "local"
+    prompt_version = "1"
+
+    def __init__(
+        self,
+        fixtures_dir: Path | None = None,
+        preprocessor: ImagePreprocessor | None = None,
+        latency_seconds: float = 0.0,
+        latency_jitter_seconds: float = 0.0,
+        hash_size: int = 16,
+        max_distance: int = 10,
+        stream_chunk_size: int = 16,
+    ):
+        """
+        :param fixtures_dir: Directory of the fixtures, or None to only answer with synthetic bills
+        :param preprocessor: Preprocesses images before OCR, or None if they are sent as is
+        :param latency_seconds: Simulated latency of each extraction
+        :param latency_jitter_seconds: Up to this much latency is added at random to each extraction
+        :param hash_size: Side of the thumbnail the perceptual hashes are computed from
+        :param max_distance: Bits which may differ between the hashes of an image and of its fixture
+        :param stream_chunk_size: Number of characters per streamed chunk
+        """
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.hash_size = hash_size
+        self.max_distance = max_distance
+        self.stream_chunk_size = stream_chunk_size
+        self._fixtures = self._load_fixtures(fixtures_dir, preprocessor) if fixtures_dir is not None else []
+
+    def _load_fixtures(self, fixtures_dir: Path, preprocessor: ImagePreprocessor | None) -> list[tuple[int, str]]:
+        fixtures = []
+        for image_path in sorted(fixtures_dir.iterdir()):
+            bill_path = image_path.with_suffix(".json")
+            if image_path == bill_path or not bill_path.is_file():
+                continue
+            bill_data = OCRBill.model_validate_json(bill_path.read_text()).model_dump_json()
+
+            image_bytes = image_path.read_bytes()
+            images = [image_bytes]
+            if preprocessor is not None:
+                mime_type = mimetypes.guess_type(image_path.name)[0] or "application/octet-stream"
+                images.append(preprocessor.preprocess(image_bytes, mime_type).content)
+
+            for image in images:
+                image_hash = dhash(image, self.hash_size)
+                if image_hash is None:
+                    raise ValueError(f"The OCR fixture {image_path} is not an image")
+                fixtures.append((image_hash, bill_data))
+        return fixtures
+
+    def _latency(self) -> float:
+        return self.latency_seconds + random.uniform(0, self.latency_jitter_seconds)
+
+    def extract(self, image_bytes: bytes) -> str:
+        """
+        Extract bill details from an image, without the simulated latency.
+        """
+        image_hash = dhash(image_bytes, self.hash_size) if self._fixtures else None
+        if image_hash is not None:
+            distance, bill_data = min(((image_hash ^ fixture).bit_count(), data) for fixture, data in self._fixtures)
+            if distance <= self.max_distance:
+                return bill_data
+        return self._synthetic_bill(image_bytes)
+
+    def _synthetic_bill(self, image_bytes: bytes) -> str:
+        rng = random.Random(hashlib.sha256(image_bytes).digest())
+        items = [
+            OCRBillItem(name=name, price=rng.randint(100, 2000) / 100, quantity=rng.randint(1, 3))
+            for name in rng.sample(_LOCAL_ITEM_NAMES, rng.randint(1, 6))
+        ]
+        tax_rate = rng.choice([0.0, 0.05, 0.1])
+        service_charge = rng.choice([0.0, 0.1])
+        subtotal = sum(item.price * item.quantity for item in items)
+        return json.dumps(
+            {
+                "items": [item.model_dump() for item in items],
+                "tax_rate": tax_rate,
+                "service_charge": service_charge,
+                "amount_paid": round(subtotal * (1 + tax_rate + service_charge), 2),
+            }
+        )
+
+    def get_bill_details_from_image(self, image_bytes: bytes, mime_type: str) -> str:
+        time.sleep(self._latency())
+        return self.extract(image_bytes)
+
+    async def aget_bill_details_from_image(self, image_bytes: bytes, mime_type: str, items_only: bool = False) -> str:
+        await asyncio.sleep(self._latency())
+        return await asyncio.to_thread(self.extract, image_bytes)
+
+    async def astream_bill_details_from_image(self, image_bytes: bytes, mime_type: str) -> AsyncIterator[str]:
+        bill_data = await asyncio.to_thread(self.extract, image_bytes)
+        chunks = [
+            bill_data[start : start + self.stream_chunk_size]
+            for start in range(0, len(bill_data), self.stream_chunk_size)
+        ]
+        # The latency is spread over the chunks, like the tokens of an LLM
+        delay = self._latency() / len(chunks)
+        for chunk in chunks:
+            await asyncio.sleep(delay)
+            yield chunk
+
+
+def create_ocr_engine() -> OCREngine:
+    """
+    Create the OCR engine selected with OCR_ENGINE.
+    """
+    if settings.OCR_ENGINE == "local":
+        return LocalOCREngine(
+            fixtures_dir=settings.OCR_LOCAL_FIXTURES_DIR,
+            preprocessor=image_preprocessor,
+            latency_seconds=settings.OCR_LOCAL_LATENCY_SECONDS,
+            latency_jitter_seconds=settings.OCR_LOCAL_LATENCY_JITTER_SECONDS,
+        )
+    return LiteLLMEngine()
+
+
+ocr_engine = create_ocr_engine()
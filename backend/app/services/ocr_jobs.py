@@ -0,0 +1,527 @@
+"""
+Background OCR jobs.
+
+Clients submit an image and get a job id back immediately, instead of holding a connection open for the whole
+LLM call. Jobs are processed by a pool of asyncio workers in every worker process, which claim them from a
+pluggable backend:
+
+- memory: for tests and local development, jobs are lost on restart
+- sqlite: a database in DATA_DIR shared by all the worker processes of a single node
+- redis: any server speaking the Redis protocol, shared by several nodes
+
+Claimed jobs hold a lease. If a worker process dies while processing a job, the job goes back to the queue
+once its lease expires, so the sqlite and redis backends survive restarts.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Protocol
+
+from pydantic import BaseModel
+
+from app.core.settings import settings
+from app.core.sqlite import SQLiteDatabase
+from app.schemas.bill import OCRBill
+from app.schemas.ocr_job import OCRJob, OCRJobStatus
+from app.services.admission import AdmissionRejectedError, ocr_admission
+from app.services.bill import aget_bill_details_from_image
+from app.services.redis_client import RedisClient
+
+logger = logging.getLogger(__name__)
+
+
+class ClaimedOCRJob(BaseModel):
+    job: OCRJob
+    image: bytes
+    mime_type: str
+
+
+class OCRJobBackend(Protocol):
+    """
+    Storage of OCR jobs and queue of the pending ones. Methods are blocking, call them from worker threads.
+    """
+
+    def submit(self, image: bytes, mime_type: str) -> OCRJob:
+        """Store a new pending job."""
+        ...
+
+    def get(self, job_id: str) -> OCRJob | None:
+        """Look up a job, or None if it does not exist (anymore)."""
+        ...
+
+    def claim(self) -> ClaimedOCRJob | None:
+        """Atomically take the oldest pending job and mark it as running, or None if there is none."""
+        ...
+
+    def complete(self, job_id: str, result: OCRBill) -> None:
+        """Mark a running job as succeeded."""
+        ...
+
+    def fail(self, job_id: str, error: str) -> None:
+        """Mark a running job as failed."""
+        ...
+
+    def release(self, job_id: str) -> None:
+        """Put a running job back in the queue, e.g. when its worker shuts down."""
+        ...
+
+    def renew(self, job_id: str) -> None:
+        """Extend the lease of a running job, as if it was claimed now."""
+        ...
+
+    def requeue_stale(self, lease_seconds: float) -> int:
+        """Put back in the queue the jobs claimed more than `lease_seconds` ago, and return how many there were."""
+        ...
+
+
+def _now() -> datetime:
+    return datetime.now(UTC)
+
+
+def _new_job() -> OCRJob:
+    now = _now()
+    return OCRJob(id=uuid.uuid4().hex, status=OCRJobStatus.PENDING, created_at=now, updated_at=now)
+
+
+class InMemoryOCRJobBackend:
+    def __init__(self, retention_seconds: float):
+        self.retention_seconds = retention_seconds
+
+        self._lock = threading.Lock()
+        self._jobs: dict[str, OCRJob] = {}
+        self._images: dict[str, tuple[bytes, str]] = {}
+        self._pending: deque[str] = deque()
+        self._claimed_at: dict[str, float] = {}
+
+    def submit(self, image: bytes, mime_type: str) -> OCRJob:
+        job = _new_job()
+        with self._lock:
+            self._purge_finished()
+            self._jobs[job.id] = job
+            self._images[job.id] = (image, mime_type)
+            self._pending.append(job.id)
+        return job
+
+    def _purge_finished(self) -> None:
+        expired_before = time.time() - self.retention_seconds
+        for job_id, job in list(self._jobs.items()):
+            if job.is_finished and job.updated_at.timestamp() < expired_before:
+                del self._jobs[job_id]
+
+    def get(self, job_id: str) -> OCRJob | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.model_copy() if job is not None else None
+
+    def claim(self) -> ClaimedOCRJob | None:
+        with self._lock:
+            if not self._pending:
+                return None
+            job_id = self._pending.popleft()
+            job = self._jobs[job_id] = self._jobs[job_id].model_copy(
+                update={"status": OCRJobStatus.RUNNING, "updated_at": _now()}
+            )
+            self._claimed_at[job_id] = time.time()
+            image, mime_type = self._images[job_id]
+            return ClaimedOCRJob(job=job.model_copy(), image=image, mime_type=mime_type)
+
+    def _finish(self, job_id: str, **update) -> None:
+        with self._lock:
+            self._jobs[job_id] = self._jobs[job_id].model_copy(update={**update, "updated_at": _now()})
+            self._images.pop(job_id, None)
+            self._claimed_at.pop(job_id, None)
+
+    def complete(self, job_id: str, result: OCRBill) -> None:
+        self._finish(job_id, status=OCRJobStatus.SUCCEEDED, result=result)
+
+    def fail(self, job_id: str, error: str) -> None:
+        self._finish(job_id, status=OCRJobStatus.FAILED, error=error)
+
+    def _release(self, job_id: str) -> None:
+        self._jobs[job_id] = self._jobs[job_id].model_copy(
+            update={"status": OCRJobStatus.PENDING, "updated_at": _now()}
+        )
+        self._claimed_at.pop(job_id, None)
+        self._pending.appendleft(job_id)
+
+    def release(self, job_id: str) -> None:
+        with self._lock:
+            self._release(job_id)
+
+    def renew(self, job_id: str) -> None:
+        with self._lock:
+            if job_id in self._claimed_at:
+                self._claimed_at[job_id] = time.time()
+
+    def requeue_stale(self, lease_seconds: float) -> int:
+        expired_before = time.time() - lease_seconds
+        with self._lock:
+            stale = [job_id for job_id, claimed_at in self._claimed_at.items() if claimed_at < expired_before]
+            for job_id in stale:
+                self._release(job_id)
+        return len(stale)
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ocr_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    image BLOB,
+    mime_type TEXT NOT NULL,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS ocr_jobs_status_created_at ON ocr_jobs (status, created_at);
+"""
+
+_SQLITE_JOB_COLUMNS = "id, status, created_at, updated_at, result, error"
+
+
+def _job_from_row(row: tuple) -> OCRJob:
+    job_id, status, created_at, updated_at, result, error = row
+    return OCRJob(
+        id=job_id,
+        status=OCRJobStatus(status),
+        created_at=datetime.fromisoformat(created_at),
+        updated_at=datetime.fromisoformat(updated_at),
+        result=OCRBill.model_validate_json(result) if result is not None else None,
+        error=error,
+    )
+
+
+class SQLiteOCRJobBackend:
+    def __init__(self, path: Path, retention_seconds: float):
+        self.retention_seconds = retention_seconds
+        self._database = SQLiteDatabase(path, _SQLITE_SCHEMA)
+
+    def submit(self, image: bytes, mime_type: str) -> OCRJob:
+        job = _new_job()
+        with self._database.connect() as connection:
+            connection.execute(
+                "DELETE FROM ocr_jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (
+                    OCRJobStatus.SUCCEEDED,
+                    OCRJobStatus.FAILED,
+                    datetime.fromtimestamp(time.time() - self.retention_seconds, UTC).isoformat(),
+                ),
+            )
+            connection.execute(
+                "INSERT INTO ocr_jobs (id, status, created_at, updated_at, image, mime_type) VALUES (?, ?, ?, ?, ?, ?)",
+                (job.id, job.status, job.created_at.isoformat(), job.updated_at.isoformat(), image, mime_type),
+            )
+        return job
+
+    def get(self, job_id: str) -> OCRJob | None:
+        with self._database.connect() as connection:
+            row = connection.execute(f"SELECT {_SQLITE_JOB_COLUMNS} FROM ocr_jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job_from_row(row) if row is not None else None
+
+    def claim(self) -> ClaimedOCRJob | None:
+        with self._database.connect() as connection:
+            # A single statement, so that two workers can never claim the same job
+            row = connection.execute(
+                f"""
+                UPDATE ocr_jobs SET status = ?, updated_at = ?, claimed_at = ?
+                WHERE id = (SELECT id FROM ocr_jobs WHERE status = ? ORDER BY created_at LIMIT 1)
+                RETURNING {_SQLITE_JOB_COLUMNS}, image, mime_type
+                """,
+                (OCRJobStatus.RUNNING, _now().isoformat(), time.time(), OCRJobStatus.PENDING),
+            ).fetchone()
+        if row is None:
+            return None
+        return ClaimedOCRJob(job=_job_from_row(row[:6]), image=row[6], mime_type=row[7])
+
+    def complete(self, job_id: str, result: OCRBill) -> None:
+        with self._database.connect() as connection:
+            connection.execute(
+                """
+                UPDATE ocr_jobs SET status = ?, updated_at = ?, result = ?, image = NULL, claimed_at = NULL
+                WHERE id = ?
+                """,
+                (OCRJobStatus.SUCCEEDED, _now().isoformat(), result.model_dump_json(), job_id),
+            )
+
+    def fail(self, job_id: str, error: str) -> None:
+        with self._database.connect() as connection:
+            connection.execute(
+                """
+                UPDATE ocr_jobs SET status = ?, updated_at = ?, error = ?, image = NULL, claimed_at = NULL
+                WHERE id = ?
+                """,
+                (OCRJobStatus.FAILED, _now().isoformat(), error, job_id),
+            )
+
+    def release(self, job_id: str) -> None:
+        with self._database.connect() as connection:
+            connection.execute(
+                "UPDATE ocr_jobs SET status = ?, updated_at = ?, claimed_at = NULL WHERE id = ? AND status = ?",
+                (OCRJobStatus.PENDING, _now().isoformat(), job_id, OCRJobStatus.RUNNING),
+            )
+
+    def renew(self, job_id: str) -> None:
+        with self._database.connect() as connection:
+            connection.execute(
+                "UPDATE ocr_jobs SET claimed_at = ? WHERE id = ? AND status = ?",
+                (time.time(), job_id, OCRJobStatus.RUNNING),
+            )
+
+    def requeue_stale(self, lease_seconds: float) -> int:
+        with self._database.connect() as connection:
+            cursor = connection.execute(
+                "UPDATE ocr_jobs SET status = ?, updated_at = ?, claimed_at = NULL WHERE status = ? AND claimed_at < ?",
+                (OCRJobStatus.PENDING, _now().isoformat(), OCRJobStatus.RUNNING, time.time() - lease_seconds),
+            )
+            return cursor.rowcount
+
+
+class RedisOCRJobBackend:
+    """
+    Jobs are hashes, and their images separate strings. Pending job ids are in a list, from which workers
+    atomically move them to a list of running jobs with LMOVE, so a claimed job is never lost.
+    """
+
+    def __init__(self, client: RedisClient, retention_seconds: float, prefix: str = "bill-splitter:ocr-jobs"):
+        self.client = client
+        self.retention_seconds = retention_seconds
+        self.prefix = prefix
+
+    def _job_key(self, job_id: str) -> str:
+        return f"{self.prefix}:job:{job_id}"
+
+    def _image_key(self, job_id: str) -> str:
+        return f"{self.prefix}:image:{job_id}"
+
+    @property
+    def _pending_key(self) -> str:
+        return f"{self.prefix}:pending"
+
+    @property
+    def _running_key(self) -> str:
+        return f"{self.prefix}:running"
+
+    def _get_fields(self, job_id: str) -> dict[str, str]:
+        reply = self.client.execute("HGETALL", self._job_key(job_id)) or []
+        return {reply[i].decode(): reply[i + 1].decode() for i in range(0, len(reply), 2)}
+
+    def submit(self, image: bytes, mime_type: str) -> OCRJob:
+        job = _new_job()
+        self.client.execute(
+            "HSET",
+            self._job_key(job.id),
+            "status",
+            job.status,
+            "created_at",
+            job.created_at.isoformat(),
+            "updated_at",
+            job.updated_at.isoformat(),
+            "mime_type",
+            mime_type,
+        )
+        self.client.execute("SET", self._image_key(job.id), image)
+        self.client.execute("LPUSH", self._pending_key, job.id)
+        return job
+
+    def get(self, job_id: str) -> OCRJob | None:
+        fields = self._get_fields(job_id)
+        if not fields:
+            return None
+        return OCRJob(
+            id=job_id,
+            status=OCRJobStatus(fields["status"]),
+            created_at=datetime.fromisoformat(fields["created_at"]),
+            updated_at=datetime.fromisoformat(fields["updated_at"]),
+            result=OCRBill.model_validate_json(fields["result"]) if "result" in fields else None,
+            error=fields.get("error"),
+        )
+
+    def claim(self) -> ClaimedOCRJob | None:
+        job_id = self.client.execute("LMOVE", self._pending_key, self._running_key, "RIGHT", "LEFT")
+        if job_id is None:
+            return None
+        job_id = job_id.decode()
+
+        self.client.execute(
+            "HSET",
+            self._job_key(job_id),
+            "status",
+            OCRJobStatus.RUNNING,
+            "updated_at",
+            _now().isoformat(),
+            "claimed_at",
+            time.time(),
+        )
+        image = self.client.execute("GET", self._image_key(job_id))
+        job = self.get(job_id)
+        if job is None or image is None:
+            # Expired or deleted while it was queued
+            self.client.execute("LREM", self._running_key, 0, job_id)
+            return None
+        return ClaimedOCRJob(job=job, image=image, mime_type=self._get_fields(job_id)["mime_type"])
+
+    def _finish(self, job_id: str, *fields: str) -> None:
+        job_key = self._job_key(job_id)
+        self.client.execute("HSET", job_key, *fields, "updated_at", _now().isoformat())
+        self.client.execute("HDEL", job_key, "claimed_at")
+        self.client.execute("EXPIRE", job_key, int(self.retention_seconds))
+        self.client.execute("DEL", self._image_key(job_id))
+        self.client.execute("LREM", self._running_key, 0, job_id)
+
+    def complete(self, job_id: str, result: OCRBill) -> None:
+        self._finish(job_id, "status", OCRJobStatus.SUCCEEDED, "result", result.model_dump_json())
+
+    def fail(self, job_id: str, error: str) -> None:
+        self._finish(job_id, "status", OCRJobStatus.FAILED, "error", error)
+
+    def release(self, job_id: str) -> None:
+        if not self.client.execute("LREM", self._running_key, 0, job_id):
+            return
+        self.client.execute(
+            "HSET", self._job_key(job_id), "status", OCRJobStatus.PENDING, "updated_at", _now().isoformat()
+        )
+        self.client.execute("HDEL", self._job_key(job_id), "claimed_at")
+        # Pushed where workers pop from, so that it is picked up again first
+        self.client.execute("RPUSH", self._pending_key, job_id)
+
+    def renew(self, job_id: str) -> None:
+        if self._get_fields(job_id).get("status") == OCRJobStatus.RUNNING:
+            self.client.execute("HSET", self._job_key(job_id), "claimed_at", time.time())
+
+    def requeue_stale(self, lease_seconds: float) -> int:
+        expired_before = time.time() - lease_seconds
+        requeued = 0
+        for job_id in self.client.execute("LRANGE", self._running_key, 0, -1) or []:
+            job_id = job_id.decode()
+            fields = self._get_fields(job_id)
+            # A job without claimed_at was moved to the running list by a worker which died right after
+            claimed_at = float(fields.get("claimed_at") or datetime.fromisoformat(fields["created_at"]).timestamp())
+            if claimed_at < expired_before:
+                self.release(job_id)
+                requeued += 1
+        return requeued
+
+
+def create_ocr_job_backend() -> OCRJobBackend:
+    match settings.OCR_JOB_BACKEND:
+        case "memory":
+            return InMemoryOCRJobBackend(retention_seconds=settings.OCR_JOB_RETENTION_SECONDS)
+        case "sqlite":
+            return SQLiteOCRJobBackend(
+                path=settings.DATA_DIR / "ocr_jobs.sqlite3", retention_seconds=settings.OCR_JOB_RETENTION_SECONDS
+            )
+        case "redis":
+            return RedisOCRJobBackend(
+                client=RedisClient(settings.OCR_JOB_REDIS_URL), retention_seconds=settings.OCR_JOB_RETENTION_SECONDS
+            )
+
+
+class OCRJobWorkerPool:
+    """
+    Asyncio tasks processing OCR jobs in the background of a worker process.
+
+    The lease of a job is renewed while it is processed, so that only the jobs of a worker which died are put back in
+    the queue, however long an extraction takes.
+    """
+
+    def __init__(self, backend: OCRJobBackend, workers: int, poll_interval: float, lease_seconds: float):
+        self.backend = backend
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+
+        self._tasks: list[asyncio.Task] = []
+        self._running_jobs: set[str] = set()
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._requeue_stale_jobs()))
+
+    async def stop(self) -> None:
+        """
+        Stop the workers, and put the jobs they were processing back in the queue for another worker to pick up.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        for job_id in list(self._running_jobs):
+            await asyncio.to_thread(self.backend.release, job_id)
+        self._running_jobs.clear()
+
+    async def _work(self) -> None:
+        while True:
+            try:
+                claimed = await asyncio.to_thread(self.backend.claim)
+            except Exception:
+                logger.exception("Could not claim an OCR job")
+                claimed = None
+
+            if claimed is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            await self._process(claimed)
+
+    async def _process(self, claimed: ClaimedOCRJob) -> None:
+        job_id = claimed.job.id
+        self._running_jobs.add(job_id)
+        lease = asyncio.create_task(self._renew_lease(job_id))
+        try:
+            bill = await self._extract(claimed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Could not extract bill details of OCR job %s", job_id)
+            await asyncio.to_thread(self.backend.fail, job_id, f"Could not extract bill details: {e}")
+        else:
+            await asyncio.to_thread(self.backend.complete, job_id, bill)
+        finally:
+            lease.cancel()
+        self._running_jobs.discard(job_id)
+
+    async def _renew_lease(self, job_id: str) -> None:
+        # Renewed several times per lease, so that a slow renewal does not let it expire
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self.backend.renew, job_id)
+            except Exception:
+                logger.exception("Could not renew the lease of OCR job %s", job_id)
+
+    async def _extract(self, claimed: ClaimedOCRJob) -> OCRBill:
+        # Jobs share the OCR slots of this worker process with requests, and wait for one as long as it takes
+        while True:
+            try:
+                async with ocr_admission.admit():
+                    return await aget_bill_details_from_image(claimed.image, claimed.mime_type)
+            except AdmissionRejectedError as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def _requeue_stale_jobs(self) -> None:
+        while True:
+            try:
+                requeued = await asyncio.to_thread(self.backend.requeue_stale, self.lease_seconds)
+                if requeued:
+                    logger.warning("Put %d stale OCR jobs back in the queue", requeued)
+            except Exception:
+                logger.exception("Could not requeue stale OCR jobs")
+            await asyncio.sleep(self.lease_seconds / 2)
+
+
+ocr_job_backend = create_ocr_job_backend()
+
+ocr_job_workers = OCRJobWorkerPool(
+    backend=ocr_job_backend,
+    workers=settings.OCR_JOB_WORKERS,
+    poll_interval=settings.OCR_JOB_POLL_INTERVAL_SECONDS,
+    lease_seconds=settings.OCR_JOB_LEASE_SECONDS,
+)
@@ -0,0 +1,327 @@
+"""
+Persistent outings, edited one bill at a time.
+
+Instead of uploading a whole outing to /bills/split on every edit, clients create an outing once, then add, update
+or remove its bills one by one. Each outing keeps the net balance of each person, and each bill what it contributes
+to them (see `app.services.ledger`), so an edit only applies the difference made by the bill which changed. The
+split is computed from the balances on the first read after a change, and cached with the outing until the next
+change, so that reads of an unchanged outing do no computation. Outings are stored in a pluggable backend:
+
+- memory: for tests and local development, outings are lost on restart
+- sqlite: a database in DATA_DIR shared by all the worker processes of a single node
+"""
+
+import json
+import sqlite3
+import threading
+import uuid
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Protocol
+
+from app.core.settings import settings
+from app.core.sqlite import SQLiteDatabase
+from app.schemas.bill import Bill, OutingSplit
+from app.schemas.outing import BillUpdate, StoredBill, StoredOuting
+from app.services.bill import settle_balances
+from app.services.ledger import OutingLedger, bill_contribution, update_balances
+from app.services.settlement import SettlementStrategy
+
+
+class OutingStore(Protocol):
+    """
+    Storage of outings and of their bills. Methods are blocking, call them from worker threads.
+    """
+
+    def create(self, bills: list[Bill]) -> StoredOuting:
+        """Store a new outing with its first bills, if any."""
+        ...
+
+    def get(self, outing_id: str) -> StoredOuting | None:
+        """Look up an outing, or None if it does not exist."""
+        ...
+
+    def add_bill(self, outing_id: str, bill: Bill) -> StoredBill | None:
+        """Add a bill to an outing, or return None if the outing does not exist."""
+        ...
+
+    def update_bill(self, outing_id: str, bill_id: int, update: BillUpdate) -> StoredBill | None:
+        """Change fields of a bill of an outing, or return None if the outing or bill does not exist."""
+        ...
+
+    def remove_bill(self, outing_id: str, bill_id: int) -> bool:
+        """Remove a bill from an outing, and return whether the outing and bill existed."""
+        ...
+
+    def split(self, outing_id: str, strategy: SettlementStrategy = "greedy") -> OutingSplit | None:
+        """The transactions settling the debts of an outing, or None if the outing does not exist."""
+        ...
+
+
+def _now() -> datetime:
+    return datetime.now(UTC)
+
+
+class _InMemoryOuting:
+    def __init__(self, outing_id: str):
+        self.id = outing_id
+        self.created_at = self.updated_at = _now()
+        self.ledger = OutingLedger()
+        self.bills: dict[int, Bill] = {}
+
+    def to_stored(self) -> StoredOuting:
+        return StoredOuting(
+            id=self.id,
+            created_at=self.created_at,
+            updated_at=self.updated_at,
+            bills=[StoredBill(id=bill_id, **bill.model_dump()) for bill_id, bill in self.bills.items()],
+        )
+
+
+class InMemoryOutingStore:
+    """
+    Outings are ledgers, which cache their split themselves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._outings: dict[str, _InMemoryOuting] = {}
+
+    def create(self, bills: list[Bill]) -> StoredOuting:
+        outing = _InMemoryOuting(uuid.uuid4().hex)
+        for bill in bills:
+            outing.bills[outing.ledger.add_bill(bill)] = bill
+        with self._lock:
+            self._outings[outing.id] = outing
+            return outing.to_stored()
+
+    def get(self, outing_id: str) -> StoredOuting | None:
+        with self._lock:
+            outing = self._outings.get(outing_id)
+            return outing.to_stored() if outing is not None else None
+
+    def add_bill(self, outing_id: str, bill: Bill) -> StoredBill | None:
+        with self._lock:
+            outing = self._outings.get(outing_id)
+            if outing is None:
+                return None
+            bill_id = outing.ledger.add_bill(bill)
+            outing.bills[bill_id] = bill
+            outing.updated_at = _now()
+        return StoredBill(id=bill_id, **bill.model_dump())
+
+    def update_bill(self, outing_id: str, bill_id: int, update: BillUpdate) -> StoredBill | None:
+        with self._lock:
+            outing = self._outings.get(outing_id)
+            if outing is None or bill_id not in outing.bills:
+                return None
+            bill = update.apply(outing.bills[bill_id])
+            outing.ledger.replace_bill(bill_id, bill)
+            outing.bills[bill_id] = bill
+            outing.updated_at = _now()
+        return StoredBill(id=bill_id, **bill.model_dump())
+
+    def remove_bill(self, outing_id: str, bill_id: int) -> bool:
+        with self._lock:
+            outing = self._outings.get(outing_id)
+            if outing is None or bill_id not in outing.bills:
+                return False
+            outing.ledger.remove_bill(bill_id)
+            del outing.bills[bill_id]
+            outing.updated_at = _now()
+        return True
+
+    def split(self, outing_id: str, strategy: SettlementStrategy = "greedy") -> OutingSplit | None:
+        with self._lock:
+            outing = self._outings.get(outing_id)
+            return outing.ledger.split(strategy) if outing is not None else None
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outings (
+    id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    next_bill_id INTEGER NOT NULL,
+    -- {person: [balance in cents, number of bills they appear in]}
+    balances TEXT NOT NULL,
+    -- Incremented whenever the balances change, so that a split computed from older balances is not cached
+    version INTEGER NOT NULL,
+    -- {strategy: split} computed from the current balances
+    splits TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outing_bills (
+    outing_id TEXT NOT NULL REFERENCES outings (id),
+    id INTEGER NOT NULL,
+    bill TEXT NOT NULL,
+    -- {person: cents} paid minus consumed in the bill
+    contribution TEXT NOT NULL,
+    PRIMARY KEY (outing_id, id)
+);
+"""
+
+
+class SQLiteOutingStore:
+    """
+    Edits read and write the balances of the outing, and the bill which changed, in a single transaction which takes
+    the write lock up front, so that concurrent edits of an outing are applied one after the other.
+    """
+
+    def __init__(self, path: Path):
+        self._database = SQLiteDatabase(path, _SQLITE_SCHEMA)
+
+    def create(self, bills: list[Bill]) -> StoredOuting:
+        outing_id = uuid.uuid4().hex
+        now = _now()
+        contributions = [bill_contribution(bill) for bill in bills]
+        balances: dict[str, int] = {}
+        appearances: dict[str, int] = {}
+        for contribution in contributions:
+            update_balances(balances, appearances, contribution, {})
+
+        with self._database.connect() as connection:
+            connection.execute(
+                """
+                INSERT INTO outings (id, created_at, updated_at, next_bill_id, balances, version, splits)
+                VALUES (?, ?, ?, ?, ?, 0, '{}')
+                """,
+                (outing_id, now.isoformat(), now.isoformat(), len(bills), _dump_balances(balances, appearances)),
+            )
+            connection.executemany(
+                "INSERT INTO outing_bills (outing_id, id, bill, contribution) VALUES (?, ?, ?, ?)",
+                [
+                    (outing_id, bill_id, bill.model_dump_json(), json.dumps(contribution))
+                    for bill_id, (bill, contribution) in enumerate(zip(bills, contributions))
+                ],
+            )
+        return StoredOuting(
+            id=outing_id,
+            created_at=now,
+            updated_at=now,
+            bills=[StoredBill(id=bill_id, **bill.model_dump()) for bill_id, bill in enumerate(bills)],
+        )
+
+    def get(self, outing_id: str) -> StoredOuting | None:
+        with self._database.connect() as connection:
+            row = connection.execute("SELECT created_at, updated_at FROM outings WHERE id = ?", (outing_id,)).fetchone()
+            if row is None:
+                return None
+            bill_rows = connection.execute(
+                "SELECT id, bill FROM outing_bills WHERE outing_id = ? ORDER BY id", (outing_id,)
+            ).fetchall()
+        created_at, updated_at = row
+        return StoredOuting(
+            id=outing_id,
+            created_at=created_at,
+            updated_at=updated_at,
+            bills=[StoredBill(id=bill_id, **json.loads(bill)) for bill_id, bill in bill_rows],
+        )
+
+    def add_bill(self, outing_id: str, bill: Bill) -> StoredBill | None:
+        contribution = bill_contribution(bill)
+        with self._database.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT next_bill_id FROM outings WHERE id = ?", (outing_id,)).fetchone()
+            if row is None:
+                return None
+            (bill_id,) = row
+            connection.execute(
+                "INSERT INTO outing_bills (outing_id, id, bill, contribution) VALUES (?, ?, ?, ?)",
+                (outing_id, bill_id, bill.model_dump_json(), json.dumps(contribution)),
+            )
+            connection.execute("UPDATE outings SET next_bill_id = next_bill_id + 1 WHERE id = ?", (outing_id,))
+            self._update_balances(connection, outing_id, contribution, {})
+        return StoredBill(id=bill_id, **bill.model_dump())
+
+    def update_bill(self, outing_id: str, bill_id: int, update: BillUpdate) -> StoredBill | None:
+        with self._database.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT bill, contribution FROM outing_bills WHERE outing_id = ? AND id = ?", (outing_id, bill_id)
+            ).fetchone()
+            if row is None:
+                return None
+            bill = update.apply(Bill.model_validate_json(row[0]))
+            contribution = bill_contribution(bill)
+            connection.execute(
+                "UPDATE outing_bills SET bill = ?, contribution = ? WHERE outing_id = ? AND id = ?",
+                (bill.model_dump_json(), json.dumps(contribution), outing_id, bill_id),
+            )
+            self._update_balances(connection, outing_id, contribution, json.loads(row[1]))
+        return StoredBill(id=bill_id, **bill.model_dump())
+
+    def remove_bill(self, outing_id: str, bill_id: int) -> bool:
+        with self._database.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "DELETE FROM outing_bills WHERE outing_id = ? AND id = ? RETURNING contribution", (outing_id, bill_id)
+            ).fetchone()
+            if row is None:
+                return False
+            self._update_balances(connection, outing_id, {}, json.loads(row[0]))
+        return True
+
+    @staticmethod
+    def _update_balances(
+        connection: sqlite3.Connection, outing_id: str, added: dict[str, int], removed: dict[str, int]
+    ) -> None:
+        """
+        Apply the difference made by a bill to the balances of an outing, dropping its cached splits if the balances
+        changed.
+        """
+        (stored_balances,) = connection.execute("SELECT balances FROM outings WHERE id = ?", (outing_id,)).fetchone()
+        balances, appearances = _load_balances(stored_balances)
+        changed = update_balances(balances, appearances, added, removed)
+        connection.execute(
+            f"""
+            UPDATE outings SET updated_at = ?, balances = ?{", version = version + 1, splits = '{}'" if changed else ""}
+            WHERE id = ?
+            """,
+            (_now().isoformat(), _dump_balances(balances, appearances), outing_id),
+        )
+
+    def split(self, outing_id: str, strategy: SettlementStrategy = "greedy") -> OutingSplit | None:
+        with self._database.connect() as connection:
+            row = connection.execute(
+                "SELECT balances, version, json_extract(splits, ?) FROM outings WHERE id = ?",
+                (f"$.{strategy}", outing_id),
+            ).fetchone()
+        if row is None:
+            return None
+        stored_balances, version, cached_split = row
+        if cached_split is not None:
+            return OutingSplit.model_validate_json(cached_split)
+
+        balances, _ = _load_balances(stored_balances)
+        outing_split = settle_balances(list(balances), list(balances.values()), strategy)
+        with self._database.connect() as connection:
+            # Unless the balances changed in the meantime
+            connection.execute(
+                "UPDATE outings SET splits = json_set(splits, ?, json(?)) WHERE id = ? AND version = ?",
+                (f"$.{strategy}", outing_split.model_dump_json(), outing_id, version),
+            )
+        return outing_split
+
+
+def _load_balances(stored: str) -> tuple[dict[str, int], dict[str, int]]:
+    balances: dict[str, int] = {}
+    appearances: dict[str, int] = {}
+    for person, (balance, bills) in json.loads(stored).items():
+        balances[person] = balance
+        appearances[person] = bills
+    return balances, appearances
+
+
+def _dump_balances(balances: dict[str, int], appearances: dict[str, int]) -> str:
+    return json.dumps({person: [balance, appearances[person]] for person, balance in balances.items()})
+
+
+def create_outing_store() -> OutingStore:
+    match settings.OUTING_STORE_BACKEND:
+        case "memory":
+            return InMemoryOutingStore()
+        case "sqlite":
+            return SQLiteOutingStore(path=settings.DATA_DIR / "outings.sqlite3")
+
+
+outing_store = create_outing_store()
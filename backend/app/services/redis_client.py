@@ -0,0 +1,97 @@
+"""
+Minimal blocking client for the Redis protocol (RESP2).
+
+Only what the OCR job queue needs: send a command, read its reply. Works against Redis, Valkey, KeyDB or any
+other server speaking the protocol.
+"""
+
+import socket
+import threading
+from urllib.parse import urlparse
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisClient:
+    def __init__(self, url: str, timeout: float = 5.0):
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise ValueError(f"Unsupported Redis URL scheme: {parsed.scheme}")
+
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._socket: socket.socket | None = None
+        self._reader = None
+
+    def _connect(self) -> None:
+        self._socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._socket.makefile("rb")
+        if self.password:
+            self._execute("AUTH", self.password)
+        if self.db:
+            self._execute("SELECT", self.db)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._socket is not None:
+                self._socket.close()
+            self._socket = self._reader = None
+
+    def _read_reply(self):
+        assert self._reader is not None
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by Redis server")
+
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RedisError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply from Redis server: {line!r}")
+
+    def _execute(self, *args: str | bytes | float):
+        assert self._socket is not None
+        command = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in args]
+        request = b"".join([f"*{len(command)}\r\n".encode()] + [b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in command])
+        self._socket.sendall(request)
+        return self._read_reply()
+
+    def execute(self, *args: str | bytes | float):
+        """
+        Run a command and return its reply. Bulk strings are returned as bytes.
+
+        The connection is (re)established on demand, and a command is retried once if the connection was lost.
+        """
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    return self._execute(*args)
+                except (ConnectionError, OSError):
+                    if self._socket is not None:
+                        self._socket.close()
+                    self._socket = self._reader = None
+                    if attempt == 1:
+                        raise
@@ -0,0 +1,101 @@
+"""
+Exact minimum-transfer settlement.
+
+Settling a group whose balances sum to zero takes one transfer less than the number of people in it, and no fewer in
+general. So the fewest transfers settling everyone come from splitting people into as many groups as possible which
+each sum to zero, and settling each group on its own. The greedy settlement makes one group of everyone, which is
+optimal unless some subgroups net to zero, e.g. two people who owe and are owed the same amount.
+
+Finding the most zero-sum groups is NP-hard, so it is solved exactly with a dynamic program over the subsets of
+people, which takes time and memory exponential in their number. It is only attempted up to a number of people, and
+gives up once its time budget runs out, for the caller to fall back to the greedy settlement.
+"""
+
+import time
+from typing import Literal
+
+import numpy as np
+
+SettlementStrategy = Literal["greedy", "exact"]
+
+
+def zero_sum_groups(
+    balances: list[int], max_people: int = 20, time_budget_seconds: float = 0.5
+) -> list[list[int]] | None:
+    """
+    Split people into as many groups as possible whose balances each sum to zero.
+
+    :param balances: Balance of each person, which sum to zero
+    :param max_people: Most people with a non-zero balance to attempt, as the time and memory taken double with each
+    :param time_budget_seconds: Time after which to give up
+    :return: The indices of the people in each group, in order, people with a zero balance being left out, or None if
+        there are too many people, or the time budget ran out
+    """
+    deadline = time.perf_counter() + time_budget_seconds
+    groups: list[list[int]] = []
+
+    # Pairs of people who owe and are owed the same amount are always in a group of their own in some optimal split
+    unmatched: dict[int, list[int]] = {}
+    for index, balance in enumerate(balances):
+        if balance == 0:
+            continue
+        opposites = unmatched.get(-balance)
+        if opposites:
+            groups.append([opposites.pop(), index])
+        else:
+            unmatched.setdefault(balance, []).append(index)
+    remaining = sorted(index for indices in unmatched.values() for index in indices)
+
+    if len(remaining) > max_people:
+        return None
+    if remaining:
+        remaining_groups = _largest_partition([balances[index] for index in remaining], deadline)
+        if remaining_groups is None:
+            return None
+        groups.extend([remaining[member] for member in group] for group in remaining_groups)
+    return sorted(sorted(group) for group in groups)
+
+
+def _largest_partition(balances: list[int], deadline: float) -> list[list[int]] | None:
+    """
+    Split balances which sum to zero into as many groups as possible which each sum to zero.
+
+    The groups of a split are the differences between consecutive sets of a chain of zero-sum subsets, so the best
+    split comes from the longest such chain. `chains[mask]` is the length of the longest chain ending in the subset
+    `mask`, computed for all the subsets of each size at once, from those with one person less.
+    """
+    count = len(balances)
+    sums = np.zeros(1 << count, dtype=np.int64)
+    sizes = np.zeros(1 << count, dtype=np.int8)
+    for bit, balance in enumerate(balances):
+        sums[1 << bit : 2 << bit] = sums[: 1 << bit] + balance
+        sizes[1 << bit : 2 << bit] = sizes[: 1 << bit] + 1
+    zero_sums = (sums == 0).astype(np.int8)
+
+    chains = np.zeros(1 << count, dtype=np.int8)
+    order = np.argsort(sizes, kind="stable")
+    bounds = np.searchsorted(sizes[order], np.arange(count + 2))
+    for size in range(1, count + 1):
+        if time.perf_counter() > deadline:
+            return None
+        layer = order[bounds[size] : bounds[size + 1]]
+        best = np.zeros(len(layer), dtype=np.int8)
+        for bit in range(count):
+            has_bit = (layer >> bit) & 1 == 1
+            best[has_bit] = np.maximum(best[has_bit], chains[layer[has_bit] ^ (1 << bit)])
+        chains[layer] = best + zero_sums[layer]
+
+    # Walk the longest chain back from everyone, cutting a group at each zero-sum subset
+    groups = []
+    mask = (1 << count) - 1
+    group_end = mask
+    while mask:
+        if zero_sums[mask] and mask != group_end:
+            groups.append(group_end ^ mask)
+            group_end = mask
+        target = chains[mask] - zero_sums[mask]
+        mask = next(
+            mask ^ (1 << bit) for bit in range(count) if mask >> bit & 1 and chains[mask ^ (1 << bit)] == target
+        )
+    groups.append(group_end)
+    return [[bit for bit in range(count) if group >> bit & 1] for group in groups]
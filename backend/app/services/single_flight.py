@@ -0,0 +1,105 @@
+"""
+Single-flight coalescing of identical calls in flight at the same time.
+
+The first call for a key runs, and every identical call made before it finishes waits for it and gets the same
+result, or the same error, instead of running again.
+"""
+
+import asyncio
+import threading
+from collections.abc import Callable, Coroutine
+from typing import Any
+
+from app.schemas.metrics import SingleFlightStats
+
+
+class _Call[T]:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: T | None = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight[T]:
+    """
+    Coalesces calls by key. Blocking calls made from threads and coroutines on the event loop are coalesced
+    separately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, _Call[T]] = {}
+        self._tasks: dict[str, asyncio.Task[T]] = {}
+
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: str, function: Callable[[], T]) -> T:
+        """
+        Run a blocking function, unless it is already running for the same key, in which case wait for it instead.
+
+        :param key: Identifies the result of the function
+        :param function: Computes the result
+        :return: The result of the function, from this call or the one in flight
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result  # type: ignore
+
+        try:
+            call.result = function()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key: str, coroutine: Coroutine[Any, Any, T]) -> T:
+        """
+        Async version of `do`, which takes the coroutine to run. It is closed without running if a call is already in
+        flight for the same key.
+
+        The coroutine runs in its own task, so that cancelling one of the callers, e.g. when its client disconnects,
+        does not cancel the call for all the others.
+        """
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is None:
+                task = self._tasks[key] = asyncio.ensure_future(coroutine)
+                task.add_done_callback(lambda done_task: self._forget(key, done_task))
+                self.calls += 1
+            else:
+                coroutine.close()
+                self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task[T]) -> None:
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+        # Mark the error as retrieved, in case every caller was cancelled before the task failed
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> SingleFlightStats:
+        with self._lock:
+            return SingleFlightStats(
+                in_flight=len(self._calls) + len(self._tasks),
+                calls=self.calls,
+                coalesced=self.coalesced,
+            )
@@ -0,0 +1,132 @@
+"""
+Process pool splitting batches of outings, for /bills/split/batch.
+
+Splitting an outing is pure CPU work, so a batch of thousands of outings is spread over a pool of worker processes,
+one per core by default, instead of running on the event loop of a single process. Outings are sent to the workers
+as parsed JSON, in a few chunks per worker to keep the overhead of inter-process communication low, and each worker
+validates and splits its outings, and sends back their results already serialized. Nothing is done per outing in
+the worker process serving the request, besides concatenating the results, so the throughput scales with the cores.
+
+Workers are forked from a server process which imported this module once, so that they start quickly without
+re-importing the app, and without inheriting the threads of the worker process serving requests.
+"""
+
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any
+
+from pydantic import ValidationError
+
+from app.core.settings import settings
+from app.schemas.bill import Outing, SplitBatchResult
+from app.services.bill import calculate_outing_split
+from app.services.settlement import SettlementStrategy
+
+logger = logging.getLogger(__name__)
+
+# Chunks sent to each worker process, so that a slow chunk does not leave the other workers idle for long
+CHUNKS_PER_WORKER = 4
+
+
+def _validation_error_detail(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, detail['loc'])) or 'outing'}: {detail['msg']}" for detail in error.errors())
+
+
+def split_outing(data: Any, strategy: SettlementStrategy) -> SplitBatchResult:
+    """
+    Validate and split an outing, catching any error.
+
+    :param data: The outing, parsed from JSON
+    :param strategy: Settlement strategy
+    :return: The split of the outing, or why it could not be split
+    """
+    try:
+        outing = Outing.model_validate(data)
+    except ValidationError as e:
+        return SplitBatchResult(error=f"Invalid outing: {_validation_error_detail(e)}")
+
+    try:
+        return SplitBatchResult(split=calculate_outing_split(outing, strategy))
+    except Exception as e:
+        logger.exception("Could not split outing")
+        return SplitBatchResult(error=f"Could not split outing: {e}")
+
+
+def split_outings(outings: list[Any], strategy: SettlementStrategy) -> list[bytes]:
+    """
+    Split a chunk of outings, in a worker process.
+
+    :return: The JSON of the result of each outing
+    """
+    return [split_outing(data, strategy).model_dump_json().encode() for data in outings]
+
+
+class SplitPool:
+    def __init__(self, workers: int):
+        """
+        :param workers: Number of worker processes, or 0 for one per core available to this process
+        """
+        self.workers = workers or os.process_cpu_count() or 1
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def started(self) -> bool:
+        return self._executor is not None
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    def start(self) -> None:
+        """
+        Create the pool, whose worker processes are only started by the first batch.
+        """
+        if self._executor is None:
+            self._executor = self._create_executor()
+
+    async def stop(self) -> None:
+        """
+        Stop the worker processes, cancelling the chunks which have not started yet.
+        """
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+    async def split(self, outings: list[Any], strategy: SettlementStrategy = "greedy") -> list[bytes]:
+        """
+        Split outings on the worker processes.
+
+        :param outings: The outings, parsed from JSON, and validated by the workers
+        :param strategy: Settlement strategy of every outing
+        :return: The JSON of the `SplitBatchResult` of each outing, in order
+        """
+        executor = self._executor
+        if executor is None:
+            raise RuntimeError("The split pool is not started")
+
+        chunk_size = max(1, math.ceil(len(outings) / (self.workers * CHUNKS_PER_WORKER)))
+        chunks = [outings[start : start + chunk_size] for start in range(0, len(outings), chunk_size)]
+        chunk_results = await asyncio.gather(*(self._split_chunk(executor, chunk, strategy) for chunk in chunks))
+        return [result for results in chunk_results for result in results]
+
+    async def _split_chunk(
+        self, executor: ProcessPoolExecutor, chunk: list[Any], strategy: SettlementStrategy
+    ) -> list[bytes]:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, split_outings, chunk, strategy)
+        except Exception as e:
+            logger.exception("Could not split a chunk of %d outings", len(chunk))
+            if isinstance(e, BrokenProcessPool) and self._executor is executor:
+                # A worker process died, which leaves the pool unusable
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+            return [SplitBatchResult(error=f"Could not split outing: {e}").model_dump_json().encode()] * len(chunk)
+
+
+split_pool = SplitPool(workers=settings.SPLIT_BATCH_WORKERS)
@@ -0,0 +1,183 @@
+"""
+Time spent in each stage of serving a request: parsing it, computing the balances, settling them, calling the LLM,
+validating the `OCRBill` it returned, and serializing the response.
+
+Code runs a stage inside `stage_timing.stage(name)`, or in a function decorated with `stage_timing.timed(name)`.
+Parsing and serialization happen in FastAPI, around the endpoint: they are timed from the start of the request until
+the endpoint is called, less the stages run by its dependencies such as the wait for an admission slot, and from its
+return until the response starts, for endpoints decorated with `stage_timing.endpoint`. The durations of the stages
+of a request are added up by name, for stages run several times such as the LLM calls of a tiled receipt, and
+reported in its Server-Timing header by `StageTimingMiddleware`. They are also added up per stage for all requests,
+for /metrics.
+
+When disabled, no request is tracked, a stage is a shared context manager which does nothing, and a decorated
+function only checks a flag before being called.
+"""
+
+import contextlib
+import functools
+import inspect
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import AbstractContextManager
+from contextvars import ContextVar
+
+from app.core.settings import settings
+from app.schemas.metrics import StageStats, StageTimingStats
+
+_NOT_TIMED = contextlib.nullcontext()
+
+
+class RequestStages:
+    """
+    Stages of a request, as they are run.
+    """
+
+    __slots__ = ("durations", "endpoint_returned", "started")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.endpoint_returned: float | None = None
+        self.durations: dict[str, float] = {}  # By stage, in the order they were first run
+
+
+_request_stages: ContextVar[RequestStages | None] = ContextVar("stage_timing_request_stages", default=None)
+
+
+class _Stage:
+    __slots__ = ("name", "start", "timing")
+
+    def __init__(self, timing: "StageTiming", name: str):
+        self.timing = timing
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_) -> None:
+        self.timing.record(self.name, time.perf_counter() - self.start)
+
+
+class StageTiming:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stages: dict[str, list] = {}  # [count, total seconds, max seconds] by stage
+
+    def stage(self, name: str) -> AbstractContextManager[None]:
+        """
+        Time the block as a stage, errors included.
+
+        :param name: Name of the stage, a token of the Server-Timing header, e.g. without spaces
+        """
+        if not self.enabled:
+            return _NOT_TIMED
+        return _Stage(self, name)
+
+    def timed(self, name: str) -> Callable[[Callable], Callable]:
+        """
+        Decorator timing each call of a function or of a coroutine function as a stage.
+        """
+
+        def decorator(function: Callable) -> Callable:
+            if inspect.iscoroutinefunction(function):
+
+                @functools.wraps(function)
+                async def timed_coroutine_function(*args, **kwargs):
+                    if not self.enabled:
+                        return await function(*args, **kwargs)
+                    with _Stage(self, name):
+                        return await function(*args, **kwargs)
+
+                return timed_coroutine_function
+
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Stage(self, name):
+                    return function(*args, **kwargs)
+
+            return timed_function
+
+        return decorator
+
+    def endpoint(self, function: Callable) -> Callable:
+        """
+        Decorator of an async endpoint, timing the parsing of its requests and the serialization of its responses.
+
+        Apply it below the route decorator, so that FastAPI still reads the signature of the endpoint.
+        """
+
+        @functools.wraps(function)
+        async def timed_endpoint(*args, **kwargs):
+            stages = _request_stages.get()
+            if stages is None:
+                return await function(*args, **kwargs)
+            # The stages run so far are those of the dependencies of the endpoint, after its request was parsed
+            self.record("parse", time.perf_counter() - stages.started - sum(stages.durations.values()))
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                stages.endpoint_returned = time.perf_counter()
+
+        return timed_endpoint
+
+    def record(self, name: str, seconds: float) -> None:
+        """
+        Record a stage which lasted this long, for the request being served, if any.
+        """
+        stages = _request_stages.get()
+        with self._lock:
+            if stages is not None:
+                stages.durations[name] = stages.durations.get(name, 0.0) + seconds
+            stats = self._stages.get(name)
+            if stats is None:
+                self._stages[name] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+
+    @contextlib.contextmanager
+    def track_request(self) -> Iterator[RequestStages | None]:
+        """
+        Collect the stages run inside the block, as those of a request.
+
+        Tasks and threads started inside the block inherit it, so stages run there are collected as well.
+
+        :return: The stages run so far inside the block, or None if disabled
+        """
+        if not self.enabled:
+            yield None
+            return
+        stages = RequestStages()
+        token = _request_stages.set(stages)
+        try:
+            yield stages
+        finally:
+            _request_stages.reset(token)
+
+    def stats(self) -> StageTimingStats:
+        with self._lock:
+            return StageTimingStats(
+                enabled=self.enabled,
+                stages={
+                    name: StageStats(count=count, total_seconds=total_seconds, max_seconds=max_seconds)
+                    for name, (count, total_seconds, max_seconds) in self._stages.items()
+                },
+            )
+
+
+def server_timing_header(durations: dict[str, float]) -> str:
+    """
+    Format the durations of stages as a Server-Timing header, see https://www.w3.org/TR/server-timing/
+
+    :param durations: Duration of each stage, in seconds
+    :return: The value of the header, with durations in milliseconds
+    """
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in durations.items())
+
+
+stage_timing = StageTiming(enabled=settings.STAGE_TIMING_ENABLED)
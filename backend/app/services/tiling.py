@@ -0,0 +1,101 @@
+"""
+Tiled OCR of very long receipts.
+
+A tall, narrow receipt squashed into a single vision input is downscaled until its small text is unreadable. Instead,
+it is split into overlapping horizontal tiles, each one downscaled on its own, and extracted concurrently. The items
+of the tiles are then merged in order, with the items read twice where tiles overlap counted once, and the totals are
+taken from the last tile, where the footer of the receipt is.
+"""
+
+import itertools
+import json
+import math
+
+from pydantic import TypeAdapter, ValidationError
+
+from app.schemas.bill import OCRBill, OCRBillItem
+
+# Most items a line of the receipt read in two tiles can account for, beyond which repeats are genuine
+_MAX_OVERLAP_ITEMS = 5
+
+_items_adapter = TypeAdapter(list[OCRBillItem])
+
+
+def tile_boxes(
+    width: int, height: int, tile_aspect_ratio: float, overlap: float, max_tiles: int
+) -> list[tuple[int, int, int, int]]:
+    """
+    Split an image into overlapping horizontal tiles of the same height.
+
+    :param width: Width of the image
+    :param height: Height of the image
+    :param tile_aspect_ratio: Height of a tile relative to its width, images at most this tall are not split
+    :param overlap: Fraction of the height of a tile shared with the next one
+    :param max_tiles: Most tiles to split the image into, the tiles are taller than `tile_aspect_ratio` beyond this
+    :return: The boxes of the tiles, from top to bottom
+    """
+    tile_height = width * tile_aspect_ratio
+    if height <= tile_height:
+        return [(0, 0, width, height)]
+
+    # n tiles of height t, each one overlapping the next by overlap * t, cover n * t - (n - 1) * overlap * t
+    count = min(max_tiles, math.ceil((height / tile_height - overlap) / (1 - overlap)))
+    tile_height = height / (count - (count - 1) * overlap)
+    step = tile_height * (1 - overlap)
+    return [
+        (0, round(index * step), width, height if index == count - 1 else round(index * step + tile_height))
+        for index in range(count)
+    ]
+
+
+def _item_key(item: OCRBillItem) -> tuple[str, float, int]:
+    return " ".join(item.name.casefold().split()), round(item.price, 2), item.quantity
+
+
+def _overlapping_items(previous: list[OCRBillItem], following: list[OCRBillItem]) -> int:
+    """
+    Count the items at the start of a tile which were already read at the end of the previous one.
+    """
+    previous_keys = [_item_key(item) for item in previous[-_MAX_OVERLAP_ITEMS:]]
+    following_keys = [_item_key(item) for item in following[:_MAX_OVERLAP_ITEMS]]
+    for count in range(min(len(previous_keys), len(following_keys)), 0, -1):
+        if previous_keys[-count:] == following_keys[:count]:
+            return count
+    return 0
+
+
+def validate_tile_items(tile_data: str) -> list[OCRBillItem]:
+    """
+    Validate the bill details extracted from a tile above the last one, of which only the items are used.
+
+    :param tile_data: Bill details extracted from the tile, as a JSON string
+    :return: The items of the tile
+    :raises ValueError: If the items are not valid
+    """
+    try:
+        return _items_adapter.validate_python(json.loads(tile_data).get("items", []))
+    except (ValueError, AttributeError, ValidationError) as e:
+        raise ValueError(f"Invalid bill details extracted from a tile: {e}") from e
+
+
+def merge_tiles(tiles_data: list[str]) -> OCRBill:
+    """
+    Merge the bill details extracted from each tile of a receipt into the bill of the whole receipt.
+
+    Only the items of the tiles above the last one are used, so their totals, which the receipt does not show there,
+    need not be valid.
+
+    :param tiles_data: Bill details extracted from each tile, as JSON strings, from top to bottom
+    :return: The bill of the whole receipt
+    """
+    *upper_tiles_data, last_tile_data = tiles_data
+    last_tile = OCRBill.model_validate_json(last_tile_data)
+
+    tiles_items = [validate_tile_items(tile_data) for tile_data in upper_tiles_data]
+    tiles_items.append(last_tile.items)
+
+    items = list(tiles_items[0])
+    for previous, following in itertools.pairwise(tiles_items):
+        items.extend(following[_overlapping_items(previous, following) :])
+
+    return last_tile.model_copy(update={"items": items})
@@ -0,0 +1,77 @@
+"""
+NumPy balance engine, for outings too large for the item by item loop of `calculate_balance`.
+
+Each share of an item, i.e. each (item, consumer) pair, is an entry of a sparse item x person share matrix, kept as
+its item and person indices. The amount paid for every bill is allocated among its items, and the cost of every item
+among its consumers, with the largest remainder method, in a few array operations over all the bills at once. The
+arrays of the `CompactOuting` are used as they are, without walking the outing again in Python.
+
+All amounts are integer cents, computed with the same integer arithmetic as the loop, so the results are identical.
+"""
+
+import numpy as np
+
+from app.services.compact_outing import CompactOuting
+
+_INT64_MAX = np.iinfo(np.int64).max
+
+
+def _item_costs(paid: np.ndarray, bill_sizes: np.ndarray, item_weights: np.ndarray) -> np.ndarray:
+    """
+    Allocate the amount paid for each bill among its items, in proportion to their weights, with the largest
+    remainder method: leftover cents go to the largest remainders, ties going to the first items.
+
+    Kept apart from `net_balances`, so that the arrays per item it works with are freed before those per share are
+    allocated.
+
+    :raises OverflowError: If the amounts are too large for 64-bit integers
+    """
+    item_bills = np.repeat(np.arange(len(paid)), bill_sizes)
+    bill_weights = np.zeros(len(paid), dtype=np.int64)
+    np.add.at(bill_weights, item_bills, item_weights)
+    if any(amount * weight > _INT64_MAX for amount, weight in zip(paid.tolist(), bill_weights.tolist())):
+        raise OverflowError("Amounts too large for the vectorized balance engine")
+
+    item_costs, remainders = np.divmod(paid[item_bills] * item_weights, bill_weights[item_bills])
+    allocated = np.zeros(len(paid), dtype=np.int64)
+    np.add.at(allocated, item_bills, item_costs)
+    bill_starts = np.cumsum(bill_sizes) - bill_sizes
+    # Sorted by bill first, each bill keeps its slice of the items, so the sorted items have the same bills
+    order = np.lexsort((np.arange(len(item_bills)), -remainders, item_bills))
+    ranks = np.arange(len(order)) - bill_starts[item_bills]
+    item_costs[order] += ranks < (paid - allocated)[item_bills]
+    return item_costs
+
+
+def net_balances(outing: CompactOuting) -> list[int]:
+    """
+    Calculate the net balance of each person in the outing, paid minus consumed, in cents.
+
+    :param outing: Contains the bills of the outing
+    :return: The balance of each person id
+    :raises OverflowError: If the amounts are too large for 64-bit integers
+    """
+    payers = np.frombuffer(outing.payers, dtype=np.int64)
+    paid = np.frombuffer(outing.paid, dtype=np.int64)
+    bill_sizes = np.frombuffer(outing.bill_sizes, dtype=np.int64)
+    item_weights = np.frombuffer(outing.item_weights, dtype=np.int64)
+    item_consumers = np.frombuffer(outing.item_consumers, dtype=np.int64)
+    share_people = np.frombuffer(outing.share_people, dtype=np.int64)
+
+    item_costs = _item_costs(paid, bill_sizes, item_weights)
+
+    # Equal split of the cost of each item among its consumers, leftover cents going to the first ones. Shares
+    # outnumber items, so the shares which get a leftover cent are marked in a difference array of bytes, rather than
+    # by comparing their ranks: +1 at the first share of each item, -1 after its last share with a leftover cent.
+    share_costs, leftovers = np.divmod(item_costs, item_consumers)
+    share_starts = np.cumsum(item_consumers) - item_consumers
+    marks = np.zeros(len(share_people) + 1, dtype=np.int8)
+    np.add.at(marks, share_starts, 1)
+    np.subtract.at(marks, share_starts + leftovers, 1)
+    share_costs = np.repeat(share_costs, item_consumers)
+    share_costs += np.cumsum(marks[:-1], dtype=np.int8)
+
+    balances = np.zeros(len(outing.people), dtype=np.int64)
+    np.add.at(balances, payers, paid)
+    np.subtract.at(balances, share_people, share_costs)
+    return balances.tolist()
@@ -0,0 +1,54 @@
+"""
+Time to compute the balances of outings of increasing size, with the item by item loop and with the NumPy engine,
+including the conversion of the outing to its `CompactOuting`.
+
+Outings are random, with bills of up to 20 items each shared by up to 6 people. Run from the backend directory with:
+
+    uv run python -m benchmarks.balance_engine [repeats]
+"""
+
+import os
+import sys
+import time
+
+os.environ.setdefault("LITELLM_MODEL", "openai/benchmark")
+os.environ.setdefault("LITELLM_API_BASE", "http://localhost")
+os.environ.setdefault("LITELLM_API_KEY", "benchmark")
+
+from app.core.settings import settings  # noqa: E402
+from app.schemas.bill import Outing  # noqa: E402
+from app.services.bill import _net_balances  # noqa: E402
+from app.services.compact_outing import CompactOuting  # noqa: E402
+from app.services.vectorized_balance import net_balances  # noqa: E402
+from tests import examples  # noqa: E402
+
+SIZES = [(1, 4), (5, 10), (25, 25), (100, 50), (500, 100), (2_500, 250)]
+
+
+def _vectorized_net_balances(outing: Outing) -> list[int]:
+    return net_balances(CompactOuting.from_outing(outing))
+
+
+def _time(function, outing, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(outing)
+    return (time.perf_counter() - start) / repeats
+
+
+def main(repeats: int) -> None:
+    print(f"Outings of bills with up to 20 items, vectorized from {settings.BALANCE_VECTORIZED_MIN_ITEMS} items")
+    print(f"{'bills':>6} {'people':>6} {'items':>7} {'loop':>10} {'numpy':>10} {'speedup':>8}")
+    for bills, people in SIZES:
+        outing = examples.random_outings.random_outing(0, bills=bills, items_per_bill=20, people=people)
+        items = sum(len(bill.items) for bill in outing.bills)
+        loop_seconds = _time(_net_balances, outing, repeats)
+        numpy_seconds = _time(_vectorized_net_balances, outing, repeats)
+        print(
+            f"{bills:>6} {people:>6} {items:>7} {loop_seconds * 1e3:>8.3f}ms {numpy_seconds * 1e3:>8.3f}ms"
+            f" {loop_seconds / numpy_seconds:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main(repeats=int(sys.argv[1]) if len(sys.argv) > 1 else 20)
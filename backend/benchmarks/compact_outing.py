@@ -0,0 +1,94 @@
+"""
+Time and memory to split outings of increasing size, through models and through the compact representation.
+
+Through models, the balances are computed item by item into a dict keyed by name, sorted into a `PersonBalance` per
+person, and settled from those. `calculate_outing_split` settles person ids indexing a list of cents instead, and
+computes the balances of large outings with the NumPy engine, on the arrays of their `CompactOuting`. Peak is the
+most memory allocated at once while splitting, and churn the part of it which was only allocated transiently, i.e.
+freed again before the split was returned.
+
+The last columns compare the memory taken by the amounts of the `CompactOuting`, in arrays of 64-bit integers, with
+the same amounts in lists of Python integers, as they were gathered before the compact representation. Outings are
+random, with bills of up to 20 items each shared by up to 6 people. Run from the backend directory with:
+
+    uv run python -m benchmarks.compact_outing [repeats]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("LITELLM_MODEL", "openai/benchmark")
+os.environ.setdefault("LITELLM_API_BASE", "http://localhost")
+os.environ.setdefault("LITELLM_API_KEY", "benchmark")
+
+from app.core.settings import settings  # noqa: E402
+from app.schemas.bill import Outing, OutingSplit  # noqa: E402
+from app.services.bill import (  # noqa: E402
+    _net_balances,
+    calculate_outing_split,
+    calculate_outing_split_with_minimal_transactions,
+    payment_balance,
+)
+from app.services.compact_outing import CompactOuting  # noqa: E402
+from tests import examples  # noqa: E402
+
+SIZES = [(5, 10), (25, 25), (100, 50), (500, 100), (2_500, 250), (10_000, 1_000)]
+ARRAYS = ["payers", "paid", "bill_sizes", "item_weights", "item_consumers", "share_people"]
+
+
+def split_through_models(outing: Outing) -> OutingSplit:
+    return calculate_outing_split_with_minimal_transactions(payment_balance(_net_balances(outing)))
+
+
+def _allocated(function) -> tuple[int, int]:
+    """
+    :return: The memory still allocated once the function returned, as long as its result is kept, and the peak
+    """
+    tracemalloc.start()
+    result = function()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, peak
+
+
+def _measure(function, outing: Outing, repeats: int) -> tuple[float, int, int]:
+    """
+    :return: The time taken by the function, its peak memory, and its churn
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(outing)
+    seconds = (time.perf_counter() - start) / repeats
+    current, peak = _allocated(lambda: function(outing))
+    return seconds, peak, peak - current
+
+
+def main(repeats: int) -> None:
+    print(f"Vectorized from {settings.BALANCE_VECTORIZED_MIN_ITEMS} items")
+    print(
+        f"{'bills':>6} {'people':>6} {'items':>7} {'models':>10} {'compact':>10} {'speedup':>8}"
+        f" {'peak models':>12} {'peak compact':>13} {'churn models':>13} {'churn compact':>14}"
+        f" {'arrays':>10} {'lists':>10}"
+    )
+    for bills, people in SIZES:
+        outing = examples.random_outings.random_outing(0, bills=bills, items_per_bill=20, people=people)
+        items = sum(len(bill.items) for bill in outing.bills)
+        models_seconds, models_peak, models_churn = _measure(split_through_models, outing, repeats)
+        compact_seconds, compact_peak, compact_churn = _measure(calculate_outing_split, outing, repeats)
+
+        compact = CompactOuting.from_outing(outing)
+        arrays = sum(len(getattr(compact, name)) * 8 for name in ARRAYS)
+        lists, _ = _allocated(lambda compact=compact: [getattr(compact, name).tolist() for name in ARRAYS])
+        print(
+            f"{bills:>6} {people:>6} {items:>7} {models_seconds * 1e3:>8.2f}ms {compact_seconds * 1e3:>8.2f}ms"
+            f" {models_seconds / compact_seconds:>7.2f}x {models_peak / 1024:>9.0f}KiB {compact_peak / 1024:>10.0f}KiB"
+            f" {models_churn / 1024:>10.0f}KiB {compact_churn / 1024:>11.0f}KiB"
+            f" {arrays / 1024:>7.0f}KiB {lists / 1024:>7.0f}KiB"
+        )
+
+
+if __name__ == "__main__":
+    main(repeats=int(sys.argv[1]) if len(sys.argv) > 1 else 5)
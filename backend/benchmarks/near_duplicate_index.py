@@ -0,0 +1,56 @@
+"""
+Lookup time of the near-duplicate index of receipts, against comparing the query with every indexed hash.
+
+Hashes are random, so most lookups are misses, which is the common case and the worst one for the linear scan. Run
+from the backend directory with:
+
+    uv run python -m benchmarks.near_duplicate_index [indexed hashes] [lookups]
+"""
+
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("LITELLM_MODEL", "openai/benchmark")
+os.environ.setdefault("LITELLM_API_BASE", "http://localhost")
+os.environ.setdefault("LITELLM_API_KEY", "benchmark")
+
+from app.core.settings import settings  # noqa: E402
+from app.services.near_duplicates import NearDuplicateIndex  # noqa: E402
+
+
+def main(entries: int, lookups: int) -> None:
+    hash_size, max_distance = settings.OCR_NEAR_DUPLICATE_HASH_SIZE, settings.OCR_NEAR_DUPLICATE_MAX_DISTANCE
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(hash_size**2) for _ in range(entries)]
+    # Half of the queries are near-duplicates of an indexed hash, the other half are new receipts
+    queries = [
+        rng.choice(hashes) ^ (1 << rng.randrange(hash_size**2)) if i % 2 else rng.getrandbits(hash_size**2)
+        for i in range(lookups)
+    ]
+
+    index = NearDuplicateIndex(hash_size=hash_size, max_distance=max_distance, max_entries=entries)
+    for position, image_hash in enumerate(hashes):
+        index.add(image_hash, "1", str(position))
+
+    start = time.perf_counter()
+    for query in queries:
+        index.find(query, "1")
+    index_seconds = (time.perf_counter() - start) / lookups
+
+    start = time.perf_counter()
+    for query in queries:
+        min((image_hash ^ query).bit_count() for image_hash in hashes)
+    scan_seconds = (time.perf_counter() - start) / lookups
+
+    print(f"{entries} hashes of {hash_size**2} bits, maximum distance {max_distance}")
+    print(f"index:       {index_seconds * 1e6:8.1f} µs per lookup, {index.stats().hits} hits")
+    print(f"linear scan: {scan_seconds * 1e6:8.1f} µs per lookup")
+
+
+if __name__ == "__main__":
+    main(
+        entries=int(sys.argv[1]) if len(sys.argv) > 1 else 50_000,
+        lookups=int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+    )
@@ -0,0 +1,146 @@
+"""
+Peak memory of concurrent OCR requests, before and after the upload handling was reworked.
+
+Before, the endpoint kept the uploaded image alive for the whole request, JPEGs were decoded at full resolution
+in color before being shrunk, and the image was encoded to a data URL through three full-size copies. The LLM
+provider is replaced by a stub which serializes the request like litellm does and then waits, so that every request
+holds its buffers at the same time.
+
+Peak RSS is measured by resetting the high-water mark of the process through /proc, so it is only reported on
+Linux. Python allocations are also traced, which excludes image decoding buffers held by Pillow. Run from the
+backend directory with:
+
+    uv run python -m benchmarks.ocr_upload_memory [photo width in pixels] [concurrent requests]
+"""
+
+import asyncio
+import base64
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tracemalloc
+from unittest.mock import MagicMock
+
+os.environ.setdefault("LITELLM_MODEL", "openai/benchmark")
+os.environ.setdefault("LITELLM_API_BASE", "http://localhost")
+os.environ.setdefault("LITELLM_API_KEY", "benchmark")
+
+import httpx  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from app.api.v1.endpoints import bill as bill_endpoints  # noqa: E402
+from app.main import app  # noqa: E402
+from app.services import litellm_service  # noqa: E402
+from app.services.ocr_cache import ocr_cache  # noqa: E402
+from tests import examples  # noqa: E402
+
+OCR_RESPONSE = MagicMock(
+    choices=[MagicMock(message=MagicMock(content=examples.simple_bill.OCR_BILL.model_dump_json()))]
+)
+
+
+def one_shot_encode_image_data_url(image_bytes: bytes, mime_type: str) -> str:
+    """The encoding used before, which allocates the encoded image three times over."""
+    base64_image = base64.b64encode(image_bytes).decode("utf-8")
+    return f"data:{mime_type};base64,{base64_image}"
+
+
+def hold_upload_during_request(get_bill_details_from_image):
+    """Keep a reference to the uploaded image until the request is done, like the endpoint did before."""
+
+    async def wrapper(image_bytes: bytes, mime_type: str, **kwargs):
+        held_upload = [image_bytes]
+        try:
+            return await get_bill_details_from_image(image_bytes, mime_type, **kwargs)
+        finally:
+            held_upload.clear()
+
+    return wrapper
+
+
+async def stub_acompletion(**kwargs) -> MagicMock:
+    request_body = json.dumps({"model": kwargs["model"], "messages": kwargs["messages"]})
+    await asyncio.sleep(0.5)
+    del request_body
+    return OCR_RESPONSE
+
+
+def reset_peak_rss() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss() -> int:
+    with open("/proc/self/status") as status:
+        return int(re.search(r"VmHWM:\s+(\d+) kB", status.read()).group(1)) * 1024  # type: ignore
+
+
+async def measure(image: bytes, concurrency: int) -> tuple[int, int | None]:
+    # Every request gets different bytes, so that nothing is served from a cache
+    uploads = [image + bytes([i]) for i in range(concurrency)]
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        rss_baseline = peak_rss() if reset_peak_rss() else None
+        tracemalloc.start()
+        baseline, _ = tracemalloc.get_traced_memory()
+        responses = await asyncio.gather(
+            *(
+                client.post("/api/v1/bills/ocr", files={"file": (f"{i}.jpg", upload, "image/jpeg")})
+                for i, upload in enumerate(uploads)
+            )
+        )
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss = peak_rss() - rss_baseline if rss_baseline is not None else None
+
+    assert all(response.status_code == 200 for response in responses), [response.text for response in responses]
+    return peak - baseline, rss
+
+
+def build_photo(width: int) -> bytes:
+    """A noisy 4:3 photo, which compresses about as badly as a phone camera picture."""
+    height = width * 4 // 3
+    photo = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+async def run(mode: str, width: int, concurrency: int) -> None:
+    ocr_cache.enabled = False
+    litellm_service.acompletion = stub_acompletion
+    if mode == "before":
+        Image.Image.draft = lambda self, mode, size: None  # type: ignore
+        litellm_service._encode_image_data_url = one_shot_encode_image_data_url
+        bill_endpoints.aget_bill_details_from_image = hold_upload_during_request(
+            bill_endpoints.aget_bill_details_from_image
+        )
+
+    peak, rss = await measure(build_photo(width), concurrency)
+    rss_report = f"{rss / concurrency / 2**20:6.1f} MB peak RSS" if rss is not None else "peak RSS unavailable"
+    print(f"  {mode:>6}: {rss_report}, {peak / concurrency / 2**20:6.1f} MB peak traced, per request")
+
+
+def main(width: int, concurrency: int) -> None:
+    print(f"{concurrency} concurrent OCR requests of a {len(build_photo(width)) / 2**20:.1f} MB photo", flush=True)
+    # Each mode runs in a fresh process, so that memory freed by one run is not reused by the other
+    for mode in ("before", "after"):
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.ocr_upload_memory", str(width), str(concurrency), mode], check=True
+        )
+
+
+if __name__ == "__main__":
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    if len(sys.argv) > 3:
+        asyncio.run(run(sys.argv[3], width, concurrency))
+    else:
+        main(width, concurrency)
@@ -0,0 +1,112 @@
+"""
+Time to serialize splits of increasing size into a response, depending on the default response class of the app.
+
+A route returning an `OutingSplit` is called in apps which only differ by their default response class:
+
+- default: FastAPI's own default, as in `app.main`, the split is dumped straight to JSON by pydantic-core
+- json: `JSONResponse` set explicitly, the split is dumped to a dict, then encoded by `json.dumps`
+- pydantic: a response class encoding with pydantic-core set explicitly, like a custom encoder such as orjson would
+  be, the split is dumped to a dict, then encoded by pydantic-core
+
+The time is that of the whole request through the app, without a server, and the cost that of the fastest explicit
+class over the default. Run from the backend directory with:
+
+    uv run python -m benchmarks.response_serialization [repeats]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from typing import Any
+
+os.environ.setdefault("LITELLM_MODEL", "openai/benchmark")
+os.environ.setdefault("LITELLM_API_BASE", "http://localhost")
+os.environ.setdefault("LITELLM_API_KEY", "benchmark")
+
+import pydantic_core  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from app.schemas.bill import OutingSplit, Payment, PaymentPlan  # noqa: E402
+
+PLANS = [1, 10, 100, 1_000, 10_000]
+
+
+class PydanticJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return pydantic_core.to_json(content)
+
+
+def _split(plans: int) -> OutingSplit:
+    return OutingSplit(
+        payment_plans=[
+            PaymentPlan(name=f"Person {i}", payments=[Payment(to=f"Person {j}", amount=12.34) for j in range(3)])
+            for i in range(plans)
+        ]
+    )
+
+
+def _app(split: OutingSplit, response_class: type[JSONResponse] | None = None) -> FastAPI:
+    app = FastAPI() if response_class is None else FastAPI(default_response_class=response_class)
+
+    @app.get("/split")
+    async def get_split() -> OutingSplit:
+        return split
+
+    return app
+
+
+async def _request(app: FastAPI) -> bytes:
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/split",
+        "query_string": b"",
+        "headers": [],
+        "root_path": "",
+        "server": ("localhost", 80),
+        "scheme": "http",
+    }
+    body = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message["body"])
+
+    await app(scope, receive, send)
+    return b"".join(body)
+
+
+async def _seconds(app: FastAPI, repeats: int) -> float:
+    await _request(app)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        await _request(app)
+    return (time.perf_counter() - start) / repeats
+
+
+async def main(repeats: int) -> None:
+    print(f"{'plans':>6} {'size':>9} {'default':>10} {'json':>10} {'pydantic':>10} {'cost':>10} {'slowdown':>8}")
+    for plans in PLANS:
+        split = _split(plans)
+        apps = [_app(split), _app(split, JSONResponse), _app(split, PydanticJSONResponse)]
+        bodies = [await _request(app) for app in apps]
+        assert all(OutingSplit.model_validate_json(body) == split for body in bodies)
+
+        # Fewer requests for larger splits
+        app_repeats = max(1, repeats * 1_000 // plans)
+        default_seconds, json_seconds, pydantic_seconds = [await _seconds(app, app_repeats) for app in apps]
+        explicit_seconds = min(json_seconds, pydantic_seconds)
+        print(
+            f"{plans:>6} {len(bodies[0]) / 1024:>6.0f}KiB {default_seconds * 1e3:>8.3f}ms {json_seconds * 1e3:>8.3f}ms"
+            f" {pydantic_seconds * 1e3:>8.3f}ms {(explicit_seconds - default_seconds) * 1e3:>8.3f}ms"
+            f" {explicit_seconds / default_seconds:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(repeats=int(sys.argv[1]) if len(sys.argv) > 1 else 5))
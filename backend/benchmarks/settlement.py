@@ -0,0 +1,92 @@
+"""
+Transfers and time of the greedy and exact settlements, for groups of 5 to 25 people.
+
+Balances are random, in groups of 2 to 5 people who net to zero among themselves, like friends who mostly paid for
+each other within an outing. Groups beyond SETTLEMENT_EXACT_MAX_PEOPLE, or which take longer than the time budget,
+fall back to the greedy settlement, which the last column shows. Run from the backend directory with:
+
+    uv run python -m benchmarks.settlement [max people] [time budget in seconds]
+"""
+
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("LITELLM_MODEL", "openai/benchmark")
+os.environ.setdefault("LITELLM_API_BASE", "http://localhost")
+os.environ.setdefault("LITELLM_API_KEY", "benchmark")
+
+from app.core.settings import settings  # noqa: E402
+from app.schemas.bill import OutingSplit  # noqa: E402
+from app.services.bill import (  # noqa: E402
+    OutingPaymentBalance,
+    PersonBalance,
+    calculate_outing_split_with_minimal_transactions,
+)
+from app.services.settlement import zero_sum_groups  # noqa: E402
+
+SIZES = [5, 10, 15, 18, 20, 22, 25]
+
+
+def random_balance(rng: random.Random, people: int) -> OutingPaymentBalance:
+    amounts: list[int] = []
+    while len(amounts) < people:
+        group = [rng.randint(-20_000, 20_000) for _ in range(min(rng.randint(1, 4), people - len(amounts) - 1))]
+        amounts.extend([*group, -sum(group)])
+    rng.shuffle(amounts)
+
+    people_balances = [PersonBalance(name=f"person{index}", amount=amount) for index, amount in enumerate(amounts)]
+    return OutingPaymentBalance(
+        creditors=sorted((p for p in people_balances if p.amount > 0), key=lambda p: p.amount, reverse=True),
+        debtors=sorted(
+            (p.model_copy(update={"amount": -p.amount}) for p in people_balances if p.amount <= 0),
+            key=lambda p: p.amount,
+            reverse=True,
+        ),
+    )
+
+
+def _transfers(split: OutingSplit) -> int:
+    return sum(len(plan.payments) for plan in split.payment_plans)
+
+
+def main(repeats: int = 5) -> None:
+    print(
+        f"Exact settlement of up to {settings.SETTLEMENT_EXACT_MAX_PEOPLE} people, "
+        f"within {settings.SETTLEMENT_EXACT_TIME_BUDGET_SECONDS}s"
+    )
+    print(f"{'people':>6} {'greedy':>8} {'time':>10} {'exact':>8} {'time':>10} {'fallbacks':>10}")
+    rng = random.Random(0)
+    for people in SIZES:
+        balances = [random_balance(rng, people) for _ in range(repeats)]
+        results = {}
+        for strategy in ("greedy", "exact"):
+            start = time.perf_counter()
+            transfers = [
+                _transfers(calculate_outing_split_with_minimal_transactions(balance, strategy)) for balance in balances
+            ]
+            results[strategy] = (sum(transfers) / repeats, (time.perf_counter() - start) / repeats)
+
+        fallbacks = sum(
+            zero_sum_groups(
+                [p.amount for p in balance.creditors] + [-p.amount for p in balance.debtors],
+                max_people=settings.SETTLEMENT_EXACT_MAX_PEOPLE,
+                time_budget_seconds=settings.SETTLEMENT_EXACT_TIME_BUDGET_SECONDS,
+            )
+            is None
+            for balance in balances
+        )
+        (greedy, greedy_seconds), (exact, exact_seconds) = results["greedy"], results["exact"]
+        print(
+            f"{people:>6} {greedy:>8.1f} {greedy_seconds * 1e3:>8.2f}ms {exact:>8.1f} {exact_seconds * 1e3:>8.2f}ms"
+            f" {fallbacks:>6}/{repeats}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        settings.SETTLEMENT_EXACT_MAX_PEOPLE = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        settings.SETTLEMENT_EXACT_TIME_BUDGET_SECONDS = float(sys.argv[2])
+    main()
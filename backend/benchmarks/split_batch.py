@@ -0,0 +1,61 @@
+"""
+Throughput of the batch split, splitting outings in a single process, and on pools of 1 up to one worker process per
+core.
+
+Outings are random, of 2 to 10 bills with up to 8 items each among 6 people, submitted as parsed JSON like in the
+request. Run from the backend directory with:
+
+    uv run python -m benchmarks.split_batch [outings] [max workers]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("LITELLM_MODEL", "openai/benchmark")
+os.environ.setdefault("LITELLM_API_BASE", "http://localhost")
+os.environ.setdefault("LITELLM_API_KEY", "benchmark")
+
+from app.services.split_pool import SplitPool, split_outings  # noqa: E402
+from tests import examples  # noqa: E402
+
+
+async def _pool_seconds(outings: list, workers: int) -> float:
+    pool = SplitPool(workers=workers)
+    pool.start()
+    try:
+        # Start every worker process before timing
+        await pool.split(outings[: workers * 4])
+        start = time.perf_counter()
+        await pool.split(outings)
+        return time.perf_counter() - start
+    finally:
+        await pool.stop()
+
+
+def main(count: int, max_workers: int) -> None:
+    outings = [
+        examples.random_outings.random_outing(seed, bills=2 + seed % 9, items_per_bill=8, people=6).model_dump()
+        for seed in range(count)
+    ]
+    print(f"{count} outings, {os.process_cpu_count()} cores")
+    print(f"{'workers':>8} {'time':>9} {'outings/s':>10} {'speedup':>8}")
+
+    start = time.perf_counter()
+    split_outings(outings, "greedy")
+    serial_seconds = time.perf_counter() - start
+    print(f"{'serial':>8} {serial_seconds:>8.2f}s {count / serial_seconds:>10.0f} {1:>7.2f}x")
+
+    workers = 1
+    while workers <= max_workers:
+        seconds = asyncio.run(_pool_seconds(outings, workers))
+        print(f"{workers:>8} {seconds:>8.2f}s {count / seconds:>10.0f} {serial_seconds / seconds:>7.2f}x")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main(
+        count=int(sys.argv[1]) if len(sys.argv) > 1 else 5_000,
+        max_workers=int(sys.argv[2]) if len(sys.argv) > 2 else os.process_cpu_count() or 1,
+    )
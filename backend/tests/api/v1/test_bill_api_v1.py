@@ -1,49 +1,46 @@
+import asyncio
+import json
+import time
+from pathlib import Path
 from typing import Iterator
+from unittest.mock import MagicMock
 
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 
-from app.schemas.bill import OCRBill, Outing, OutingSplit
-from app.services.bill import OutingPaymentBalance
+from app.main import app
+from app.schemas.bill import Bill, Item, OCRBatchResult, OCRBill, Outing, OutingSplit, SplitBatchResult
+from app.schemas.ocr_job import OCRJob, OCRJobStatus
+from app.services.admission import AdmissionController, ClientQuota
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.image_preprocessing import image_preprocessor
+from app.services.llm_usage import TokenBudgetExceededError
+from app.services.near_duplicates import near_duplicate_index
+from app.services.ocr_cache import ocr_cache
+from app.services.ocr_engines import LocalOCREngine
 from tests import examples
+from tests.services.test_near_duplicates import build_receipt, encode_jpeg
 
 
 class TestSplit:
-    def mock_calculate_balance(self, monkeypatch: pytest.MonkeyPatch, mock_balance: OutingPaymentBalance):
-        def mock(_: Outing):
-            return mock_balance
-
-        monkeypatch.setattr("app.api.v1.endpoints.bill.calculate_balance", mock)
-
-    def mock_calculate_outing_split_with_minimal_transactions(
-        self, monkeypatch: pytest.MonkeyPatch, mock_split: OutingSplit
-    ):
-        def mock(_: OutingPaymentBalance):
+    def mock_calculate_outing_split(self, monkeypatch: pytest.MonkeyPatch, mock_split: OutingSplit):
+        def mock(_: Outing, strategy: str = "greedy"):
             return mock_split
 
-        monkeypatch.setattr("app.api.v1.endpoints.bill.calculate_outing_split_with_minimal_transactions", mock)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.calculate_outing_split", mock)
 
     @pytest.mark.parametrize(
-        "outing, balance, split",
+        "outing, split",
         [
-            (
-                examples.simple_bill.OUTING,
-                examples.simple_bill.OUTING_PAYMENT_BALANCE,
-                examples.simple_bill.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS,
-            ),
-            (
-                examples.multiple_bills.OUTING,
-                examples.multiple_bills.OUTING_PAYMENT_BALANCE,
-                examples.multiple_bills.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS,
-            ),
+            (examples.simple_bill.OUTING, examples.simple_bill.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS),
+            (examples.multiple_bills.OUTING, examples.multiple_bills.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS),
             (
                 examples.simple_bill_discounted.OUTING,
-                examples.simple_bill_discounted.OUTING_PAYMENT_BALANCE,
                 examples.simple_bill_discounted.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS,
             ),
             (
                 examples.multiple_bills_discounted.OUTING,
-                examples.multiple_bills_discounted.OUTING_PAYMENT_BALANCE,
                 examples.multiple_bills_discounted.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS,
             ),
         ],
@@ -53,16 +50,20 @@ class TestSplit:
         monkeypatch: pytest.MonkeyPatch,
         test_client: TestClient,
         outing: Outing,
-        balance: OutingPaymentBalance,
         split: OutingSplit,
     ):
-        self.mock_calculate_balance(monkeypatch, balance)
-        self.mock_calculate_outing_split_with_minimal_transactions(monkeypatch, split)
+        self.mock_calculate_outing_split(monkeypatch, split)
 
         response = test_client.post("/api/v1/bills/split", json=outing.model_dump())
         assert response.status_code == 200
         assert response.json() == split.model_dump()
 
+    def test_server_timing(self, test_client: TestClient):
+        response = test_client.post("/api/v1/bills/split", json=examples.simple_bill.OUTING.model_dump())
+        assert response.status_code == 200
+        stages = [stage.split(";dur=")[0] for stage in response.headers["Server-Timing"].split(", ")]
+        assert stages == ["parse", "balances", "settlement", "serialize"]
+
     @pytest.mark.parametrize(
         "outing_data, error_response",
         [
@@ -730,16 +731,101 @@ class TestSplit:
         print(response.json())
         assert response.json() == error_response
 
+    def test_exact_strategy(self, test_client: TestClient):
+        # alice is owed 7 by charlie and erin, and bob 3 by dave, which greedy matching settles in 4 payments
+        outing = Outing(
+            bills=[
+                Bill(
+                    paid_by=paid_by,
+                    amount_paid=price,
+                    tax_rate=0,
+                    items=[Item(name="x", price=price, quantity=1, consumed_by=[consumer])],
+                )
+                for paid_by, price, consumer in [("alice", 5, "charlie"), ("alice", 2, "erin"), ("bob", 3, "dave")]
+            ]
+        )
+
+        greedy = test_client.post("/api/v1/bills/split", json=outing.model_dump())
+        exact = test_client.post("/api/v1/bills/split", params={"strategy": "exact"}, json=outing.model_dump())
+
+        assert greedy.status_code == exact.status_code == 200
+        assert sum(len(plan["payments"]) for plan in greedy.json()["payment_plans"]) == 4
+        assert exact.json() == {
+            "payment_plans": [
+                {"name": "charlie", "payments": [{"to": "alice", "amount": 5.0}]},
+                {"name": "erin", "payments": [{"to": "alice", "amount": 2.0}]},
+                {"name": "dave", "payments": [{"to": "bob", "amount": 3.0}]},
+            ]
+        }
+
+        response = test_client.post("/api/v1/bills/split", params={"strategy": "optimal"}, json=outing.model_dump())
+        assert response.status_code == 422
+
+
+class TestSplitBatch:
+    def test_results_in_order(self, test_client: TestClient):
+        valid = [examples.simple_bill, examples.multiple_bills, examples.multiple_bills_discounted]
+        outings = [example.OUTING.model_dump() for example in valid]
+        outings.insert(1, {"bills": []})
+
+        response = test_client.post("/api/v1/bills/split/batch", json=outings)
+
+        assert response.status_code == 200
+        results = [SplitBatchResult.model_validate(result) for result in response.json()]
+        assert [result.split for result in results] == [
+            valid[0].OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS,
+            None,
+            *(example.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS for example in valid[1:]),
+        ]
+        assert results[1].error == "Invalid outing: bills: List should have at least 1 item after validation, not 0"
+
+    def test_exact_strategy(self, test_client: TestClient):
+        outing = examples.multiple_bills.OUTING.model_dump()
+
+        response = test_client.post("/api/v1/bills/split/batch", params={"strategy": "exact"}, json=[outing])
+
+        assert response.json() == [
+            {"split": test_client.post("/api/v1/bills/split?strategy=exact", json=outing).json(), "error": None}
+        ]
+
+    @pytest.mark.parametrize("content", [b"not json", b'{"bills": []}'])
+    def test_not_an_array(self, test_client: TestClient, content: bytes):
+        response = test_client.post(
+            "/api/v1/bills/split/batch", content=content, headers={"Content-Type": "application/json"}
+        )
+
+        assert response.status_code == 422
+        assert response.json() == {"detail": "Invalid request body. Please submit a JSON array of outings."}
+
+    def test_too_many_outings(self, test_client: TestClient, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr("app.api.v1.endpoints.bill.settings.SPLIT_BATCH_MAX_OUTINGS", 2)
+
+        response = test_client.post("/api/v1/bills/split/batch", json=[examples.simple_bill.OUTING.model_dump()] * 3)
+
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Too many outings. Please submit at most 2 outings."}
+
+    def test_documented(self, test_client: TestClient):
+        operation = test_client.get("/openapi.json").json()["paths"]["/api/v1/bills/split/batch"]["post"]
+
+        schema = operation["requestBody"]["content"]["application/json"]["schema"]
+        assert schema == {"type": "array", "items": {"$ref": "#/components/schemas/Outing"}}
+
 
 class TestExtractBillDetailsFromImage:
     success_bill = examples.simple_bill.OCR_BILL
 
     @pytest.fixture
-    def _mock_bill_service_method(self, monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
-        def mock_get_bill_details_from_image(image_bytes: bytes, mime_type: str) -> OCRBill:
+    def tiled_calls(self) -> list[bool]:
+        return []
+
+    @pytest.fixture
+    def _mock_bill_service_method(self, monkeypatch: pytest.MonkeyPatch, tiled_calls: list[bool]) -> Iterator[None]:
+        async def mock_get_bill_details_from_image(image_bytes: bytes, mime_type: str, tiled: bool = False) -> OCRBill:
+            tiled_calls.append(tiled)
             return self.success_bill
 
-        monkeypatch.setattr("app.api.v1.endpoints.bill.get_bill_details_from_image", mock_get_bill_details_from_image)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.aget_bill_details_from_image", mock_get_bill_details_from_image)
         yield None
 
     def test_valid_image_file(self, test_client, _mock_bill_service_method: None):
@@ -749,6 +835,123 @@ class TestExtractBillDetailsFromImage:
         ocr_response = response.text
         assert OCRBill.model_validate_json(ocr_response) == self.success_bill
 
+    def test_tiled(self, test_client, _mock_bill_service_method: None, tiled_calls: list[bool]):
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+        assert test_client.post("/api/v1/bills/ocr", files=files).status_code == 200
+        assert test_client.post("/api/v1/bills/ocr?tiled=true", files=files).status_code == 200
+        assert tiled_calls == [False, True]
+
+    def test_token_budget_exceeded(self, test_client, monkeypatch: pytest.MonkeyPatch):
+        async def mock_get_bill_details_from_image(image_bytes: bytes, mime_type: str, tiled: bool = False) -> OCRBill:
+            raise TokenBudgetExceededError("Daily token budget exceeded.", retry_after=3600)
+
+        monkeypatch.setattr("app.api.v1.endpoints.bill.aget_bill_details_from_image", mock_get_bill_details_from_image)
+
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+        response = test_client.post("/api/v1/bills/ocr", files=files)
+
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "3600"
+        assert response.json() == {"detail": "Daily token budget exceeded."}
+
+    def test_llm_provider_unavailable(self, test_client, monkeypatch: pytest.MonkeyPatch):
+        async def mock_get_bill_details_from_image(image_bytes: bytes, mime_type: str, tiled: bool = False) -> OCRBill:
+            raise CircuitOpenError("The LLM provider is unavailable, please try again later.", retry_after=12)
+
+        monkeypatch.setattr("app.api.v1.endpoints.bill.aget_bill_details_from_image", mock_get_bill_details_from_image)
+
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+        response = test_client.post("/api/v1/bills/ocr", files=files)
+
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "12"
+        assert response.json() == {"detail": "The LLM provider is unavailable, please try again later."}
+
+    @pytest.mark.parametrize(
+        "error, status_code, retry_after",
+        [
+            (CircuitOpenError("The LLM provider is unavailable, please try again later.", retry_after=7), 503, "7"),
+            (TokenBudgetExceededError("Daily token budget exceeded.", retry_after=3600), 429, "3600"),
+        ],
+    )
+    def test_tiled_error(
+        self, test_client, monkeypatch: pytest.MonkeyPatch, error: Exception, status_code: int, retry_after: str
+    ):
+        tiles: list[int] = []
+
+        class FailingTileEngine:
+            model = "failing-tile"
+            prompt_version = "test"
+
+            async def aget_bill_details_from_image(
+                self, image_bytes: bytes, mime_type: str, items_only: bool = False
+            ) -> str:
+                tiles.append(len(image_bytes))
+                if len(tiles) == 2:
+                    raise error
+                await asyncio.sleep(1)
+                return examples.simple_bill.OCR_BILL.model_dump_json()
+
+        monkeypatch.setattr("app.services.bill.ocr_engine", FailingTileEngine())
+        ocr_cache.clear()
+        near_duplicate_index.clear()
+
+        image_bytes = encode_jpeg(build_receipt(seed=3, width=600, height=4000), quality=80)
+        files = {"file": ("receipt.jpg", image_bytes, "image/jpeg")}
+        response = test_client.post("/api/v1/bills/ocr?tiled=true", files=files)
+
+        assert len(tiles) > 1
+        assert response.status_code == status_code
+        assert response.headers["Retry-After"] == retry_after
+        assert response.json() == {"detail": str(error)}
+
+    def test_client_quota(
+        self, test_client, monkeypatch: pytest.MonkeyPatch, tmp_path: Path, _mock_bill_service_method: None
+    ):
+        quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=1, burst=2)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.ocr_client_quota", quota)
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+
+        # Keyed by the address of the client, which a header can not change
+        responses = [
+            test_client.post("/api/v1/bills/ocr", files=files, headers={"X-Client-ID": f"alice-{index}"})
+            for index in range(3)
+        ]
+        with TestClient(app, client=("203.0.113.7", 50000)) as other_test_client:
+            other_client = other_test_client.post("/api/v1/bills/ocr", files=files)
+
+        assert [response.status_code for response in responses] == [200, 200, 429]
+        assert int(responses[2].headers["Retry-After"]) > 0
+        assert responses[2].json() == {"detail": "Request quota exceeded, please try again later."}
+        assert other_client.status_code == 200
+
+    @pytest.mark.anyio
+    async def test_admission_control(self, monkeypatch: pytest.MonkeyPatch):
+        async def mock_get_bill_details_from_image(image_bytes: bytes, mime_type: str, tiled: bool = False) -> OCRBill:
+            await asyncio.sleep(0.2)
+            return self.success_bill
+
+        monkeypatch.setattr("app.api.v1.endpoints.bill.aget_bill_details_from_image", mock_get_bill_details_from_image)
+        controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout_seconds=5)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.ocr_admission", controller)
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+            requests = [asyncio.create_task(client.post("/api/v1/bills/ocr", files=files)) for _ in range(3)]
+            responses = await asyncio.gather(*requests)
+
+        assert sorted(response.status_code for response in responses) == [200, 200, 429]
+        assert controller.stats().rejected_queue_full == 1
+
+    def test_file_too_large(self, test_client, monkeypatch: pytest.MonkeyPatch, _mock_bill_service_method: None):
+        monkeypatch.setattr("app.api.v1.endpoints.bill.settings.OCR_MAX_UPLOAD_BYTES", 8)
+
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+        response = test_client.post("/api/v1/bills/ocr", files=files)
+
+        assert response.status_code == 413
+        assert response.json() == {"detail": "File too large. Please upload a smaller image."}
+
     @pytest.mark.parametrize(
         "files, status_code, error_response",
         [
@@ -777,3 +980,449 @@ class TestExtractBillDetailsFromImage:
         assert response.status_code == status_code
         print(response.json())
         assert response.json() == error_response
+
+
+class TestExtractBillDetailsFromImageWithLocalEngine:
+    @pytest.fixture(autouse=True)
+    def _local_engine(self, monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Iterator[None]:
+        (tmp_path / "simple.jpg").write_bytes(encode_jpeg(build_receipt(seed=1), quality=90))
+        (tmp_path / "simple.json").write_text(examples.simple_bill.OCR_BILL.model_dump_json())
+        monkeypatch.setattr(
+            "app.services.bill.ocr_engine", LocalOCREngine(tmp_path, image_preprocessor, latency_seconds=0.01)
+        )
+        ocr_cache.clear()
+        near_duplicate_index.clear()
+        yield None
+        ocr_cache.clear()
+        near_duplicate_index.clear()
+
+    def test_fixture_is_extracted_without_network(self, test_client):
+        image_bytes = encode_jpeg(build_receipt(seed=1), quality=70)
+
+        response = test_client.post("/api/v1/bills/ocr", files={"file": ("receipt.jpg", image_bytes, "image/jpeg")})
+
+        assert response.status_code == 200
+        assert OCRBill.model_validate(response.json()) == examples.simple_bill.OCR_BILL
+        stages = [stage.split(";dur=")[0] for stage in response.headers["Server-Timing"].split(", ")]
+        assert stages == ["queue", "parse", "ocr_validation", "serialize"]
+
+    def test_unknown_receipt_is_extracted_as_a_synthetic_bill(self, test_client):
+        image_bytes = encode_jpeg(build_receipt(seed=5), quality=70)
+
+        responses = [
+            test_client.post("/api/v1/bills/ocr", files={"file": ("receipt.jpg", image_bytes, "image/jpeg")})
+            for _ in range(2)
+        ]
+
+        assert [response.status_code for response in responses] == [200, 200]
+        assert responses[0].json() == responses[1].json()
+        assert OCRBill.model_validate(responses[0].json()) != examples.simple_bill.OCR_BILL
+
+
+class TestStreamBillDetailsFromImage:
+    success_bill = examples.simple_bill.OCR_BILL
+
+    @pytest.fixture
+    def _mock_bill_service_method(self, monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+        async def mock_stream_bill_details_from_image(image_bytes: bytes, mime_type: str):
+            for item in self.success_bill.items:
+                yield item
+            if image_bytes == b"unreadable":
+                raise ValueError("No content in LiteLLM response")
+            yield self.success_bill
+
+        monkeypatch.setattr(
+            "app.api.v1.endpoints.bill.astream_bill_details_from_image", mock_stream_bill_details_from_image
+        )
+        yield None
+
+    def stream_events(self, test_client: TestClient, image_bytes: bytes) -> list[tuple[str, dict]]:
+        files = {"file": ("test_image.png", image_bytes, "image/png")}
+        with test_client.stream("POST", "/api/v1/bills/ocr/stream", files=files) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            lines = [line for line in response.iter_lines() if line]
+        return [
+            (event.removeprefix("event: "), json.loads(data.removeprefix("data: ")))
+            for event, data in zip(lines[::2], lines[1::2])
+        ]
+
+    def test_items_then_totals(self, test_client: TestClient, _mock_bill_service_method: None):
+        events = self.stream_events(test_client, b"dummy image content")
+
+        assert events == [
+            *(("item", item.model_dump()) for item in self.success_bill.items),
+            ("totals", {"tax_rate": 0.05, "service_charge": 0.1, "amount_paid": 1207.5}),
+        ]
+
+    def test_error(self, test_client: TestClient, _mock_bill_service_method: None):
+        events = self.stream_events(test_client, b"unreadable")
+
+        assert [event for event, _ in events] == ["item"] * len(self.success_bill.items) + ["error"]
+        assert events[-1][1] == {"detail": "Could not extract bill details: No content in LiteLLM response"}
+
+    @pytest.mark.parametrize(
+        "error, status_code, retry_after",
+        [
+            (CircuitOpenError("The LLM provider is unavailable, please try again later.", retry_after=7), 503, "7"),
+            (TokenBudgetExceededError("Daily token budget exceeded.", retry_after=3600), 429, "3600"),
+        ],
+    )
+    def test_unavailable_llm(
+        self,
+        test_client: TestClient,
+        monkeypatch: pytest.MonkeyPatch,
+        error: Exception,
+        status_code: int,
+        retry_after: str,
+    ):
+        async def mock_stream_bill_details_from_image(image_bytes: bytes, mime_type: str):
+            raise error
+            yield
+
+        monkeypatch.setattr(
+            "app.api.v1.endpoints.bill.astream_bill_details_from_image", mock_stream_bill_details_from_image
+        )
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+
+        response = test_client.post("/api/v1/bills/ocr/stream", files=files)
+
+        assert response.status_code == status_code
+        assert response.headers["Retry-After"] == retry_after
+        assert response.json() == {"detail": str(error)}
+
+    def test_invalid_file_type(self, test_client: TestClient):
+        files = {"file": ("notes.txt", b"notes", "text/plain")}
+
+        response = test_client.post("/api/v1/bills/ocr/stream", files=files)
+
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Invalid file type. Please upload an image file."}
+
+    def test_client_quota(
+        self, test_client: TestClient, monkeypatch: pytest.MonkeyPatch, tmp_path: Path, _mock_bill_service_method: None
+    ):
+        quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=1, burst=1)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.ocr_client_quota", quota)
+
+        self.stream_events(test_client, b"dummy image content")
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+        response = test_client.post("/api/v1/bills/ocr/stream", files=files)
+
+        assert response.status_code == 429
+        assert response.json() == {"detail": "Request quota exceeded, please try again later."}
+
+    def test_admission_slot_is_held_while_streaming(self, test_client: TestClient, monkeypatch: pytest.MonkeyPatch):
+        controller = AdmissionController(max_in_flight=1, max_queued=0, queue_timeout_seconds=5)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.ocr_admission", controller)
+        in_flight: list[int] = []
+
+        async def mock_stream_bill_details_from_image(image_bytes: bytes, mime_type: str):
+            for item in self.success_bill.items:
+                in_flight.append(controller.stats().in_flight)
+                yield item
+            yield self.success_bill
+
+        monkeypatch.setattr(
+            "app.api.v1.endpoints.bill.astream_bill_details_from_image", mock_stream_bill_details_from_image
+        )
+
+        self.stream_events(test_client, b"dummy image content")
+
+        assert in_flight == [1] * len(self.success_bill.items)
+        assert controller.stats().in_flight == 0
+
+
+class TestExtractBillDetailsFromImageConcurrency:
+    llm_latency = 0.5
+
+    @pytest.fixture
+    def _mock_slow_llm(self, monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+        llm_success_response_text = examples.simple_bill.OCR_BILL.model_dump_json()
+
+        async def mock_acompletion(**_):
+            await asyncio.sleep(self.llm_latency)
+            return MagicMock(choices=[MagicMock(message=MagicMock(content=llm_success_response_text))])
+
+        monkeypatch.setattr("app.services.litellm_service.acompletion", mock_acompletion)
+        yield None
+
+    @pytest.mark.anyio
+    async def test_split_latency_stays_flat_while_ocr_is_in_flight(self, _mock_slow_llm: None):
+        outing = examples.multiple_bills.OUTING.model_dump()
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+
+            async def timed_split() -> float:
+                start = time.perf_counter()
+                response = await client.post("/api/v1/bills/split", json=outing)
+                assert response.status_code == 200
+                return time.perf_counter() - start
+
+            idle_latency = await timed_split()
+
+            ocr_requests = [
+                asyncio.create_task(
+                    client.post("/api/v1/bills/ocr", files={"file": (f"{i}.png", f"image {i}".encode(), "image/png")})
+                )
+                for i in range(4)
+            ]
+            # Give the OCR requests time to reach the (mocked) provider call
+            await asyncio.sleep(0.1)
+            loaded_latencies = [await timed_split() for _ in range(3)]
+            ocr_responses = await asyncio.gather(*ocr_requests)
+
+        assert all(response.status_code == 200 for response in ocr_responses)
+        assert max(loaded_latencies) < idle_latency + self.llm_latency / 2
+
+
+class TestExtractBillDetailsFromImages:
+    success_bill = examples.simple_bill.OCR_BILL
+    llm_latency = 0.2
+
+    @pytest.fixture
+    def concurrency(self, monkeypatch: pytest.MonkeyPatch) -> Iterator[list[int]]:
+        """Mock the bill service, and record how many extractions were in flight at the same time."""
+        in_flight = [0]
+        max_in_flight = [0]
+
+        async def mock_get_bill_details_from_image(image_bytes: bytes, mime_type: str) -> OCRBill:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            try:
+                await asyncio.sleep(self.llm_latency)
+                if image_bytes == b"unreadable":
+                    raise ValueError("No content in LiteLLM response")
+                return self.success_bill
+            finally:
+                in_flight[0] -= 1
+
+        monkeypatch.setattr("app.api.v1.endpoints.bill.aget_bill_details_from_image", mock_get_bill_details_from_image)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.settings.OCR_BATCH_CONCURRENCY", 3)
+        yield max_in_flight
+
+    def test_results_in_order_with_per_file_errors(self, test_client: TestClient, concurrency: list[int]):
+        files = [
+            ("files", ("first.png", b"first", "image/png")),
+            ("files", ("notes.txt", b"notes", "text/plain")),
+            ("files", ("unreadable.jpg", b"unreadable", "image/jpeg")),
+            ("files", ("last.png", b"last", "image/png")),
+        ]
+
+        response = test_client.post("/api/v1/bills/ocr/batch", files=files)
+
+        assert response.status_code == 200
+        results = [OCRBatchResult.model_validate(result) for result in response.json()]
+        assert [result.filename for result in results] == ["first.png", "notes.txt", "unreadable.jpg", "last.png"]
+        assert results[0].bill == results[3].bill == self.success_bill
+        assert results[1].bill is None
+        assert results[1].error == "Invalid file type. Please upload an image file."
+        assert results[2].bill is None
+        assert results[2].error == "Could not extract bill details: No content in LiteLLM response"
+
+    def test_concurrency_is_bounded(self, test_client: TestClient, concurrency: list[int]):
+        files = [("files", (f"{i}.png", f"image {i}".encode(), "image/png")) for i in range(6)]
+
+        start = time.perf_counter()
+        response = test_client.post("/api/v1/bills/ocr/batch", files=files)
+        elapsed = time.perf_counter() - start
+
+        assert response.status_code == 200
+        assert all(result["bill"] is not None for result in response.json())
+        assert concurrency[0] == 3
+        # Two rounds of three concurrent extractions, instead of six sequential ones
+        assert elapsed < 4 * self.llm_latency
+
+    def test_too_many_files(self, test_client: TestClient, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr("app.api.v1.endpoints.bill.settings.OCR_BATCH_MAX_FILES", 1)
+        files = [("files", (f"{i}.png", b"image", "image/png")) for i in range(2)]
+
+        response = test_client.post("/api/v1/bills/ocr/batch", files=files)
+
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Too many files. Please upload at most 1 images."}
+
+    def test_client_quota_is_taken_per_file(
+        self, test_client: TestClient, monkeypatch: pytest.MonkeyPatch, tmp_path: Path, concurrency: list[int]
+    ):
+        quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=1, burst=3)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.ocr_client_quota", quota)
+        files = [("files", (f"{i}.png", b"image", "image/png")) for i in range(2)]
+
+        responses = [test_client.post("/api/v1/bills/ocr/batch", files=files) for _ in range(2)]
+
+        assert [response.status_code for response in responses] == [200, 429]
+        assert responses[1].json() == {"detail": "Request quota exceeded, please try again later."}
+
+    def test_files_hold_ocr_slots(
+        self, test_client: TestClient, monkeypatch: pytest.MonkeyPatch, concurrency: list[int]
+    ):
+        controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout_seconds=5)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.ocr_admission", controller)
+        files = [("files", (f"{i}.png", b"image", "image/png")) for i in range(3)]
+
+        response = test_client.post("/api/v1/bills/ocr/batch", files=files)
+
+        assert response.status_code == 200
+        results = [OCRBatchResult.model_validate(result) for result in response.json()]
+        assert concurrency[0] == 1
+        # One file is extracted, one waits for its slot, and the queue is full for the third
+        assert sum(result.bill is not None for result in results) == 2
+        assert [result.error for result in results if result.bill is None] == [
+            "Too many requests, please try again later."
+        ]
+
+
+class TestOCRJobs:
+    success_bill = examples.simple_bill.OCR_BILL
+
+    @pytest.fixture
+    def _mock_bill_service_method(self, monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+        async def mock_get_bill_details_from_image(image_bytes: bytes, mime_type: str) -> OCRBill:
+            if image_bytes == b"unreadable":
+                raise ValueError("No content in LiteLLM response")
+            return self.success_bill
+
+        monkeypatch.setattr("app.services.ocr_jobs.aget_bill_details_from_image", mock_get_bill_details_from_image)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.settings.OCR_JOB_POLL_INTERVAL_SECONDS", 0.05)
+        yield None
+
+    def wait_for_job(self, test_client: TestClient, job_id: str) -> OCRJob:
+        for _ in range(100):
+            response = test_client.get(f"/api/v1/bills/ocr/jobs/{job_id}")
+            assert response.status_code == 200
+            job = OCRJob.model_validate(response.json())
+            if job.is_finished:
+                return job
+            time.sleep(0.05)
+        raise TimeoutError(f"OCR job {job_id} did not finish")
+
+    def test_submit_and_poll(self, test_client: TestClient, _mock_bill_service_method: None):
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+
+        response = test_client.post("/api/v1/bills/ocr/jobs", files=files)
+
+        assert response.status_code == 202
+        submitted = OCRJob.model_validate(response.json())
+        assert submitted.status == OCRJobStatus.PENDING
+        job = self.wait_for_job(test_client, submitted.id)
+        assert job.status == OCRJobStatus.SUCCEEDED
+        assert job.result == self.success_bill
+
+    def test_failed_job(self, test_client: TestClient, _mock_bill_service_method: None):
+        files = {"file": ("test_image.png", b"unreadable", "image/png")}
+
+        response = test_client.post("/api/v1/bills/ocr/jobs", files=files)
+
+        job = self.wait_for_job(test_client, response.json()["id"])
+        assert job.status == OCRJobStatus.FAILED
+        assert job.error == "Could not extract bill details: No content in LiteLLM response"
+
+    def test_events(self, test_client: TestClient, _mock_bill_service_method: None):
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+        job_id = test_client.post("/api/v1/bills/ocr/jobs", files=files).json()["id"]
+
+        with test_client.stream("GET", f"/api/v1/bills/ocr/jobs/{job_id}/events") as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            events = [line.removeprefix("data: ") for line in response.iter_lines() if line.startswith("data: ")]
+
+        jobs = [OCRJob.model_validate_json(event) for event in events]
+        assert jobs[-1].status == OCRJobStatus.SUCCEEDED
+        assert jobs[-1].result == self.success_bill
+        # Only status changes are sent
+        assert len({job.status for job in jobs}) == len(jobs)
+
+    def test_invalid_file_type(self, test_client: TestClient):
+        files = {"file": ("notes.txt", b"notes", "text/plain")}
+
+        response = test_client.post("/api/v1/bills/ocr/jobs", files=files)
+
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Invalid file type. Please upload an image file."}
+
+    def test_client_quota(
+        self, test_client: TestClient, monkeypatch: pytest.MonkeyPatch, tmp_path: Path, _mock_bill_service_method: None
+    ):
+        quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=1, burst=1)
+        monkeypatch.setattr("app.api.v1.endpoints.bill.ocr_client_quota", quota)
+        files = {"file": ("test_image.png", b"dummy image content", "image/png")}
+
+        responses = [test_client.post("/api/v1/bills/ocr/jobs", files=files) for _ in range(2)]
+
+        assert [response.status_code for response in responses] == [202, 429]
+        assert responses[1].json() == {"detail": "Request quota exceeded, please try again later."}
+        assert self.wait_for_job(test_client, responses[0].json()["id"]).status == OCRJobStatus.SUCCEEDED
+
+    @pytest.mark.parametrize("path", ["/api/v1/bills/ocr/jobs/unknown", "/api/v1/bills/ocr/jobs/unknown/events"])
+    def test_unknown_job(self, test_client: TestClient, path: str):
+        response = test_client.get(path)
+
+        assert response.status_code == 404
+        assert response.json() == {"detail": "OCR job not found."}
+
+
+class TestOutings:
+    def test_edit_and_split(self, test_client: TestClient):
+        bills = [bill.model_dump() for bill in examples.multiple_bills.OUTING.bills]
+
+        response = test_client.post("/api/v1/bills/outings", json={"bills": bills[:1]})
+        assert response.status_code == 201
+        outing_id = response.json()["id"]
+        for bill in bills[1:]:
+            response = test_client.post(f"/api/v1/bills/outings/{outing_id}/bills", json=bill)
+            assert response.status_code == 201
+
+        response = test_client.get(f"/api/v1/bills/outings/{outing_id}/split")
+        assert response.status_code == 200
+        assert (
+            OutingSplit.model_validate(response.json())
+            == examples.multiple_bills.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS
+        )
+
+        response = test_client.patch(f"/api/v1/bills/outings/{outing_id}/bills/0", json={"paid_by": "Dave"})
+        assert response.status_code == 200
+        assert response.json() == {**bills[0], "paid_by": "dave", "id": 0}
+
+        response = test_client.delete(f"/api/v1/bills/outings/{outing_id}/bills/1")
+        assert response.status_code == 204
+
+        response = test_client.get(f"/api/v1/bills/outings/{outing_id}")
+        assert response.status_code == 200
+        assert [bill["id"] for bill in response.json()["bills"]] == [0, *range(2, len(bills))]
+        outing = Outing(bills=[Bill.model_validate(bill) for bill in response.json()["bills"]])
+        response = test_client.get(f"/api/v1/bills/outings/{outing_id}/split", params={"strategy": "exact"})
+        assert (
+            response.json()
+            == test_client.post("/api/v1/bills/split", params={"strategy": "exact"}, json=outing.model_dump()).json()
+        )
+
+    def test_invalid_bill_update(self, test_client: TestClient):
+        bill = examples.simple_bill.OUTING.bills[0].model_dump()
+        outing_id = test_client.post("/api/v1/bills/outings", json={"bills": [bill]}).json()["id"]
+
+        response = test_client.patch(f"/api/v1/bills/outings/{outing_id}/bills/0", json={"items": []})
+
+        assert response.status_code == 422
+        assert test_client.get(f"/api/v1/bills/outings/{outing_id}").json()["bills"] == [{**bill, "id": 0}]
+
+    @pytest.mark.parametrize(
+        "method, path, json, detail",
+        [
+            ("GET", "/api/v1/bills/outings/unknown", None, "Outing not found."),
+            ("GET", "/api/v1/bills/outings/unknown/split", None, "Outing not found."),
+            (
+                "POST",
+                "/api/v1/bills/outings/unknown/bills",
+                examples.simple_bill.OUTING.bills[0].model_dump(),
+                "Outing not found.",
+            ),
+            ("PATCH", "/api/v1/bills/outings/unknown/bills/0", {"amount_paid": 1.0}, "Bill not found."),
+            ("DELETE", "/api/v1/bills/outings/unknown/bills/0", None, "Bill not found."),
+        ],
+    )
+    def test_unknown_outing(self, test_client: TestClient, method: str, path: str, json: dict | None, detail: str):
+        response = test_client.request(method, path, json=json)
+
+        assert response.status_code == 404
+        assert response.json() == {"detail": detail}
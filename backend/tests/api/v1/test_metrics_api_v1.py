@@ -0,0 +1,65 @@
+from tests import examples
+
+
+def test_metrics(test_client):
+    response = test_client.get("/api/v1/metrics/")
+    assert response.status_code == 200
+    assert set(response.json()["ocr_cache"]) == {"enabled", "memory_hits", "disk_hits", "misses", "memory_entries"}
+
+
+def test_llm_http_pool_metrics(test_client):
+    response = test_client.get("/api/v1/metrics/")
+    assert response.status_code == 200
+    llm_http_pool = response.json()["llm_http_pool"]
+    # The pool is created when the app starts
+    assert llm_http_pool["started"] is True
+    assert {"requests", "requests_waiting", "connections_open", "connections_reused"} <= set(llm_http_pool)
+
+
+def test_ocr_single_flight_metrics(test_client):
+    response = test_client.get("/api/v1/metrics/")
+    assert response.status_code == 200
+    assert set(response.json()["ocr_single_flight"]) == {"in_flight", "calls", "coalesced"}
+
+
+def test_ocr_near_duplicates_metrics(test_client):
+    response = test_client.get("/api/v1/metrics/")
+    assert response.status_code == 200
+    assert set(response.json()["ocr_near_duplicates"]) == {"enabled", "entries", "lookups", "hits"}
+
+
+def test_ocr_hedging_metrics(test_client):
+    response = test_client.get("/api/v1/metrics/")
+    assert response.status_code == 200
+    assert set(response.json()["ocr_hedging"]) == {"enabled", "delay_seconds", "requests", "hedged", "decisions"}
+
+
+def test_llm_usage_metrics(test_client):
+    response = test_client.get("/api/v1/metrics/")
+    assert response.status_code == 200
+    assert set(response.json()["llm_usage"]) == {"models", "budget"}
+
+
+def test_circuit_breaker_metrics(test_client):
+    response = test_client.get("/api/v1/metrics/")
+    assert response.status_code == 200
+    assert set(response.json()["llm_retry_budget"]) == {"tokens", "retries", "exhausted"}
+    for breaker in response.json()["llm_circuit_breakers"].values():
+        assert breaker["state"] in {"closed", "open", "half_open"}
+
+
+def test_admission_metrics(test_client):
+    response = test_client.get("/api/v1/metrics/")
+    assert response.status_code == 200
+    assert response.json()["ocr_admission"]["in_flight"] == 0
+    assert set(response.json()["ocr_client_quota"]) == {"requests_per_minute", "burst", "rejected"}
+
+
+def test_stage_timing_metrics(test_client):
+    test_client.post("/api/v1/bills/split", json=examples.simple_bill.OUTING.model_dump())
+    response = test_client.get("/api/v1/metrics/")
+    assert response.status_code == 200
+    stage_timing = response.json()["stage_timing"]
+    assert stage_timing["enabled"] is True
+    assert {"parse", "balances", "settlement", "serialize"} <= set(stage_timing["stages"])
+    assert set(stage_timing["stages"]["settlement"]) == {"count", "total_seconds", "max_seconds"}
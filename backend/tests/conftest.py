@@ -1,8 +1,10 @@
 import os
+import tempfile
 
 os.environ.setdefault("LITELLM_MODEL", "gemini/gemini-2.5-flash")
 os.environ.setdefault("LITELLM_API_BASE", "https://proxy.clanker.ai")
 os.environ.setdefault("LITELLM_API_KEY", "clanker123")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bill-splitter-tests-"))
 
 
 def pytest_configure(config):
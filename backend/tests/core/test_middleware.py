@@ -0,0 +1,144 @@
+import tempfile
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from app.core.middleware import LLMUsageMiddleware, RequestSizeLimitMiddleware, StageTimingMiddleware
+from app.services.llm_usage import LLMUsageTracker, TokenBudget, _client_id
+from app.services.stage_timing import StageTiming
+
+
+@pytest.fixture
+def test_client() -> TestClient:
+    app = FastAPI()
+    app.add_middleware(RequestSizeLimitMiddleware, limits={"/limited": 10})  # type: ignore
+
+    @app.post("/limited")
+    @app.post("/unlimited")
+    async def echo(request: Request) -> int:
+        return len(await request.body())
+
+    return TestClient(app)
+
+
+class TestRequestSizeLimitMiddleware:
+    def test_within_limit(self, test_client: TestClient):
+        response = test_client.post("/limited", content=b"0123456789")
+        assert response.status_code == 200
+        assert response.json() == 10
+
+    def test_content_length_above_limit(self, test_client: TestClient):
+        response = test_client.post("/limited", content=b"0123456789!")
+        assert response.status_code == 413
+        assert response.json() == {"detail": "Request too large. Please upload a smaller image."}
+
+    def test_streamed_body_above_limit(self, test_client: TestClient):
+        def body():
+            yield b"01234"
+            yield b"56789"
+            yield b"!"
+
+        # A generator body is sent with chunked transfer encoding, without a Content-Length
+        response = test_client.post("/limited", content=body())
+        assert response.status_code == 413
+        assert response.json() == {"detail": "Request too large. Please upload a smaller image."}
+
+    def test_other_paths_are_not_limited(self, test_client: TestClient):
+        response = test_client.post("/unlimited", content=b"0123456789!")
+        assert response.status_code == 200
+        assert response.json() == 11
+
+
+class TestLLMUsageMiddleware:
+    @pytest.fixture
+    def test_client(self) -> TestClient:
+        app = FastAPI()
+        app.add_middleware(LLMUsageMiddleware)  # type: ignore
+        tracker = LLMUsageTracker(
+            TokenBudget(Path(tempfile.mkdtemp()) / "usage.sqlite3", None, None, exceeded_action="reject")
+        )
+
+        @app.get("/calls/{count}")
+        async def make_calls(count: int) -> str | None:
+            for _ in range(count):
+                response = MagicMock(usage=MagicMock(prompt_tokens=1000, completion_tokens=100))
+                tracker.record("gemini/gemini-2.5-flash", response, image_bytes=2048, latency_seconds=0.25)
+            return _client_id.get()
+
+        return TestClient(app)
+
+    def test_usage_headers(self, test_client: TestClient):
+        response = test_client.get("/calls/2")
+
+        assert response.status_code == 200
+        assert response.headers["X-LLM-Calls"] == "2"
+        assert response.headers["X-LLM-Prompt-Tokens"] == "2000"
+        assert response.headers["X-LLM-Completion-Tokens"] == "200"
+        assert response.headers["X-LLM-Latency-Ms"] == "500"
+        assert float(response.headers["X-LLM-Cost-USD"]) > 0
+
+    def test_no_headers_without_calls(self, test_client: TestClient):
+        response = test_client.get("/calls/0")
+
+        assert response.status_code == 200
+        assert "X-LLM-Calls" not in response.headers
+
+    def test_client_id(self, test_client: TestClient):
+        assert test_client.get("/calls/0").json() == "testclient"
+        # A header set by the client does not make it another client
+        assert test_client.get("/calls/0", headers={"X-Client-ID": "alice"}).json() == "testclient"
+
+
+class TestStageTimingMiddleware:
+    @staticmethod
+    def _test_client(timing: StageTiming) -> TestClient:
+        app = FastAPI()
+        app.add_middleware(StageTimingMiddleware, timing=timing)  # type: ignore
+
+        @app.get("/split")
+        @timing.endpoint
+        async def split() -> dict[str, int]:
+            with timing.stage("balances"):
+                pass
+            with timing.stage("settlement"):
+                pass
+            return {"payments": 0}
+
+        @app.get("/health")
+        async def health() -> str:
+            return "healthy"
+
+        return TestClient(app)
+
+    def test_server_timing_header(self):
+        timing = StageTiming(enabled=True)
+        response = self._test_client(timing).get("/split")
+
+        assert response.status_code == 200
+        assert response.json() == {"payments": 0}
+        stages = [stage.split(";dur=") for stage in response.headers["Server-Timing"].split(", ")]
+        assert [name for name, _ in stages] == ["parse", "balances", "settlement", "serialize"]
+        assert all(float(duration) >= 0 for _, duration in stages)
+        assert {name: stats.count for name, stats in timing.stats().stages.items()} == {
+            "parse": 1,
+            "balances": 1,
+            "settlement": 1,
+            "serialize": 1,
+        }
+
+    def test_no_header_without_stages(self):
+        response = self._test_client(StageTiming(enabled=True)).get("/health")
+
+        assert response.status_code == 200
+        assert "Server-Timing" not in response.headers
+
+    def test_disabled(self):
+        timing = StageTiming(enabled=False)
+        response = self._test_client(timing).get("/split")
+
+        assert response.status_code == 200
+        assert "Server-Timing" not in response.headers
+        assert timing.stats().stages == {}
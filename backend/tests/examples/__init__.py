@@ -1 +1 @@
-from . import simple_bill, multiple_bills, simple_bill_discounted, multiple_bills_discounted
+from . import simple_bill, multiple_bills, simple_bill_discounted, multiple_bills_discounted, random_outings
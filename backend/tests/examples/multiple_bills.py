@@ -44,11 +44,11 @@ OUTING = Outing(
 
 OUTING_PAYMENT_BALANCE = OutingPaymentBalance(
     creditors=[
-        PersonBalance(name="bob", amount=360),
-        PersonBalance(name="alice", amount=315),
+        PersonBalance(name="bob", amount=36000),
+        PersonBalance(name="alice", amount=31500),
     ],
     debtors=[
-        PersonBalance(name="charlie", amount=675),
+        PersonBalance(name="charlie", amount=67500),
     ],
 )
 
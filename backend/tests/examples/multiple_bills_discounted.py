@@ -44,11 +44,11 @@ OUTING = Outing(
 
 OUTING_PAYMENT_BALANCE = OutingPaymentBalance(
     creditors=[
-        PersonBalance(name="bob", amount=293.33),
-        PersonBalance(name="alice", amount=253.33),
+        PersonBalance(name="bob", amount=29333),
+        PersonBalance(name="alice", amount=25333),
     ],
     debtors=[
-        PersonBalance(name="charlie", amount=546.67),
+        PersonBalance(name="charlie", amount=54666),  # Balances sum to zero
     ],
 )
 
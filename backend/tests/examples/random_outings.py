@@ -0,0 +1,39 @@
+# Randomly generated outings of any size, for property tests and benchmarks
+
+import random
+
+from app.schemas.bill import Bill, Item, Outing
+
+
+def random_outing(seed: int, bills: int, items_per_bill: int, people: int) -> Outing:
+    """
+    Generate an outing where random people pay for bills of random items, each one shared by a few random people.
+    Some bills are discounted, and tax rates and service charges vary between bills.
+    """
+    rng = random.Random(seed)
+    names = [f"person{index}" for index in range(people)]
+
+    outing_bills = []
+    for _ in range(bills):
+        items = [
+            Item(
+                name=f"item{index}",
+                price=rng.randint(50, 5000) / 100,
+                quantity=rng.randint(1, 4),
+                consumed_by=rng.sample(names, rng.randint(1, min(people, 6))),
+            )
+            for index in range(rng.randint(1, items_per_bill))
+        ]
+        tax_rate = rng.choice([0.0, 0.05, 0.08, 0.18])
+        service_charge = rng.choice([0.0, 0.1, 0.125])
+        total = sum(item.price * item.quantity for item in items) * (1 + tax_rate + service_charge)
+        outing_bills.append(
+            Bill(
+                paid_by=rng.choice(names),
+                items=items,
+                tax_rate=tax_rate,
+                service_charge=service_charge,
+                amount_paid=round(total * rng.choice([1.0, 1.0, 0.9, 0.75]), 2),
+            )
+        )
+    return Outing(bills=outing_bills)
@@ -58,8 +58,8 @@ OUTING = Outing(
 )
 
 OUTING_PAYMENT_BALANCE = OutingPaymentBalance(
-    creditors=[PersonBalance(name="bob", amount=891.25)],
-    debtors=[PersonBalance(name="charlie", amount=575), PersonBalance(name="alice", amount=316.25)],
+    creditors=[PersonBalance(name="bob", amount=89125)],
+    debtors=[PersonBalance(name="charlie", amount=57500), PersonBalance(name="alice", amount=31625)],
 )
 
 OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS = OutingSplit(
@@ -34,19 +34,21 @@ OUTING = Outing(
     ]
 )
 
+# The 1000 paid is shared as 571.43 for the pizza, 142.86 for the coke and 285.71 for the ice cream, and the leftover
+# cents of the pizza and coke go to the first of their consumers
 OUTING_PAYMENT_BALANCE = OutingPaymentBalance(
     creditors=[
-        PersonBalance(name="bob", amount=738.10),
+        PersonBalance(name="bob", amount=73809),
     ],
     debtors=[
-        PersonBalance(name="charlie", amount=476.19),
-        PersonBalance(name="alice", amount=261.90),
+        PersonBalance(name="charlie", amount=47618),
+        PersonBalance(name="alice", amount=26191),
     ],
 )
 
 OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS = OutingSplit(
     payment_plans=[
-        PaymentPlan(name="charlie", payments=[Payment(to="bob", amount=476.19)]),
-        PaymentPlan(name="alice", payments=[Payment(to="bob", amount=261.90)]),
+        PaymentPlan(name="charlie", payments=[Payment(to="bob", amount=476.18)]),
+        PaymentPlan(name="alice", payments=[Payment(to="bob", amount=261.91)]),
     ]
 )
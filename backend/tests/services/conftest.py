@@ -0,0 +1,109 @@
+import socketserver
+import threading
+from collections.abc import Iterator
+
+import pytest
+
+
+class RedisStandInHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough of the Redis protocol for the services under test, keeping data in memory."""
+
+    def read_command(self) -> list[bytes] | None:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line.startswith(b"*")
+        command = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+    def write_reply(self, reply) -> None:
+        if reply is None:
+            self.wfile.write(b"$-1\r\n")
+        elif isinstance(reply, str):
+            self.wfile.write(f"+{reply}\r\n".encode())
+        elif isinstance(reply, int):
+            self.wfile.write(f":{reply}\r\n".encode())
+        elif isinstance(reply, bytes):
+            self.wfile.write(b"$%d\r\n%s\r\n" % (len(reply), reply))
+        elif isinstance(reply, list):
+            self.wfile.write(f"*{len(reply)}\r\n".encode())
+            for item in reply:
+                self.write_reply(item)
+
+    def handle(self) -> None:
+        while (command := self.read_command()) is not None:
+            with self.server.lock:  # type: ignore
+                try:
+                    reply = self.execute(self.server.data, command[0].decode().upper(), *command[1:])  # type: ignore
+                except KeyError as e:
+                    self.wfile.write(f"-ERR unknown command {e}\r\n".encode())
+                    continue
+            self.write_reply(reply)
+
+    @staticmethod
+    def execute(data: dict, name: str, *args: bytes):
+        match name:
+            case "PING" | "SELECT" | "AUTH":
+                return "OK" if name != "PING" else "PONG"
+            case "SET":
+                data[args[0]] = args[1]
+                return "OK"
+            case "GET":
+                return data.get(args[0])
+            case "DEL":
+                return sum(data.pop(key, None) is not None for key in args)
+            case "EXPIRE":
+                return int(args[0] in data)
+            case "HSET":
+                fields = data.setdefault(args[0], {})
+                new = sum(field not in fields for field in args[1::2])
+                fields.update(zip(args[1::2], args[2::2]))
+                return new
+            case "HDEL":
+                fields = data.get(args[0], {})
+                return sum(fields.pop(field, None) is not None for field in args[1:])
+            case "HGETALL":
+                return [item for pair in data.get(args[0], {}).items() for item in pair]
+            case "LPUSH" | "RPUSH":
+                items = data.setdefault(args[0], [])
+                for value in args[1:]:
+                    items.insert(0, value) if name == "LPUSH" else items.append(value)
+                return len(items)
+            case "LMOVE":
+                source, destination, where_from, where_to = args
+                items = data.get(source, [])
+                if not items:
+                    return None
+                value = items.pop() if where_from.upper() == b"RIGHT" else items.pop(0)
+                target = data.setdefault(destination, [])
+                target.insert(0, value) if where_to.upper() == b"LEFT" else target.append(value)
+                return value
+            case "LREM":
+                items = data.get(args[0], [])
+                removed = items.count(args[2])
+                data[args[0]] = [item for item in items if item != args[2]]
+                return removed
+            case "LRANGE":
+                items = data.get(args[0], [])
+                stop = int(args[2])
+                return items[int(args[1]) : None if stop == -1 else stop + 1]
+        raise KeyError(name)
+
+
+@pytest.fixture
+def redis_url() -> Iterator[str]:
+    """URL of a local Redis stand-in, running in a background thread for the duration of the test."""
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), RedisStandInHandler)
+    server.daemon_threads = True
+    server.data = {}  # type: ignore
+    server.lock = threading.Lock()  # type: ignore
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"redis://127.0.0.1:{server.server_address[1]}/0"
+
+    server.shutdown()
+    server.server_close()
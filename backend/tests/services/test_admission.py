@@ -0,0 +1,139 @@
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+
+from app.services.admission import AdmissionController, AdmissionRejectedError, ClientQuota
+
+
+class TestAdmissionController:
+    @staticmethod
+    async def hold(controller: AdmissionController, seconds: float, log: list[str], name: str) -> None:
+        async with controller.admit():
+            log.append(f"start {name}")
+            await asyncio.sleep(seconds)
+            log.append(f"end {name}")
+
+    @pytest.mark.anyio
+    async def test_in_flight_is_bounded_and_queue_is_fifo(self):
+        controller = AdmissionController(max_in_flight=2, max_queued=10, queue_timeout_seconds=5)
+        log: list[str] = []
+
+        tasks = []
+        for name in "abcde":
+            tasks.append(asyncio.create_task(self.hold(controller, 0.05, log, name)))
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.01)
+        assert controller.stats().in_flight == 2
+        assert controller.stats().waiting == 3
+        await asyncio.gather(*tasks)
+
+        in_flight, max_in_flight = 0, 0
+        for event in log:
+            in_flight += 1 if event.startswith("start") else -1
+            max_in_flight = max(max_in_flight, in_flight)
+        assert max_in_flight == 2
+        assert [event for event in log if event.startswith("start")] == [f"start {name}" for name in "abcde"]
+        stats = controller.stats()
+        assert (stats.in_flight, stats.waiting, stats.admitted, stats.queued) == (0, 0, 5, 3)
+
+    @pytest.mark.anyio
+    async def test_full_queue_is_rejected_at_once(self):
+        controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout_seconds=5)
+        log: list[str] = []
+        tasks = [asyncio.create_task(self.hold(controller, 0.1, log, name)) for name in "ab"]
+        await asyncio.sleep(0.01)
+
+        start = time.perf_counter()
+        with pytest.raises(AdmissionRejectedError, match="Too many requests") as exc_info:
+            async with controller.admit():
+                pass
+        assert time.perf_counter() - start < 0.05
+        assert exc_info.value.retry_after >= 1
+        assert controller.stats().rejected_queue_full == 1
+
+        await asyncio.gather(*tasks)
+
+    @pytest.mark.anyio
+    async def test_queue_deadline(self):
+        controller = AdmissionController(max_in_flight=1, max_queued=5, queue_timeout_seconds=0.05)
+        task = asyncio.create_task(self.hold(controller, 0.2, [], "a"))
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(AdmissionRejectedError):
+            async with controller.admit():
+                pass
+        assert controller.stats().rejected_timeout == 1
+        assert controller.stats().waiting == 0
+
+        await task
+        assert controller.stats().in_flight == 0
+
+    @pytest.mark.anyio
+    async def test_cancelled_waiter_does_not_leak_its_slot(self):
+        controller = AdmissionController(max_in_flight=1, max_queued=5, queue_timeout_seconds=5)
+        holder = asyncio.create_task(self.hold(controller, 0.05, [], "a"))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(self.hold(controller, 0.01, [], "b"))
+        await asyncio.sleep(0.01)
+
+        waiter.cancel()
+        await holder
+
+        assert controller.stats().in_flight == 0
+        async with controller.admit():
+            assert controller.stats().in_flight == 1
+
+
+class TestClientQuota:
+    def test_token_bucket(self, tmp_path: Path):
+        quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=60, burst=2)
+
+        quota.acquire("alice")
+        quota.acquire("alice")
+        with pytest.raises(AdmissionRejectedError, match="Request quota exceeded") as exc_info:
+            quota.acquire("alice")
+        assert exc_info.value.retry_after == 1
+        assert quota.stats().rejected == 1
+
+        # Other and unidentified clients are not affected
+        quota.acquire("bob")
+        quota.acquire(None)
+
+    def test_several_tokens(self, tmp_path: Path):
+        quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=60, burst=5)
+
+        quota.acquire("alice", count=3)
+        with pytest.raises(AdmissionRejectedError):
+            quota.acquire("alice", count=3)
+        quota.acquire("alice", count=2)
+
+        # More than the burst empties a full bucket, and leaves it in debt
+        quota.acquire("bob", count=8)
+        with pytest.raises(AdmissionRejectedError) as exc_info:
+            quota.acquire("bob")
+        assert exc_info.value.retry_after == 4
+
+    def test_bucket_refills(self, tmp_path: Path):
+        quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=60 * 50, burst=1)
+
+        quota.acquire("alice")
+        with pytest.raises(AdmissionRejectedError):
+            quota.acquire("alice")
+        time.sleep(0.05)
+        quota.acquire("alice")
+
+    def test_quota_is_shared_between_processes(self, tmp_path: Path):
+        quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=1, burst=1)
+        other_process_quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=1, burst=1)
+
+        quota.acquire("alice")
+        with pytest.raises(AdmissionRejectedError) as exc_info:
+            other_process_quota.acquire("alice")
+        assert 55 <= exc_info.value.retry_after <= 60
+
+    def test_disabled(self, tmp_path: Path):
+        quota = ClientQuota(tmp_path / "quota.sqlite3", requests_per_minute=None, burst=1)
+        for _ in range(5):
+            quota.acquire("alice")
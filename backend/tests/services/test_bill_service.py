@@ -1,13 +1,33 @@
+import asyncio
+import random
+from typing import Iterator
+from unittest.mock import MagicMock
+
 import pytest
 
-from app.schemas.bill import Outing, OutingSplit
+from app.core.settings import settings
+from app.schemas.bill import Bill, Item, Outing, OutingSplit, Payment, PaymentPlan
 from app.services.bill import (
     OutingPaymentBalance,
+    PersonBalance,
+    aget_bill_details_from_image,
+    astream_bill_details_from_image,
     calculate_balance,
+    calculate_outing_split,
     calculate_outing_split_with_minimal_transactions,
     get_bill_details_from_image,
+    ocr_single_flight,
 )
+from app.services.image_preprocessing import PreprocessedImage
+from app.services.litellm_service import _encode_image_data_url
+from app.services.money import to_cents
+from app.services.near_duplicates import near_duplicate_index
+from app.services.ocr_cache import ocr_cache
+from app.services.ocr_engines import LiteLLMEngine
+from app.services.settlement import SettlementStrategy, zero_sum_groups
 from tests import examples
+from tests.services.test_litellm_service import MockChoice, MockLiteLLMResponse
+from tests.services.test_near_duplicates import build_receipt, encode_jpeg
 
 
 class TestCalculateBalance:
@@ -35,6 +55,15 @@ class TestCalculateBalance:
     def test_examples(self, outing: Outing, balance: OutingPaymentBalance):
         assert calculate_balance(outing) == balance
 
+    @pytest.mark.parametrize("seed", range(20))
+    def test_balances_sum_to_zero(self, seed: int):
+        outing = examples.random_outings.random_outing(seed, bills=1 + seed, items_per_bill=10, people=2 + seed)
+        balance = calculate_balance(outing)
+
+        assert sum(creditor.amount for creditor in balance.creditors) == sum(
+            debtor.amount for debtor in balance.debtors
+        )
+
 
 class TestCalculateOutingSplitWithMinimalTransactions:
     @pytest.mark.parametrize(
@@ -61,21 +90,293 @@ class TestCalculateOutingSplitWithMinimalTransactions:
     def test_examples(self, balance: OutingPaymentBalance, split: OutingSplit):
         assert calculate_outing_split_with_minimal_transactions(balance) == split
 
+    @pytest.mark.parametrize("strategy", ["greedy", "exact"])
+    @pytest.mark.parametrize("seed", range(20))
+    def test_settles_every_balance_in_at_most_n_minus_1_transfers(self, seed: int, strategy: SettlementStrategy):
+        outing = examples.random_outings.random_outing(seed, bills=1 + seed, items_per_bill=10, people=2 + seed)
+        balance = calculate_balance(outing)
+        people = len(balance.creditors) + len(balance.debtors)
+
+        split = calculate_outing_split_with_minimal_transactions(balance, strategy)
+
+        settled = {person.name: person.amount for person in balance.creditors}
+        settled |= {person.name: -person.amount for person in balance.debtors}
+        for plan in split.payment_plans:
+            for payment in plan.payments:
+                settled[plan.name] += to_cents(payment.amount)
+                settled[payment.to] -= to_cents(payment.amount)
+        assert set(settled.values()) == {0}
+        assert transfers(split) <= people - 1
+
+    @pytest.mark.parametrize("seed", range(20))
+    def test_exact_strategy_saves_a_transfer_per_zero_sum_group(self, seed: int):
+        rng = random.Random(seed)
+        # Groups of people who net to zero among themselves, shuffled together
+        balances = []
+        for _ in range(rng.randint(1, 4)):
+            group = [rng.randint(-5000, 5000) for _ in range(rng.randint(1, 4))]
+            balances.extend([*group, -sum(group)])
+        balances = [amount for amount in balances if amount]
+        rng.shuffle(balances)
+        balance = OutingPaymentBalance(
+            creditors=sorted(
+                (
+                    PersonBalance(name=f"person{index}", amount=amount)
+                    for index, amount in enumerate(balances)
+                    if amount > 0
+                ),
+                key=lambda person: person.amount,
+                reverse=True,
+            ),
+            debtors=sorted(
+                (
+                    PersonBalance(name=f"person{index}", amount=-amount)
+                    for index, amount in enumerate(balances)
+                    if amount < 0
+                ),
+                key=lambda person: person.amount,
+                reverse=True,
+            ),
+        )
+        groups = zero_sum_groups(balances)
+
+        greedy = calculate_outing_split_with_minimal_transactions(balance, "greedy")
+        exact = calculate_outing_split_with_minimal_transactions(balance, "exact")
+
+        assert groups is not None
+        assert transfers(exact) == len(balances) - len(groups) <= transfers(greedy)
+
+    def test_exact_strategy_falls_back_to_greedy(self, monkeypatch: pytest.MonkeyPatch):
+        balance = OutingPaymentBalance(
+            creditors=[PersonBalance(name="alice", amount=700), PersonBalance(name="bob", amount=300)],
+            debtors=[
+                PersonBalance(name="charlie", amount=500),
+                PersonBalance(name="dave", amount=300),
+                PersonBalance(name="erin", amount=200),
+            ],
+        )
+        assert transfers(calculate_outing_split_with_minimal_transactions(balance, "exact")) == 3
+
+        monkeypatch.setattr("app.services.bill.settings.SETTLEMENT_EXACT_MAX_PEOPLE", 2)
+        assert calculate_outing_split_with_minimal_transactions(
+            balance, "exact"
+        ) == calculate_outing_split_with_minimal_transactions(balance, "greedy")
+        assert transfers(calculate_outing_split_with_minimal_transactions(balance, "greedy")) == 4
+
+
+class TestCalculateOutingSplit:
+    @pytest.mark.parametrize("strategy", ["greedy", "exact"])
+    @pytest.mark.parametrize("seed", range(10))
+    def test_matches_split_of_balance(self, seed: int, strategy: SettlementStrategy):
+        outing = examples.random_outings.random_outing(seed, bills=1 + seed * 3, items_per_bill=10, people=2 + seed)
+
+        split = calculate_outing_split(outing, strategy)
+
+        assert split == calculate_outing_split_with_minimal_transactions(calculate_balance(outing), strategy)
+
+    def test_examples(self):
+        for example in [examples.simple_bill, examples.multiple_bills_discounted]:
+            assert calculate_outing_split(example.OUTING) == example.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS
+
+    @pytest.mark.parametrize("vectorized_min_items", [1, 500])
+    def test_amounts_too_large_for_64_bit_integers(self, monkeypatch: pytest.MonkeyPatch, vectorized_min_items: int):
+        monkeypatch.setattr("app.services.bill.settings.BALANCE_VECTORIZED_MIN_ITEMS", vectorized_min_items)
+        item = Item(name="Galaxy", price=1e17, quantity=1, consumed_by=["alice", "bob"])
+        outing = Outing(bills=[Bill(paid_by="alice", amount_paid=1e17, items=[item])])
+
+        split = calculate_outing_split(outing)
+
+        assert split.payment_plans == [PaymentPlan(name="bob", payments=[Payment(to="alice", amount=5e16)])]
+
+
+def transfers(split: OutingSplit) -> int:
+    return sum(len(plan.payments) for plan in split.payment_plans)
+
 
 class TestGetBillDetailsFromImage:
     success_bill = examples.simple_bill.OCR_BILL
     llm_success_response_text = success_bill.model_dump_json()
 
+    @pytest.fixture(autouse=True)
+    def _clear_ocr_cache(self) -> Iterator[None]:
+        ocr_cache.clear()
+        near_duplicate_index.clear()
+        yield None
+        ocr_cache.clear()
+        near_duplicate_index.clear()
+
     @pytest.fixture
-    def _mock_litellm_service_method(self, monkeypatch: pytest.MonkeyPatch):
+    def llm_calls(self, monkeypatch: pytest.MonkeyPatch) -> list[bytes]:
         outer_self = self
+        calls: list[bytes] = []
+
+        class MockOCREngine:
+            model = "mock"
+            prompt_version = "1"
 
-        class MockLLMService:
             def get_bill_details_from_image(self, image_bytes: bytes, mime_type: str) -> str:
+                calls.append(image_bytes)
                 return outer_self.llm_success_response_text
 
-        monkeypatch.setattr("app.services.bill.litellm_service", MockLLMService())
+            async def aget_bill_details_from_image(
+                self, image_bytes: bytes, mime_type: str, items_only: bool = False
+            ) -> str:
+                await asyncio.sleep(0.05)
+                return self.get_bill_details_from_image(image_bytes, mime_type)
+
+            async def astream_bill_details_from_image(self, image_bytes: bytes, mime_type: str):
+                calls.append(image_bytes)
+                # Stream the response in chunks of a few characters, like LLM tokens
+                text = outer_self.llm_success_response_text
+                for start in range(0, len(text), 4):
+                    await asyncio.sleep(0.001)
+                    yield text[start : start + 4]
+
+        monkeypatch.setattr("app.services.bill.ocr_engine", MockOCREngine())
+        return calls
 
-    def test_litellm(self, _mock_litellm_service_method):
+    def test_litellm(self, llm_calls: list[bytes]):
         ocr_bill = get_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
         assert ocr_bill == self.success_bill
+        assert llm_calls == [b"fake-image-bytes"]
+
+    def test_reupload_is_served_from_cache(self, llm_calls: list[bytes]):
+        first = get_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+        second = get_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+        other = get_bill_details_from_image(image_bytes=b"other-image-bytes", mime_type="image/png")
+
+        assert first == second == other == self.success_bill
+        assert llm_calls == [b"fake-image-bytes", b"other-image-bytes"]
+        assert ocr_cache.stats().memory_hits == 1
+
+    @pytest.mark.anyio
+    async def test_async_shares_cache_with_sync(self, llm_calls: list[bytes]):
+        first = await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+        second = get_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+
+        assert first == second == self.success_bill
+        assert llm_calls == [b"fake-image-bytes"]
+
+    @pytest.mark.anyio
+    async def test_concurrent_identical_uploads_share_one_call(self, llm_calls: list[bytes]):
+        coalesced = ocr_single_flight.stats().coalesced
+
+        bills = await asyncio.gather(
+            *(aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png") for _ in range(3)),
+            aget_bill_details_from_image(image_bytes=b"other-image-bytes", mime_type="image/png"),
+        )
+
+        assert bills == [self.success_bill] * 4
+        assert sorted(llm_calls) == [b"fake-image-bytes", b"other-image-bytes"]
+        assert ocr_single_flight.stats().coalesced == coalesced + 2
+
+    @pytest.fixture
+    def near_duplicates_enabled(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr(near_duplicate_index, "enabled", True)
+
+    def test_rephotographed_receipt_is_extracted_again_by_default(self, llm_calls: list[bytes]):
+        receipt = build_receipt(seed=1)
+
+        get_bill_details_from_image(encode_jpeg(receipt, quality=90), mime_type="image/jpeg")
+        get_bill_details_from_image(encode_jpeg(receipt, quality=60), mime_type="image/jpeg")
+
+        assert len(llm_calls) == 2
+        assert near_duplicate_index.stats().hits == 0
+
+    @pytest.mark.anyio
+    async def test_rephotographed_receipt_is_served_from_cache(
+        self, llm_calls: list[bytes], near_duplicates_enabled: None
+    ):
+        receipt = build_receipt(seed=1)
+
+        first = await aget_bill_details_from_image(encode_jpeg(receipt, quality=90), mime_type="image/jpeg")
+        second = get_bill_details_from_image(encode_jpeg(receipt, quality=60), mime_type="image/jpeg")
+        other = get_bill_details_from_image(encode_jpeg(build_receipt(seed=2), quality=90), mime_type="image/jpeg")
+
+        assert first == second == other == self.success_bill
+        assert len(llm_calls) == 2
+        assert near_duplicate_index.stats().hits == 1
+
+    @pytest.mark.anyio
+    async def test_rephotographed_receipt_is_not_served_from_another_prompt(
+        self, llm_calls: list[bytes], near_duplicates_enabled: None
+    ):
+        receipt = build_receipt(seed=1, width=600, height=3000)
+
+        await aget_bill_details_from_image(encode_jpeg(receipt, quality=90), mime_type="image/jpeg")
+        untiled_calls = len(llm_calls)
+        await aget_bill_details_from_image(encode_jpeg(receipt, quality=60), mime_type="image/jpeg", tiled=True)
+
+        # The tiled extraction calls the LLM for each tile, instead of reusing the untiled result
+        assert len(llm_calls) > untiled_calls + 1
+        assert near_duplicate_index.stats().hits == 0
+
+    @pytest.mark.anyio
+    async def test_tall_receipt_tiles_are_extracted_concurrently(self, llm_calls: list[bytes]):
+        image_bytes = encode_jpeg(build_receipt(seed=1, width=1200, height=6000), quality=90)
+
+        start = asyncio.get_running_loop().time()
+        ocr_bill = await aget_bill_details_from_image(image_bytes, "image/jpeg", tiled=True)
+        elapsed = asyncio.get_running_loop().time() - start
+
+        # Every tile reads the same items here, which are all merged as overlaps
+        assert ocr_bill == self.success_bill
+        assert len(llm_calls) > 1
+        assert elapsed < 0.05 * len(llm_calls)
+
+        tile_calls = len(llm_calls)
+        assert await aget_bill_details_from_image(image_bytes, "image/jpeg", tiled=True) == self.success_bill
+        assert len(llm_calls) == tile_calls
+
+    @pytest.mark.anyio
+    async def test_tiled_receipt_with_hedging(self, monkeypatch: pytest.MonkeyPatch):
+        tiles = [
+            PreprocessedImage(content=f"tile {index}".encode(), mime_type="image/jpeg", original_size=6)
+            for index in range(3)
+        ]
+        last_tile_url = _encode_image_data_url(tiles[-1].content, "image/jpeg")
+        # The receipt does not show its totals above the last tile, which the LLM reads as nothing paid
+        upper_tile_json = self.success_bill.model_dump_json().replace('"amount_paid":1207.5', '"amount_paid":0.0')
+        assert '"amount_paid":0.0' in upper_tile_json
+        models: list[str] = []
+
+        async def mock_acompletion(model: str, messages: list[dict], **kwargs):
+            models.append(model)
+            url = messages[0]["content"][1]["image_url"]["url"]
+            content = self.llm_success_response_text if url == last_tile_url else upper_tile_json
+            return MockLiteLLMResponse(choices=[MockChoice(message=MagicMock(content=content))])
+
+        monkeypatch.setattr("app.services.bill.ocr_engine", LiteLLMEngine())
+        monkeypatch.setattr("app.services.bill.image_preprocessor.preprocess_tiles", lambda *args, **kwargs: tiles)
+        monkeypatch.setattr("app.services.litellm_service.acompletion", mock_acompletion)
+        monkeypatch.setattr("app.services.litellm_service.settings.LITELLM_HEDGE_MODEL", "openai/gpt-4o")
+
+        ocr_bill = await aget_bill_details_from_image(b"tall-receipt", "image/jpeg", tiled=True)
+
+        assert ocr_bill == self.success_bill
+        # Only the items of the upper tiles need to be valid, so none of the tiles was hedged
+        assert models == [settings.LITELLM_MODEL] * len(tiles)
+
+    @pytest.mark.anyio
+    async def test_stream_yields_items_before_the_response_is_complete(self, llm_calls: list[bytes]):
+        results = []
+        first_item_at = 0.0
+        start = asyncio.get_running_loop().time()
+        async for result in astream_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png"):
+            results.append(result)
+            if len(results) == 1:
+                first_item_at = asyncio.get_running_loop().time() - start
+        total = asyncio.get_running_loop().time() - start
+
+        assert results == [*self.success_bill.items, self.success_bill]
+        assert llm_calls == [b"fake-image-bytes"]
+        assert first_item_at < total / 2
+
+    @pytest.mark.anyio
+    async def test_stream_is_replayed_from_cache(self, llm_calls: list[bytes]):
+        first = [result async for result in astream_bill_details_from_image(b"fake-image-bytes", "image/png")]
+        second = [result async for result in astream_bill_details_from_image(b"fake-image-bytes", "image/png")]
+
+        assert first == second == [*self.success_bill.items, self.success_bill]
+        assert llm_calls == [b"fake-image-bytes"]
+        assert await aget_bill_details_from_image(b"fake-image-bytes", "image/png") == self.success_bill
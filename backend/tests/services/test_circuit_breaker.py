@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+from app.services.circuit_breaker import CircuitBreaker, CircuitOpenError, RetryBudget, backoff_delay
+
+
+def call(breaker: CircuitBreaker, failed: bool = False, latency_seconds: float = 0.1) -> None:
+    breaker.before_call()
+    breaker.record(failed=failed, latency_seconds=latency_seconds)
+
+
+class TestCircuitBreaker:
+    @pytest.fixture
+    def breaker(self) -> CircuitBreaker:
+        return CircuitBreaker(
+            name="The provider",
+            window=10,
+            min_calls=4,
+            failure_rate_threshold=0.5,
+            slow_call_seconds=1.0,
+            slow_call_rate_threshold=0.75,
+            open_seconds=0.1,
+        )
+
+    def test_trips_on_failure_rate(self, breaker: CircuitBreaker):
+        for failed in [False, True, False]:
+            call(breaker, failed=failed)
+        assert breaker.state == "closed"
+
+        call(breaker, failed=True)
+
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError, match="The provider is unavailable") as exc_info:
+            breaker.before_call()
+        assert exc_info.value.retry_after == 1
+        assert breaker.stats().model_dump() == {
+            "enabled": True,
+            "state": "open",
+            "trips": 1,
+            "rejected": 1,
+            "failure_rate": 0.0,
+            "slow_call_rate": 0.0,
+        }
+
+    def test_trips_on_slow_calls(self, breaker: CircuitBreaker):
+        for latency_seconds in [0.1, 2.0, 2.0]:
+            call(breaker, latency_seconds=latency_seconds)
+        assert breaker.state == "closed"
+        assert breaker.stats().slow_call_rate == pytest.approx(2 / 3)
+
+        call(breaker, latency_seconds=2.0)
+
+        assert breaker.state == "open"
+
+    def test_does_not_trip_before_min_calls(self, breaker: CircuitBreaker):
+        for _ in range(3):
+            call(breaker, failed=True)
+        assert breaker.state == "closed"
+
+    def test_probe_success_closes(self, breaker: CircuitBreaker):
+        for _ in range(4):
+            call(breaker, failed=True)
+        time.sleep(0.1)
+        assert breaker.state == "half_open"
+
+        breaker.before_call()
+        # Only one probe call is let through at a time
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+        breaker.record(failed=False, latency_seconds=0.1)
+
+        assert breaker.state == "closed"
+        call(breaker)
+
+    def test_probe_failure_reopens(self, breaker: CircuitBreaker):
+        for _ in range(4):
+            call(breaker, failed=True)
+        time.sleep(0.1)
+
+        call(breaker, failed=True)
+
+        assert breaker.state == "open"
+        assert breaker.stats().trips == 2
+
+    def test_cancelled_probe_is_released(self, breaker: CircuitBreaker):
+        for _ in range(4):
+            call(breaker, failed=True)
+        time.sleep(0.1)
+
+        breaker.before_call()
+        breaker.release()
+
+        call(breaker)
+        assert breaker.state == "closed"
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(name="The provider", min_calls=1, enabled=False)
+        for _ in range(10):
+            call(breaker, failed=True)
+        assert breaker.state == "closed"
+
+
+class TestRetryBudget:
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, max_tokens=2)
+
+        assert [budget.withdraw() for _ in range(3)] == [True, True, False]
+        budget.deposit()
+        assert not budget.withdraw()
+        budget.deposit()
+        assert budget.withdraw()
+
+        assert budget.stats().model_dump() == {"tokens": 0.0, "retries": 3, "exhausted": 2}
+
+    def test_budget_is_capped(self):
+        budget = RetryBudget(ratio=1, max_tokens=2)
+        for _ in range(10):
+            budget.deposit()
+        assert budget.stats().tokens == 2
+
+
+def test_backoff_delay():
+    delays = [backoff_delay(attempt, base_seconds=0.5, max_seconds=2.0) for attempt in range(5) for _ in range(50)]
+
+    assert all(0 <= delay <= 0.5 for delay in delays[:50])
+    assert all(0 <= delay <= 2.0 for delay in delays)
+    assert max(delays[-50:]) > 0.5
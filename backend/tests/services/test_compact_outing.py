@@ -0,0 +1,32 @@
+import pytest
+
+from app.services.bill import _net_balances
+from app.services.compact_outing import CompactOuting
+from tests import examples
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_from_outing(seed: int):
+    outing = examples.random_outings.random_outing(seed, bills=1 + seed * 3, items_per_bill=12, people=2 + seed * 4)
+
+    compact = CompactOuting.from_outing(outing)
+
+    assert compact.people == list(_net_balances(outing))
+    assert compact.item_count == sum(len(bill.items) for bill in outing.bills)
+    assert [compact.people[payer] for payer in compact.payers] == [bill.paid_by for bill in outing.bills]
+    assert list(compact.paid) == [round(bill.amount_paid * 100) for bill in outing.bills]
+    assert list(compact.bill_sizes) == [len(bill.items) for bill in outing.bills]
+    items = [item for bill in outing.bills for item in bill.items]
+    assert list(compact.item_weights) == [round(item.price * 100) * item.quantity for item in items]
+    assert list(compact.item_consumers) == [len(item.consumed_by) for item in items]
+    assert [compact.people[person] for person in compact.share_people] == [
+        person for item in items for person in item.consumed_by
+    ]
+
+
+def test_amounts_too_large_for_64_bit_integers():
+    outing = examples.simple_bill.OUTING.model_copy(deep=True)
+    outing.bills[0].amount_paid = 1e17
+
+    with pytest.raises(OverflowError):
+        CompactOuting.from_outing(outing)
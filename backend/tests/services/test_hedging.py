@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from app.services.hedging import Hedger
+
+
+def answer_after(seconds: float, answer: str, calls: list[str], cancelled: list[str]):
+    async def request() -> str:
+        calls.append(answer)
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            cancelled.append(answer)
+            raise
+        if answer.startswith("invalid"):
+            raise ValueError(answer)
+        return answer
+
+    return request
+
+
+class TestHedger:
+    @pytest.fixture
+    def calls(self) -> list[str]:
+        return []
+
+    @pytest.fixture
+    def cancelled(self) -> list[str]:
+        return []
+
+    @pytest.mark.anyio
+    async def test_fast_primary_is_not_hedged(self, calls: list[str], cancelled: list[str]):
+        hedger = Hedger(delay_seconds=0.1)
+
+        result = await hedger.run(
+            answer_after(0.01, "primary", calls, cancelled), answer_after(0.01, "secondary", calls, cancelled)
+        )
+
+        assert result == "primary"
+        assert calls == ["primary"]
+        assert hedger.stats().decisions == {"primary_only": 1}
+        assert hedger.stats().hedged == 0
+
+    @pytest.mark.anyio
+    async def test_slow_primary_is_hedged_and_cancelled(self, calls: list[str], cancelled: list[str]):
+        hedger = Hedger(delay_seconds=0.05)
+
+        result = await hedger.run(
+            answer_after(1, "primary", calls, cancelled), answer_after(0.01, "secondary", calls, cancelled)
+        )
+
+        assert result == "secondary"
+        await asyncio.sleep(0)
+        assert cancelled == ["primary"]
+        assert hedger.stats().decisions == {"primary_slow_secondary_won": 1}
+        assert hedger.stats().hedged == 1
+
+    @pytest.mark.anyio
+    async def test_slow_primary_can_still_win(self, calls: list[str], cancelled: list[str]):
+        hedger = Hedger(delay_seconds=0.05)
+
+        result = await hedger.run(
+            answer_after(0.1, "primary", calls, cancelled), answer_after(1, "secondary", calls, cancelled)
+        )
+
+        assert result == "primary"
+        await asyncio.sleep(0)
+        assert cancelled == ["secondary"]
+        assert hedger.stats().decisions == {"primary_slow_primary_won": 1}
+
+    @pytest.mark.anyio
+    async def test_invalid_answer_does_not_win(self, calls: list[str], cancelled: list[str]):
+        hedger = Hedger(delay_seconds=0.05)
+
+        result = await hedger.run(
+            answer_after(0.1, "invalid primary", calls, cancelled), answer_after(0.2, "secondary", calls, cancelled)
+        )
+
+        assert result == "secondary"
+        assert hedger.stats().decisions == {"primary_slow_secondary_won": 1}
+
+    @pytest.mark.anyio
+    async def test_failed_primary_is_hedged_right_away(self, calls: list[str], cancelled: list[str]):
+        hedger = Hedger(delay_seconds=10)
+
+        result = await asyncio.wait_for(
+            hedger.run(
+                answer_after(0.01, "invalid primary", calls, cancelled),
+                answer_after(0.01, "secondary", calls, cancelled),
+            ),
+            timeout=1,
+        )
+
+        assert result == "secondary"
+        assert hedger.stats().decisions == {"primary_failed_secondary_won": 1}
+
+    @pytest.mark.anyio
+    async def test_both_failed(self, calls: list[str], cancelled: list[str]):
+        hedger = Hedger(delay_seconds=0.01)
+
+        with pytest.raises(ValueError, match="invalid primary"):
+            await hedger.run(
+                answer_after(0.05, "invalid primary", calls, cancelled),
+                answer_after(0.01, "invalid secondary", calls, cancelled),
+            )
+
+        assert hedger.stats().decisions == {"primary_slow_both_failed": 1}
+
+    @pytest.mark.anyio
+    async def test_delay_follows_percentile_of_primary_latency(self, calls: list[str], cancelled: list[str]):
+        hedger = Hedger(delay_seconds=1, delay_percentile=0.5, min_samples=3)
+
+        for latency in (0.01, 0.02, 0.03):
+            assert hedger.delay() == 1
+            await hedger.run(
+                answer_after(latency, "primary", calls, cancelled), answer_after(0, "secondary", calls, cancelled)
+            )
+
+        assert hedger.delay() == pytest.approx(0.02, abs=0.01)
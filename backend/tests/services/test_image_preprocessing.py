@@ -0,0 +1,134 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+from app.services.image_preprocessing import ImagePreprocessor
+
+
+def build_receipt_photo(width: int = 3000, height: int = 4000, orientation: int | None = None) -> bytes:
+    """A white receipt with some text lines, lying in the middle of a dark table."""
+    image = Image.new("RGB", (width, height), (40, 30, 20))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((width // 4, height // 8, width * 3 // 4, height * 7 // 8), fill=(250, 250, 245))
+    for line in range(height // 8 + 100, height * 7 // 8 - 100, 120):
+        draw.rectangle((width // 4 + 40, line, width * 3 // 4 - 40, line + 40), fill=(20, 20, 20))
+
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[0x0112] = orientation
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", exif=exif)
+    return buffer.getvalue()
+
+
+class TestImagePreprocessor:
+    def test_shrinks_photo(self):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="JPEG", quality=80)
+        image_bytes = build_receipt_photo()
+
+        result = preprocessor.preprocess(image_bytes, "image/png")
+
+        assert result.mime_type == "image/jpeg"
+        assert result.original_size == len(image_bytes)
+        assert result.bytes_saved > 0
+        assert list(result.stage_durations) == ["decode", "rotate", "grayscale", "downscale", "crop", "encode"]
+
+        image = Image.open(io.BytesIO(result.content))
+        assert image.mode == "L"
+        # Downscaled to 768x1024, then cropped to the receipt which is half as wide and 3/4 as tall
+        assert 384 <= image.width < 450
+        assert 768 <= image.height < 850
+
+        stats = preprocessor.stats()
+        assert stats.images == 1
+        assert stats.processed_bytes == len(result.content)
+
+    def test_applies_exif_rotation(self):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="WEBP", quality=80)
+
+        # Orientation 6 means that the camera was rotated, and the image must be turned 90 degrees to be upright
+        result = preprocessor.preprocess(build_receipt_photo(orientation=6), "image/png")
+
+        assert result.mime_type == "image/webp"
+        image = Image.open(io.BytesIO(result.content))
+        assert image.width > image.height
+
+    def test_undecodable_image_is_sent_as_is(self):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="JPEG", quality=80)
+
+        result = preprocessor.preprocess(b"fake-image-bytes", "image/png")
+
+        assert result.content == b"fake-image-bytes"
+        assert result.mime_type == "image/png"
+        assert preprocessor.stats().images == 0
+
+    def test_decompression_bomb_is_sent_as_is(self, monkeypatch: pytest.MonkeyPatch):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="JPEG", quality=80)
+        image_bytes = build_receipt_photo(width=600, height=800)
+        monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+
+        result = preprocessor.preprocess(image_bytes, "image/png")
+
+        assert result.content == image_bytes
+        assert result.mime_type == "image/png"
+
+    def test_disabled(self):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="JPEG", quality=80, enabled=False)
+        image_bytes = build_receipt_photo(width=600, height=800)
+
+        result = preprocessor.preprocess(image_bytes, "image/png")
+
+        assert result.content == image_bytes
+        assert result.stage_durations == {}
+
+
+class TestPreprocessTiles:
+    def test_tall_receipt_is_tiled(self):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="JPEG", quality=80)
+        image_bytes = build_receipt_photo(width=2000, height=8000)
+
+        tiles = preprocessor.preprocess_tiles(
+            image_bytes, "image/png", tile_aspect_ratio=1.5, overlap=0.15, max_tiles=6
+        )
+
+        # The receipt is cropped to about 1080x6240, which takes 5 tiles of 1.5 times its width
+        assert len(tiles) == 5
+        for tile in tiles:
+            image = Image.open(io.BytesIO(tile.content))
+            assert tile.mime_type == "image/jpeg"
+            # Each tile is downscaled on its own, so the receipt is much wider than if it was downscaled as a whole
+            assert image.width > 600
+            assert image.height <= 1024
+        assert preprocessor.stats().images == 5
+
+    def test_short_receipt_is_not_tiled(self):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="JPEG", quality=80)
+        image_bytes = build_receipt_photo(width=4000, height=3000)
+
+        tiles = preprocessor.preprocess_tiles(
+            image_bytes, "image/png", tile_aspect_ratio=1.5, overlap=0.15, max_tiles=6
+        )
+
+        assert [tile.content for tile in tiles] == [preprocessor.preprocess(image_bytes, "image/png").content]
+
+    def test_undecodable_image_is_sent_as_is(self):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="JPEG", quality=80)
+
+        tiles = preprocessor.preprocess_tiles(
+            b"fake-image", "image/png", tile_aspect_ratio=1.5, overlap=0.15, max_tiles=6
+        )
+
+        assert [tile.content for tile in tiles] == [b"fake-image"]
+
+    def test_decompression_bomb_is_sent_as_is(self, monkeypatch: pytest.MonkeyPatch):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="JPEG", quality=80)
+        image_bytes = build_receipt_photo(width=600, height=4000)
+        monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+
+        tiles = preprocessor.preprocess_tiles(
+            image_bytes, "image/png", tile_aspect_ratio=1.5, overlap=0.15, max_tiles=6
+        )
+
+        assert [tile.content for tile in tiles] == [image_bytes]
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from app.services.json_stream import IncrementalArrayParser
+from tests import examples
+
+
+def feed_in_chunks(parser: IncrementalArrayParser, text: str, chunk_size: int) -> list[list[dict]]:
+    return [parser.feed(text[start : start + chunk_size]) for start in range(0, len(text), chunk_size)]
+
+
+class TestIncrementalArrayParser:
+    @pytest.mark.parametrize("chunk_size", [1, 3, 16, 10_000])
+    def test_items_of_bill(self, chunk_size: int):
+        text = examples.simple_bill.OCR_BILL.model_dump_json()
+        parser = IncrementalArrayParser("items")
+
+        elements = [element for chunk in feed_in_chunks(parser, text, chunk_size) for element in chunk]
+
+        assert elements == [item.model_dump() for item in examples.simple_bill.OCR_BILL.items]
+        assert parser.document == text
+
+    def test_each_item_is_parsed_as_soon_as_it_is_complete(self):
+        text = json.dumps({"items": [{"name": "Pizza"}, {"name": "Coke"}], "amount_paid": 10})
+        parser = IncrementalArrayParser("items")
+
+        first_end = text.index("}") + 1
+        assert parser.feed(text[: first_end - 1]) == []
+        assert parser.feed(text[first_end - 1 : first_end]) == [{"name": "Pizza"}]
+        assert parser.feed(text[first_end:]) == [{"name": "Coke"}]
+
+    def test_strings_with_brackets_and_escapes(self):
+        items = [{"name": 'Pizza "}{" [large]', "tags": ["a", "b"], "extra": {"items": [1]}}, {"name": "\\"}]
+        text = json.dumps({"items": items})
+        parser = IncrementalArrayParser("items")
+
+        elements = [element for chunk in feed_in_chunks(parser, text, 1) for element in chunk]
+
+        assert elements == items
+
+    def test_ignores_other_arrays_and_surrounding_text(self):
+        document = json.dumps({"notes": [{"name": "Not an item"}], "nested": {"items": [{"name": "Nested"}]}})
+        parser = IncrementalArrayParser("items")
+
+        elements = parser.feed(f"```json\n{document}\n```")
+
+        assert elements == []
+        assert parser.document == document
@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+from app.schemas.bill import Bill, Outing
+from app.services.bill import (
+    _net_balances,
+    calculate_balance,
+    calculate_outing_split_with_minimal_transactions,
+    settle_balances,
+)
+from app.services.ledger import OutingLedger
+from tests import examples
+
+
+def random_bills(seed: int, count: int) -> list[Bill]:
+    return examples.random_outings.random_outing(seed, bills=count, items_per_bill=6, people=8).bills
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_matches_full_recompute(seed: int):
+    rng = random.Random(seed)
+    candidates = random_bills(seed, 40)
+    ledger = OutingLedger()
+    bills: dict[int, Bill] = {}
+
+    for _ in range(60):
+        operation = rng.choice(["add", "add", "replace", "remove"]) if bills else "add"
+        if operation == "add":
+            bill = rng.choice(candidates)
+            bills[ledger.add_bill(bill)] = bill
+        elif operation == "replace":
+            bill_id, bill = rng.choice(list(bills)), rng.choice(candidates)
+            ledger.replace_bill(bill_id, bill)
+            bills[bill_id] = bill
+        else:
+            bill_id = rng.choice(list(bills))
+            ledger.remove_bill(bill_id)
+            del bills[bill_id]
+
+        if not bills:
+            assert ledger.net_balances == {}
+            continue
+        # The bills are in the order they were added, edits keeping their place
+        outing = Outing(bills=[bills[bill_id] for bill_id in ledger.bill_ids])
+        assert ledger.net_balances == _net_balances(outing)
+        expected = calculate_balance(outing)
+        assert sorted(ledger.balance().creditors, key=str) == sorted(expected.creditors, key=str)
+        assert sorted(ledger.balance().debtors, key=str) == sorted(expected.debtors, key=str)
+
+
+def test_examples():
+    for example in [examples.simple_bill, examples.multiple_bills, examples.multiple_bills_discounted]:
+        ledger = OutingLedger.from_outing(example.OUTING)
+        assert ledger.balance() == example.OUTING_PAYMENT_BALANCE
+        assert ledger.split() == example.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS
+
+
+def test_split_is_only_computed_again_when_balances_change(monkeypatch: pytest.MonkeyPatch):
+    calls = []
+
+    def counting_split(*args):
+        calls.append(args)
+        return settle_balances(*args)
+
+    monkeypatch.setattr("app.services.ledger.settle_balances", counting_split)
+    first, second = examples.multiple_bills.OUTING.bills
+    ledger = OutingLedger()
+    bill_id = ledger.add_bill(first)
+    ledger.add_bill(second)
+
+    assert ledger.split() == ledger.split() == examples.multiple_bills.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS
+    assert len(calls) == 1
+
+    # Renaming an item changes nobody's balance
+    renamed = first.model_copy(update={"items": [item.model_copy(update={"name": "Pie"}) for item in first.items]})
+    ledger.replace_bill(bill_id, renamed)
+    ledger.split()
+    assert len(calls) == 1
+
+    ledger.remove_bill(bill_id)
+    ledger.split()
+    assert len(calls) == 2
+    assert ledger.split() == calculate_outing_split_with_minimal_transactions(calculate_balance(Outing(bills=[second])))
+
+
+def test_unknown_bill():
+    ledger = OutingLedger()
+    with pytest.raises(KeyError):
+        ledger.remove_bill(0)
+    with pytest.raises(KeyError):
+        ledger.replace_bill(0, examples.simple_bill.OUTING.bills[0])
@@ -1,10 +1,22 @@
+import base64
 from dataclasses import dataclass, field
-from typing import Optional
-from unittest.mock import MagicMock
+from typing import Iterator, Optional
+from unittest.mock import AsyncMock, MagicMock
 
+import litellm
 import pytest
 
-from app.services.litellm_service import get_bill_details_from_image
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.litellm_service import (
+    _encode_image_data_url,
+    aget_bill_details_from_image,
+    astream_bill_details_from_image,
+    circuit_breakers,
+    get_bill_details_from_image,
+    get_circuit_breaker,
+    retry_budget,
+)
+from app.services.llm_usage import TokenBudgetExceededError, track_request
 from tests import examples
 
 
@@ -27,6 +39,15 @@ def mock_litellm_completion(
     return mock_fn
 
 
+def mock_litellm_acompletion(
+    monkeypatch: pytest.MonkeyPatch, response: Optional[MockLiteLLMResponse] = None
+) -> AsyncMock:
+    """Patch litellm.acompletion and return the mock for inspection."""
+    mock_fn = AsyncMock(return_value=response)
+    monkeypatch.setattr("app.services.litellm_service.acompletion", mock_fn)
+    return mock_fn
+
+
 class TestGetBillDetailsFromImage:
     def test_success(self, monkeypatch: pytest.MonkeyPatch):
         llm_success_response_text = examples.simple_bill.OCR_BILL.model_dump_json()
@@ -60,3 +81,178 @@ class TestGetBillDetailsFromImage:
 
         with pytest.raises(ValueError, match=error_message):
             get_bill_details_from_image(image_bytes=b"fake", mime_type="image/png")
+
+
+class TestHedgedAGetBillDetailsFromImage:
+    @pytest.mark.anyio
+    async def test_invalid_primary_answer_is_hedged(self, monkeypatch: pytest.MonkeyPatch):
+        bill_json = examples.simple_bill.OCR_BILL.model_dump_json()
+        answers = {"gemini/gemini-2.5-flash": "not a bill", "openai/gpt-4o": bill_json}
+
+        async def mock_acompletion(model: str, **kwargs):
+            return MockLiteLLMResponse(choices=[MockChoice(message=MagicMock(content=answers[model]))])
+
+        monkeypatch.setattr("app.services.litellm_service.acompletion", mock_acompletion)
+        monkeypatch.setattr("app.services.litellm_service.settings.LITELLM_HEDGE_MODEL", "openai/gpt-4o")
+
+        result = await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+
+        assert result == bill_json
+
+
+class TestCircuitBreakerAndRetries:
+    @pytest.fixture(autouse=True)
+    def _reset(self, monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+        monkeypatch.setattr("app.services.litellm_service.settings.LLM_RETRY_BACKOFF_SECONDS", 0.001)
+        circuit_breakers.clear()
+        retry_budget.reset()
+        yield None
+        circuit_breakers.clear()
+        retry_budget.reset()
+
+    @staticmethod
+    def success_response() -> MockLiteLLMResponse:
+        return MockLiteLLMResponse(choices=[MockChoice(message=MagicMock(content="{}"))])
+
+    @staticmethod
+    def transient_error() -> Exception:
+        return litellm.ServiceUnavailableError("Overloaded", llm_provider="gemini", model="gemini-2.5-flash")
+
+    def test_transient_errors_are_retried(self, monkeypatch: pytest.MonkeyPatch):
+        mock_fn = mock_litellm_completion(monkeypatch)
+        mock_fn.side_effect = [self.transient_error(), self.transient_error(), self.success_response()]
+
+        assert get_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png") == "{}"
+        assert mock_fn.call_count == 3
+        assert retry_budget.stats().retries == 2
+
+    @pytest.mark.anyio
+    async def test_retries_are_limited(self, monkeypatch: pytest.MonkeyPatch):
+        mock_fn = mock_litellm_acompletion(monkeypatch)
+        mock_fn.side_effect = self.transient_error()
+
+        with pytest.raises(litellm.ServiceUnavailableError):
+            await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+        assert mock_fn.call_count == 3
+
+    @pytest.mark.anyio
+    async def test_retries_are_limited_by_budget(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr("app.services.litellm_service.retry_budget._tokens", 1.0)
+        mock_fn = mock_litellm_acompletion(monkeypatch)
+        mock_fn.side_effect = self.transient_error()
+
+        with pytest.raises(litellm.ServiceUnavailableError):
+            await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+        assert mock_fn.call_count == 2
+        assert retry_budget.stats().exhausted == 1
+
+    @pytest.mark.anyio
+    async def test_other_errors_are_not_retried(self, monkeypatch: pytest.MonkeyPatch):
+        mock_fn = mock_litellm_acompletion(monkeypatch)
+        mock_fn.side_effect = litellm.BadRequestError("Invalid image", model="gemini-2.5-flash", llm_provider="gemini")
+
+        with pytest.raises(litellm.BadRequestError):
+            await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+        assert mock_fn.call_count == 1
+        assert get_circuit_breaker("https://proxy.clanker.ai").stats().failure_rate == 0
+
+    @pytest.mark.anyio
+    async def test_open_circuit_fails_fast(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr("app.services.litellm_service.settings.LLM_MAX_RETRIES", 0)
+        mock_fn = mock_litellm_acompletion(monkeypatch)
+        mock_fn.side_effect = self.transient_error()
+
+        for _ in range(10):
+            with pytest.raises(litellm.ServiceUnavailableError):
+                await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+
+        with pytest.raises(CircuitOpenError) as exc_info:
+            await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+        assert exc_info.value.retry_after == 30
+        assert mock_fn.call_count == 10
+        assert get_circuit_breaker("https://proxy.clanker.ai").stats().state == "open"
+
+
+class TestUsageAccounting:
+    @pytest.mark.anyio
+    async def test_calls_are_recorded(self, monkeypatch: pytest.MonkeyPatch):
+        response = MagicMock(
+            choices=[MagicMock(message=MagicMock(content="{}"))],
+            usage=MagicMock(prompt_tokens=1200, completion_tokens=80),
+        )
+        mock_litellm_acompletion(monkeypatch, response)
+
+        with track_request("alice") as calls:
+            await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+
+        assert [(call.model, call.prompt_tokens, call.completion_tokens, call.image_bytes) for call in calls] == [
+            ("gemini/gemini-2.5-flash", 1200, 80, len(b"fake-image-bytes"))
+        ]
+
+    @pytest.mark.anyio
+    async def test_budget_exceeded(self, monkeypatch: pytest.MonkeyPatch):
+        mock_fn = mock_litellm_acompletion(monkeypatch)
+
+        async def exceeded(model: str) -> str:
+            raise TokenBudgetExceededError("Daily token budget exceeded.", retry_after=60)
+
+        monkeypatch.setattr("app.services.litellm_service.token_budget.aselect_model", exceeded)
+
+        with pytest.raises(TokenBudgetExceededError):
+            await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+        mock_fn.assert_not_called()
+
+
+class TestAStreamBillDetailsFromImage:
+    @pytest.mark.anyio
+    async def test_success(self, monkeypatch: pytest.MonkeyPatch):
+        deltas = ['{"items": [', "", None, '{"name": "Pizza"}', "]}"]
+
+        async def stream():
+            for delta in deltas:
+                yield MagicMock(choices=[MagicMock(delta=MagicMock(content=delta))])
+            yield MagicMock(choices=[])
+
+        mock_fn = AsyncMock(return_value=stream())
+        monkeypatch.setattr("app.services.litellm_service.acompletion", mock_fn)
+
+        chunks = [chunk async for chunk in astream_bill_details_from_image(b"fake-image-bytes", "image/png")]
+
+        assert chunks == ['{"items": [', '{"name": "Pizza"}', "]}"]
+        assert mock_fn.call_args[1]["stream"] is True
+        assert mock_fn.call_args[1]["model"] == "gemini/gemini-2.5-flash"
+
+
+class TestAGetBillDetailsFromImage:
+    @pytest.mark.anyio
+    async def test_success(self, monkeypatch: pytest.MonkeyPatch):
+        llm_success_response_text = examples.simple_bill.OCR_BILL.model_dump_json()
+
+        response = MockLiteLLMResponse(choices=[MockChoice(message=MagicMock(content=llm_success_response_text))])
+        mock_fn = mock_litellm_acompletion(monkeypatch, response)
+
+        result = await aget_bill_details_from_image(image_bytes=b"fake-image-bytes", mime_type="image/png")
+
+        assert result == llm_success_response_text
+        mock_fn.assert_awaited_once()
+        call_kwargs = mock_fn.call_args[1]
+        assert call_kwargs["model"] == "gemini/gemini-2.5-flash"
+        assert call_kwargs["api_base"] == "https://proxy.clanker.ai"
+        assert call_kwargs["api_key"] == "clanker123"
+
+    @pytest.mark.anyio
+    async def test_no_response(self, monkeypatch: pytest.MonkeyPatch):
+        mock_litellm_acompletion(monkeypatch, MockLiteLLMResponse(choices=[]))
+
+        with pytest.raises(ValueError, match="No response from LiteLLM"):
+            await aget_bill_details_from_image(image_bytes=b"fake", mime_type="image/png")
+
+
+class TestEncodeImageDataURL:
+    @pytest.mark.parametrize("size", [0, 1, 2, 3, 1000, 3 * 256 * 1024, 2 * 3 * 256 * 1024 + 1])
+    def test_matches_one_shot_encoding(self, size: int):
+        image_bytes = bytes(i % 251 for i in range(size))
+
+        data_url = _encode_image_data_url(image_bytes, "image/jpeg")
+
+        assert data_url == f"data:image/jpeg;base64,{base64.b64encode(image_bytes).decode()}"
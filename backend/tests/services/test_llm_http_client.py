@@ -0,0 +1,82 @@
+import threading
+from collections.abc import AsyncIterator, Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import litellm
+import pytest
+
+from app.services.llm_http_client import LLMHTTPClient
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url() -> Iterator[str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+async def client() -> AsyncIterator[LLMHTTPClient]:
+    client = LLMHTTPClient(max_connections=2, max_keepalive_connections=2, keepalive_expiry=60, timeout=5)
+    client.start()
+    yield client
+    await client.stop()
+
+
+class TestLLMHTTPClient:
+    @pytest.mark.anyio
+    async def test_connections_are_reused(self, client: LLMHTTPClient, server_url: str):
+        assert litellm.aclient_session is not None
+        for _ in range(3):
+            response = await litellm.aclient_session.get(server_url)
+            assert response.status_code == 200
+        assert litellm.client_session is not None
+        for _ in range(2):
+            assert litellm.client_session.get(server_url).status_code == 200
+
+        stats = client.stats()
+        assert stats.started
+        assert stats.requests == 5
+        # One connection per pool, for the sync and the async client
+        assert stats.connections_opened == 2
+        assert stats.connections_reused == 3
+        assert stats.connections_open == stats.connections_idle == 2
+        assert stats.requests_waiting == 0
+
+    @pytest.mark.anyio
+    async def test_stop(self, server_url: str):
+        client = LLMHTTPClient(max_connections=2, max_keepalive_connections=2, keepalive_expiry=60, timeout=5)
+        client.start()
+
+        await client.stop()
+
+        assert litellm.client_session is None
+        assert litellm.aclient_session is None
+        assert not client.stats().started
+        assert client.completion_kwargs("gemini/gemini-2.5-flash", is_async=True) == {}
+
+    @pytest.mark.anyio
+    @pytest.mark.parametrize("is_async", [True, False])
+    async def test_completion_kwargs(self, client: LLMHTTPClient, is_async: bool):
+        # OpenAI SDK based providers go through the sessions set on the litellm module
+        assert client.completion_kwargs("openai/gpt-4o", is_async) == {}
+
+        handler = client.completion_kwargs("gemini/gemini-2.5-flash", is_async)["client"]
+        assert handler.client is (litellm.aclient_session if is_async else litellm.client_session)
@@ -0,0 +1,138 @@
+import threading
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+
+from app.services.llm_usage import (
+    LLMUsageTracker,
+    TokenBudget,
+    TokenBudgetExceededError,
+    track_request,
+    usage_headers,
+)
+
+
+def llm_response(prompt_tokens: int, completion_tokens: int) -> MagicMock:
+    return MagicMock(usage=MagicMock(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+
+
+def create_budget(tmp_path: Path, **kwargs) -> TokenBudget:
+    options = {"daily_tokens": None, "client_daily_tokens": None, "exceeded_action": "reject"} | kwargs
+    return TokenBudget(path=tmp_path / "token_usage.sqlite3", **options)
+
+
+class TestLLMUsageTracker:
+    def test_aggregates_calls_per_model(self, tmp_path: Path):
+        tracker = LLMUsageTracker(create_budget(tmp_path))
+
+        tracker.record("gemini/gemini-2.5-flash", llm_response(1000, 100), image_bytes=2048, latency_seconds=1.5)
+        tracker.record("gemini/gemini-2.5-flash", llm_response(500, 50), image_bytes=1024, latency_seconds=0.5)
+        unknown = tracker.record("openai/custom-proxy-model", llm_response(10, 1), image_bytes=1, latency_seconds=0.1)
+
+        models = tracker.stats().models
+        gemini = models["gemini/gemini-2.5-flash"]
+        assert (gemini.calls, gemini.prompt_tokens, gemini.completion_tokens) == (2, 1500, 150)
+        assert (gemini.image_bytes, gemini.latency_seconds) == (3072, 2.0)
+        assert gemini.cost_usd > 0
+        # The price of models unknown to LiteLLM can not be estimated
+        assert unknown.cost_usd is None
+        assert models["openai/custom-proxy-model"].cost_usd == 0
+
+    def test_response_without_usage(self, tmp_path: Path):
+        tracker = LLMUsageTracker(create_budget(tmp_path))
+
+        call = tracker.record("gemini/gemini-2.5-flash", object(), image_bytes=10, latency_seconds=0.1)
+
+        assert (call.prompt_tokens, call.completion_tokens, call.cost_usd) == (0, 0, None)
+
+    def test_collects_calls_of_request(self, tmp_path: Path):
+        tracker = LLMUsageTracker(create_budget(tmp_path))
+
+        with track_request("alice") as calls:
+            tracker.record("openai/custom-proxy-model", llm_response(1000, 100), image_bytes=10, latency_seconds=0.5)
+            tracker.record("openai/custom-proxy-model", llm_response(500, 50), image_bytes=10, latency_seconds=0.25)
+        tracker.record("openai/custom-proxy-model", llm_response(1, 1), image_bytes=10, latency_seconds=0.1)
+
+        assert len(calls) == 2
+        assert usage_headers(calls) == {
+            "X-LLM-Calls": "2",
+            "X-LLM-Prompt-Tokens": "1500",
+            "X-LLM-Completion-Tokens": "150",
+            "X-LLM-Latency-Ms": "750",
+        }
+
+
+class TestTokenBudget:
+    def test_daily_budget(self, tmp_path: Path):
+        budget = create_budget(tmp_path, daily_tokens=1000)
+        tracker = LLMUsageTracker(budget)
+
+        assert budget.select_model("gemini/gemini-2.5-flash") == "gemini/gemini-2.5-flash"
+        tracker.record("gemini/gemini-2.5-flash", llm_response(900, 100), image_bytes=10, latency_seconds=0.1)
+
+        with pytest.raises(TokenBudgetExceededError, match="Daily token budget exceeded.") as exc_info:
+            budget.select_model("gemini/gemini-2.5-flash")
+        assert 0 < exc_info.value.retry_after <= 24 * 60 * 60
+        assert budget.stats().model_dump() == {
+            "daily_tokens": 1000,
+            "client_daily_tokens": None,
+            "used_tokens_today": 1000,
+            "rejected": 1,
+            "downgraded": 0,
+        }
+
+    def test_client_budget(self, tmp_path: Path):
+        budget = create_budget(tmp_path, client_daily_tokens=1000)
+        tracker = LLMUsageTracker(budget)
+
+        with track_request("alice"):
+            tracker.record("gemini/gemini-2.5-flash", llm_response(1000, 100), image_bytes=10, latency_seconds=0.1)
+            with pytest.raises(TokenBudgetExceededError, match="Daily token budget of this client exceeded."):
+                budget.select_model("gemini/gemini-2.5-flash")
+
+        with track_request("bob"):
+            assert budget.select_model("gemini/gemini-2.5-flash") == "gemini/gemini-2.5-flash"
+
+    def test_budget_is_shared_between_processes(self, tmp_path: Path):
+        budget = create_budget(tmp_path, daily_tokens=1000)
+        LLMUsageTracker(budget).record(
+            "gemini/gemini-2.5-flash", llm_response(1000, 0), image_bytes=10, latency_seconds=0.1
+        )
+
+        with pytest.raises(TokenBudgetExceededError):
+            create_budget(tmp_path, daily_tokens=1000).select_model("gemini/gemini-2.5-flash")
+
+    def test_downgrade(self, tmp_path: Path):
+        budget = create_budget(
+            tmp_path, daily_tokens=10, exceeded_action="downgrade", downgrade_model="gemini/gemini-2.5-flash-lite"
+        )
+        LLMUsageTracker(budget).record("gemini/gemini-2.5-flash", llm_response(10, 0), image_bytes=1, latency_seconds=1)
+
+        assert budget.select_model("gemini/gemini-2.5-flash") == "gemini/gemini-2.5-flash-lite"
+        assert budget.stats().downgraded == 1
+
+    @pytest.mark.anyio
+    async def test_async_budget_is_read_and_written_off_the_event_loop(
+        self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+    ):
+        budget = create_budget(tmp_path, client_daily_tokens=1000)
+        tracker = LLMUsageTracker(budget)
+        threads = []
+        for name in ["_used_tokens", "add"]:
+            method = getattr(budget, name)
+
+            def in_thread(*args, method=method):
+                threads.append(threading.get_ident())
+                return method(*args)
+
+            monkeypatch.setattr(budget, name, in_thread)
+
+        with track_request("alice"):
+            assert await budget.aselect_model("gemini/gemini-2.5-flash") == "gemini/gemini-2.5-flash"
+            await tracker.arecord("gemini/gemini-2.5-flash", llm_response(1000, 100), image_bytes=10, latency_seconds=1)
+            with pytest.raises(TokenBudgetExceededError, match="Daily token budget of this client exceeded."):
+                await budget.aselect_model("gemini/gemini-2.5-flash")
+
+        assert len(threads) == 3
+        assert threading.get_ident() not in threads
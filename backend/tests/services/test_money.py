@@ -0,0 +1,42 @@
+import pytest
+
+from app.services.money import allocate, from_cents, split_evenly, to_cents
+
+
+def test_to_cents():
+    assert to_cents(12.34) == 1234
+    assert to_cents(0.1 + 0.2) == 30
+    assert to_cents(1.005) == 100  # 1.005 is 1.00499999999999989... as a float
+    assert from_cents(1234) == 12.34
+
+
+class TestAllocate:
+    def test_parts_add_up_to_the_total(self):
+        assert allocate(100, [1, 1, 1]) == [34, 33, 33]
+        assert allocate(1000, [3, 7]) == [300, 700]
+
+    def test_leftover_cents_go_to_the_largest_remainders(self):
+        # Exact parts are 14.2857, 28.5714 and 57.1428
+        assert allocate(100, [1, 2, 4]) == [14, 29, 57]
+
+    def test_ties_go_to_the_first_parts(self):
+        assert allocate(2, [1, 1, 1, 1]) == [1, 1, 0, 0]
+
+    def test_zero_weights_are_split_evenly(self):
+        assert allocate(5, [0, 0]) == [3, 2]
+        assert allocate(5, [0, 1]) == [0, 5]
+
+    @pytest.mark.parametrize("total", [0, 1, 99, 100_000, 123_456_789])
+    def test_random_weights(self, total: int):
+        weights = [7, 0, 13, 1, 250, 3]
+        parts = allocate(total, weights)
+
+        assert sum(parts) == total
+        for part, weight in zip(parts, weights):
+            assert abs(part - total * weight / sum(weights)) < 1
+
+
+def test_split_evenly():
+    assert split_evenly(100, 3) == [34, 33, 33]
+    assert split_evenly(90, 3) == [30, 30, 30]
+    assert split_evenly(1, 2) == [1, 0]
@@ -0,0 +1,150 @@
+import io
+import random
+import time
+
+import pytest
+from PIL import Image, ImageDraw
+
+from app.services.near_duplicates import NearDuplicateIndex, dhash
+
+HASH_SIZE = 16
+MAX_DISTANCE = 10
+PROMPT_VERSION = "1"
+
+
+def build_receipt(seed: int, width: int = 1500, height: int = 2000) -> Image.Image:
+    """A white receipt with words of random lengths, lying in the middle of a dark table."""
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), (40, 30, 20))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((width // 4, height // 8, width * 3 // 4, height * 7 // 8), fill=(250, 250, 245))
+    for line in range(height // 8 + 60, height * 7 // 8 - 60, 60):
+        x = width // 4 + 30
+        while x < width * 3 // 4 - 60:
+            word_width = rng.randint(20, 120)
+            draw.rectangle((x, line, min(x + word_width, width * 3 // 4 - 30), line + 25), fill=(20, 20, 20))
+            x += word_width + rng.randint(15, 60)
+    return image
+
+
+def encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+class TestDHash:
+    def test_same_receipt_is_close(self):
+        receipt = build_receipt(seed=1)
+        original = dhash(encode_jpeg(receipt, quality=90), HASH_SIZE)
+        assert original is not None
+
+        for image_bytes in [encode_jpeg(receipt, quality=60), encode_jpeg(receipt.resize((1200, 1600)), quality=70)]:
+            image_hash = dhash(image_bytes, HASH_SIZE)
+            assert image_hash is not None
+            assert (image_hash ^ original).bit_count() <= MAX_DISTANCE
+
+    def test_other_receipts_are_far(self):
+        original = dhash(encode_jpeg(build_receipt(seed=1), quality=90), HASH_SIZE)
+        assert original is not None
+
+        for seed in range(2, 6):
+            image_hash = dhash(encode_jpeg(build_receipt(seed=seed), quality=90), HASH_SIZE)
+            assert image_hash is not None
+            assert (image_hash ^ original).bit_count() > 2 * MAX_DISTANCE
+
+    def test_same_layout_with_other_contents_is_close(self):
+        """The reason near-duplicate detection is opt-in: the hash cannot tell amounts apart."""
+        receipt = build_receipt(seed=1)
+        original = dhash(encode_jpeg(receipt, quality=90), HASH_SIZE)
+        assert original is not None
+
+        # Another total on the last line of the same receipt
+        other_total = receipt.copy()
+        draw = ImageDraw.Draw(other_total)
+        draw.rectangle((1000, 1700, 1100, 1725), fill=(250, 250, 245))
+        draw.rectangle((1000, 1700, 1040, 1725), fill=(20, 20, 20))
+        image_hash = dhash(encode_jpeg(other_total, quality=90), HASH_SIZE)
+        assert image_hash is not None
+        assert (image_hash ^ original).bit_count() <= MAX_DISTANCE
+
+    def test_undecodable_image(self):
+        assert dhash(b"not an image", HASH_SIZE) is None
+
+    def test_decompression_bomb(self, monkeypatch: pytest.MonkeyPatch):
+        image_bytes = encode_jpeg(build_receipt(seed=1), quality=90)
+        monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+        assert dhash(image_bytes, HASH_SIZE) is None
+
+
+class TestNearDuplicateIndex:
+    @pytest.fixture
+    def index(self) -> NearDuplicateIndex:
+        return NearDuplicateIndex(hash_size=HASH_SIZE, max_distance=MAX_DISTANCE, max_entries=100)
+
+    def test_finds_closest_within_distance(self, index: NearDuplicateIndex):
+        image_hash = random.Random(0).getrandbits(HASH_SIZE**2)
+        index.add(image_hash, PROMPT_VERSION, "original")
+        index.add(image_hash ^ 0b111, PROMPT_VERSION, "three bits off")
+
+        assert index.find(image_hash, PROMPT_VERSION) == "original"
+        assert index.find(image_hash ^ 0b1, PROMPT_VERSION) == "original"
+        assert index.find(image_hash ^ 0b11, PROMPT_VERSION) == "three bits off"
+        # Ten bits spread over the hash, so that they fall in different chunks
+        assert index.find(image_hash ^ sum(1 << (bit * 25) for bit in range(10)), PROMPT_VERSION) == "original"
+        assert index.find(image_hash ^ sum(1 << (bit * 23) for bit in range(11)), PROMPT_VERSION) is None
+
+        assert index.stats().model_dump() == {"enabled": True, "entries": 2, "lookups": 5, "hits": 4}
+
+    def test_evicts_least_recently_used(self):
+        index = NearDuplicateIndex(hash_size=HASH_SIZE, max_distance=MAX_DISTANCE, max_entries=2)
+        rng = random.Random(0)
+        first, second, third = (rng.getrandbits(HASH_SIZE**2) for _ in range(3))
+        index.add(first, PROMPT_VERSION, "first")
+        index.add(second, PROMPT_VERSION, "second")
+        assert index.find(first, PROMPT_VERSION) == "first"
+
+        index.add(third, PROMPT_VERSION, "third")
+
+        assert index.find(second, PROMPT_VERSION) is None
+        assert index.find(first, PROMPT_VERSION) == "first"
+        assert index.find(third, PROMPT_VERSION) == "third"
+        assert index.stats().entries == 2
+
+    def test_partitioned_by_prompt_version(self):
+        index = NearDuplicateIndex(hash_size=HASH_SIZE, max_distance=MAX_DISTANCE, max_entries=2)
+        image_hash = random.Random(0).getrandbits(HASH_SIZE**2)
+        index.add(image_hash, "1", "untiled")
+        index.add(image_hash ^ 0b1, "1-tiled", "tiled")
+
+        assert index.find(image_hash, "1") == "untiled"
+        assert index.find(image_hash, "1-tiled") == "tiled"
+        assert index.find(image_hash, "2") is None
+
+        # Evicted from its own partition only
+        index.add(image_hash, "2", "new prompt")
+        assert index.find(image_hash, "1") is None
+        assert index.find(image_hash ^ 0b1, "1-tiled") == "tiled"
+        assert index.stats().entries == 2
+
+    def test_disabled(self):
+        index = NearDuplicateIndex(hash_size=HASH_SIZE, max_distance=MAX_DISTANCE, max_entries=2, enabled=False)
+        assert index.hash_image(encode_jpeg(build_receipt(seed=1), quality=90)) is None
+
+    def test_invalid_distance(self):
+        with pytest.raises(ValueError):
+            NearDuplicateIndex(hash_size=4, max_distance=16, max_entries=2)
+
+    def test_lookup_is_fast(self):
+        index = NearDuplicateIndex(hash_size=HASH_SIZE, max_distance=MAX_DISTANCE, max_entries=50_000)
+        rng = random.Random(0)
+        hashes = [rng.getrandbits(HASH_SIZE**2) for _ in range(20_000)]
+        for position, image_hash in enumerate(hashes):
+            index.add(image_hash, PROMPT_VERSION, str(position))
+
+        start = time.perf_counter()
+        for image_hash in hashes[:1000]:
+            index.find(image_hash ^ 0b1011, PROMPT_VERSION)
+        elapsed = time.perf_counter() - start
+
+        assert elapsed / 1000 < 0.001
@@ -0,0 +1,90 @@
+import time
+from pathlib import Path
+
+import pytest
+
+from app.services.ocr_cache import OCRCache, make_cache_key
+
+
+def build_cache(path: Path, **kwargs) -> OCRCache:
+    options = {"memory_max_entries": 2, "disk_max_entries": 3, "ttl_seconds": 60}
+    options.update(kwargs)
+    return OCRCache(path=path / "ocr_cache.sqlite3", **options)
+
+
+class TestMakeCacheKey:
+    def test_depends_on_image_model_and_prompt(self):
+        key = make_cache_key(b"image", "openai/gpt-4o", "1")
+
+        assert key == make_cache_key(b"image", "openai/gpt-4o", "1")
+        assert key != make_cache_key(b"other image", "openai/gpt-4o", "1")
+        assert key != make_cache_key(b"image", "gemini/gemini-2.5-flash", "1")
+        assert key != make_cache_key(b"image", "openai/gpt-4o", "2")
+
+
+class TestOCRCache:
+    def test_miss_then_memory_hit(self, tmp_path: Path):
+        cache = build_cache(tmp_path)
+
+        assert cache.get("key") is None
+        cache.set("key", "value")
+        assert cache.get("key") == "value"
+
+        stats = cache.stats()
+        assert (stats.memory_hits, stats.disk_hits, stats.misses) == (1, 0, 1)
+
+    def test_disk_tier_is_shared_between_processes(self, tmp_path: Path):
+        writer = build_cache(tmp_path)
+        reader = build_cache(tmp_path)
+
+        writer.set("key", "value")
+
+        assert reader.get("key") == "value"
+        assert reader.get("key") == "value"
+        stats = reader.stats()
+        assert (stats.memory_hits, stats.disk_hits, stats.misses) == (1, 1, 0)
+
+    def test_memory_tier_is_bounded(self, tmp_path: Path):
+        cache = build_cache(tmp_path)
+
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+
+        assert cache.stats().memory_entries == 2
+        # Evicted from memory, but still available on disk
+        assert cache.get("a") == "a"
+        assert cache.stats().disk_hits == 1
+
+    def test_disk_tier_evicts_least_recently_used(self, tmp_path: Path):
+        cache = build_cache(tmp_path)
+        reader = build_cache(tmp_path)
+
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+            time.sleep(0.01)
+        # Touch "a" so that "b" becomes the least recently used entry
+        assert reader.get("a") == "a"
+        time.sleep(0.01)
+        cache.set("d", "d")
+
+        fresh_reader = build_cache(tmp_path)
+        assert fresh_reader.get("b") is None
+        assert [fresh_reader.get(key) for key in ("a", "c", "d")] == ["a", "c", "d"]
+
+    def test_expired_entries_are_dropped(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+        cache = build_cache(tmp_path, ttl_seconds=10)
+        cache.set("key", "value")
+
+        now = time.time()
+        monkeypatch.setattr("app.services.ocr_cache.time.time", lambda: now + 11)
+
+        assert cache.get("key") is None
+        assert build_cache(tmp_path).get("key") is None
+
+    def test_disabled(self, tmp_path: Path):
+        cache = build_cache(tmp_path, enabled=False)
+
+        cache.set("key", "value")
+
+        assert cache.get("key") is None
+        assert not (tmp_path / "ocr_cache.sqlite3").exists()
@@ -0,0 +1,81 @@
+import time
+from pathlib import Path
+
+import pytest
+
+from app.schemas.bill import OCRBill
+from app.services.image_preprocessing import ImagePreprocessor
+from app.services.ocr_engines import LiteLLMEngine, LocalOCREngine, create_ocr_engine
+from tests import examples
+
+OTHER_OCR_BILL = examples.simple_bill.OCR_BILL.model_copy(update={"amount_paid": 1000.0})
+from tests.services.test_near_duplicates import build_receipt, encode_jpeg
+
+
+@pytest.fixture
+def fixtures_dir(tmp_path: Path) -> Path:
+    (tmp_path / "simple.jpg").write_bytes(encode_jpeg(build_receipt(seed=1), quality=90))
+    (tmp_path / "simple.json").write_text(examples.simple_bill.OCR_BILL.model_dump_json())
+    (tmp_path / "discounted.jpg").write_bytes(encode_jpeg(build_receipt(seed=2), quality=90))
+    (tmp_path / "discounted.json").write_text(OTHER_OCR_BILL.model_dump_json())
+    return tmp_path
+
+
+class TestLocalOCREngine:
+    def test_fixtures_are_matched(self, fixtures_dir: Path):
+        engine = LocalOCREngine(fixtures_dir)
+
+        for seed, bill in [(1, examples.simple_bill.OCR_BILL), (2, OTHER_OCR_BILL)]:
+            image_bytes = encode_jpeg(build_receipt(seed=seed), quality=60)
+            assert OCRBill.model_validate_json(engine.get_bill_details_from_image(image_bytes, "image/jpeg")) == bill
+
+    def test_fixtures_are_matched_after_preprocessing(self, fixtures_dir: Path):
+        preprocessor = ImagePreprocessor(max_edge=1024, image_format="JPEG", quality=85)
+        engine = LocalOCREngine(fixtures_dir, preprocessor)
+
+        image = preprocessor.preprocess(encode_jpeg(build_receipt(seed=1), quality=90), "image/jpeg")
+
+        bill_data = engine.get_bill_details_from_image(image.content, image.mime_type)
+        assert OCRBill.model_validate_json(bill_data) == examples.simple_bill.OCR_BILL
+
+    def test_synthetic_bill(self, fixtures_dir: Path):
+        engine = LocalOCREngine(fixtures_dir)
+        image_bytes = encode_jpeg(build_receipt(seed=3), quality=90)
+
+        bill_data = engine.get_bill_details_from_image(image_bytes, "image/jpeg")
+
+        bill = OCRBill.model_validate_json(bill_data)
+        assert bill not in (examples.simple_bill.OCR_BILL, OTHER_OCR_BILL)
+        assert engine.get_bill_details_from_image(image_bytes, "image/jpeg") == bill_data
+        assert LocalOCREngine().get_bill_details_from_image(b"not an image", "image/png") != bill_data
+
+    def test_simulated_latency(self):
+        engine = LocalOCREngine(latency_seconds=0.1, latency_jitter_seconds=0.05)
+
+        start = time.perf_counter()
+        engine.get_bill_details_from_image(b"fake-image-bytes", "image/png")
+
+        assert 0.1 <= time.perf_counter() - start < 0.5
+
+    @pytest.mark.anyio
+    async def test_async_and_stream_match_sync(self, fixtures_dir: Path):
+        engine = LocalOCREngine(fixtures_dir, latency_seconds=0.05)
+        image_bytes = encode_jpeg(build_receipt(seed=1), quality=90)
+
+        bill_data = engine.get_bill_details_from_image(image_bytes, "image/jpeg")
+        start = time.perf_counter()
+        chunks = [chunk async for chunk in engine.astream_bill_details_from_image(image_bytes, "image/jpeg")]
+
+        assert time.perf_counter() - start >= 0.05
+        assert len(chunks) > 1
+        assert "".join(chunks) == bill_data
+        assert await engine.aget_bill_details_from_image(image_bytes, "image/jpeg") == bill_data
+
+
+def test_engine_is_selected_in_settings(monkeypatch: pytest.MonkeyPatch):
+    assert isinstance(create_ocr_engine(), LiteLLMEngine)
+
+    monkeypatch.setattr("app.services.ocr_engines.settings.OCR_ENGINE", "local")
+    engine = create_ocr_engine()
+    assert isinstance(engine, LocalOCREngine)
+    assert engine.model == "local"
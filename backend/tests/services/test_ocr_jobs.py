@@ -0,0 +1,257 @@
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+
+from app.schemas.ocr_job import OCRJobStatus
+from app.services.admission import AdmissionController
+from app.services.ocr_jobs import (
+    InMemoryOCRJobBackend,
+    OCRJobBackend,
+    OCRJobWorkerPool,
+    RedisOCRJobBackend,
+    SQLiteOCRJobBackend,
+)
+from app.services.redis_client import RedisClient
+from tests import examples
+
+RETENTION_SECONDS = 60
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request: pytest.FixtureRequest, tmp_path: Path) -> OCRJobBackend:
+    match request.param:
+        case "memory":
+            return InMemoryOCRJobBackend(retention_seconds=RETENTION_SECONDS)
+        case "sqlite":
+            return SQLiteOCRJobBackend(path=tmp_path / "ocr_jobs.sqlite3", retention_seconds=RETENTION_SECONDS)
+        case "redis":
+            redis_url = request.getfixturevalue("redis_url")
+            return RedisOCRJobBackend(client=RedisClient(redis_url), retention_seconds=RETENTION_SECONDS)
+    raise ValueError(request.param)
+
+
+class TestOCRJobBackend:
+    def test_lifecycle(self, backend: OCRJobBackend):
+        job = backend.submit(b"image", "image/png")
+        assert job.status == OCRJobStatus.PENDING
+        assert backend.get(job.id) == job
+
+        claimed = backend.claim()
+        assert claimed is not None
+        assert (claimed.job.id, claimed.job.status) == (job.id, OCRJobStatus.RUNNING)
+        assert (claimed.image, claimed.mime_type) == (b"image", "image/png")
+        assert backend.claim() is None
+
+        backend.complete(job.id, examples.simple_bill.OCR_BILL)
+        finished = backend.get(job.id)
+        assert finished is not None
+        assert finished.status == OCRJobStatus.SUCCEEDED
+        assert finished.result == examples.simple_bill.OCR_BILL
+        assert finished.is_finished
+
+    def test_failure(self, backend: OCRJobBackend):
+        job = backend.submit(b"image", "image/png")
+        assert backend.claim() is not None
+
+        backend.fail(job.id, "Could not extract bill details")
+
+        failed = backend.get(job.id)
+        assert failed is not None
+        assert (failed.status, failed.result, failed.error) == (
+            OCRJobStatus.FAILED,
+            None,
+            "Could not extract bill details",
+        )
+
+    def test_claims_in_submission_order(self, backend: OCRJobBackend):
+        jobs = [backend.submit(f"image {i}".encode(), "image/png") for i in range(3)]
+
+        claimed = [backend.claim() for _ in range(3)]
+
+        assert [job.id for job in jobs] == [claim.job.id for claim in claimed if claim is not None]
+
+    def test_release_puts_job_back_first(self, backend: OCRJobBackend):
+        first = backend.submit(b"first", "image/png")
+        backend.submit(b"second", "image/png")
+        assert backend.claim() is not None
+
+        backend.release(first.id)
+
+        released = backend.get(first.id)
+        assert released is not None and released.status == OCRJobStatus.PENDING
+        claimed = backend.claim()
+        assert claimed is not None and claimed.job.id == first.id
+
+    def test_requeue_stale(self, backend: OCRJobBackend):
+        job = backend.submit(b"image", "image/png")
+        assert backend.claim() is not None
+
+        assert backend.requeue_stale(lease_seconds=60) == 0
+        time.sleep(0.02)
+        assert backend.requeue_stale(lease_seconds=0.01) == 1
+
+        claimed = backend.claim()
+        assert claimed is not None and claimed.job.id == job.id
+
+    def test_renew(self, backend: OCRJobBackend):
+        job = backend.submit(b"image", "image/png")
+        assert backend.claim() is not None
+
+        time.sleep(0.05)
+        backend.renew(job.id)
+
+        assert backend.requeue_stale(lease_seconds=0.04) == 0
+        running = backend.get(job.id)
+        assert running is not None and running.status == OCRJobStatus.RUNNING
+
+        # A finished job is not claimed again
+        backend.complete(job.id, examples.simple_bill.OCR_BILL)
+        backend.renew(job.id)
+        assert backend.requeue_stale(lease_seconds=0) == 0
+
+    def test_unknown_job(self, backend: OCRJobBackend):
+        assert backend.get("unknown") is None
+
+
+class TestPersistence:
+    def test_sqlite_jobs_survive_restart(self, tmp_path: Path):
+        path = tmp_path / "ocr_jobs.sqlite3"
+        job = SQLiteOCRJobBackend(path=path, retention_seconds=RETENTION_SECONDS).submit(b"image", "image/png")
+
+        restarted = SQLiteOCRJobBackend(path=path, retention_seconds=RETENTION_SECONDS)
+
+        claimed = restarted.claim()
+        assert claimed is not None and claimed.job.id == job.id
+
+    def test_redis_jobs_survive_restart(self, redis_url: str):
+        job = RedisOCRJobBackend(RedisClient(redis_url), retention_seconds=RETENTION_SECONDS).submit(
+            b"image", "image/png"
+        )
+
+        restarted = RedisOCRJobBackend(RedisClient(redis_url), retention_seconds=RETENTION_SECONDS)
+
+        claimed = restarted.claim()
+        assert claimed is not None and claimed.job.id == job.id
+
+
+class TestOCRJobWorkerPool:
+    @pytest.fixture
+    def extracted_images(self, monkeypatch: pytest.MonkeyPatch) -> list[bytes]:
+        extracted: list[bytes] = []
+
+        async def mock_get_bill_details_from_image(image_bytes: bytes, mime_type: str):
+            extracted.append(image_bytes)
+            if image_bytes == b"unreadable":
+                raise ValueError("No content in LiteLLM response")
+            return examples.simple_bill.OCR_BILL
+
+        monkeypatch.setattr("app.services.ocr_jobs.aget_bill_details_from_image", mock_get_bill_details_from_image)
+        return extracted
+
+    @pytest.mark.anyio
+    async def test_processes_jobs(self, extracted_images: list[bytes]):
+        backend = InMemoryOCRJobBackend(retention_seconds=RETENTION_SECONDS)
+        pool = OCRJobWorkerPool(backend, workers=2, poll_interval=0.01, lease_seconds=60)
+        readable = backend.submit(b"readable", "image/png")
+        unreadable = backend.submit(b"unreadable", "image/png")
+
+        pool.start()
+        try:
+            for _ in range(100):
+                jobs = [backend.get(readable.id), backend.get(unreadable.id)]
+                if all(job is not None and job.is_finished for job in jobs):
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await pool.stop()
+
+        succeeded, failed = backend.get(readable.id), backend.get(unreadable.id)
+        assert succeeded is not None and succeeded.result == examples.simple_bill.OCR_BILL
+        assert failed is not None and failed.error == "Could not extract bill details: No content in LiteLLM response"
+        assert sorted(extracted_images) == [b"readable", b"unreadable"]
+
+    @pytest.mark.anyio
+    async def test_stop_releases_running_jobs(self, monkeypatch: pytest.MonkeyPatch):
+        started = asyncio.Event()
+
+        async def never_finishes(image_bytes: bytes, mime_type: str):
+            started.set()
+            await asyncio.sleep(3600)
+
+        monkeypatch.setattr("app.services.ocr_jobs.aget_bill_details_from_image", never_finishes)
+        backend = InMemoryOCRJobBackend(retention_seconds=RETENTION_SECONDS)
+        pool = OCRJobWorkerPool(backend, workers=1, poll_interval=0.01, lease_seconds=60)
+        job = backend.submit(b"image", "image/png")
+
+        pool.start()
+        await asyncio.wait_for(started.wait(), timeout=1)
+        await pool.stop()
+
+        released = backend.get(job.id)
+        assert released is not None and released.status == OCRJobStatus.PENDING
+
+    @pytest.mark.anyio
+    async def test_jobs_hold_ocr_slots(self, monkeypatch: pytest.MonkeyPatch):
+        in_flight = [0]
+        max_in_flight = [0]
+
+        async def mock_get_bill_details_from_image(image_bytes: bytes, mime_type: str):
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            try:
+                await asyncio.sleep(0.05)
+                return examples.simple_bill.OCR_BILL
+            finally:
+                in_flight[0] -= 1
+
+        monkeypatch.setattr("app.services.ocr_jobs.aget_bill_details_from_image", mock_get_bill_details_from_image)
+        controller = AdmissionController(max_in_flight=1, max_queued=1, queue_timeout_seconds=5)
+        monkeypatch.setattr("app.services.ocr_jobs.ocr_admission", controller)
+        backend = InMemoryOCRJobBackend(retention_seconds=RETENTION_SECONDS)
+        pool = OCRJobWorkerPool(backend, workers=3, poll_interval=0.01, lease_seconds=60)
+        jobs = [backend.submit(f"image {i}".encode(), "image/png") for i in range(3)]
+
+        pool.start()
+        try:
+            for _ in range(500):
+                finished = [backend.get(job.id) for job in jobs]
+                if all(job is not None and job.is_finished for job in finished):
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await pool.stop()
+
+        # The third job found the queue full, and waited to retry rather than failing
+        assert all(backend.get(job.id).status == OCRJobStatus.SUCCEEDED for job in jobs)
+        assert max_in_flight[0] == 1
+        assert controller.stats().rejected_queue_full >= 1
+
+    @pytest.mark.anyio
+    async def test_lease_is_renewed_while_processing(self, monkeypatch: pytest.MonkeyPatch):
+        extracted: list[bytes] = []
+
+        async def slow_get_bill_details_from_image(image_bytes: bytes, mime_type: str):
+            extracted.append(image_bytes)
+            await asyncio.sleep(0.5)
+            return examples.simple_bill.OCR_BILL
+
+        monkeypatch.setattr("app.services.ocr_jobs.aget_bill_details_from_image", slow_get_bill_details_from_image)
+        backend = InMemoryOCRJobBackend(retention_seconds=RETENTION_SECONDS)
+        pool = OCRJobWorkerPool(backend, workers=2, poll_interval=0.01, lease_seconds=0.15)
+        job = backend.submit(b"image", "image/png")
+
+        pool.start()
+        try:
+            for _ in range(100):
+                finished = backend.get(job.id)
+                if finished is not None and finished.is_finished:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await pool.stop()
+
+        # Outlasting its lease, the job was still not put back in the queue for the other worker
+        assert finished is not None and finished.status == OCRJobStatus.SUCCEEDED
+        assert extracted == [b"image"]
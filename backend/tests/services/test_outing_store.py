@@ -0,0 +1,149 @@
+import random
+from pathlib import Path
+
+import pytest
+
+from app.schemas.bill import Bill, Outing, OutingSplit
+from app.schemas.outing import BillUpdate
+from app.services.bill import calculate_outing_split_with_minimal_transactions, settle_balances
+from app.services.ledger import OutingLedger
+from app.services.outing_store import InMemoryOutingStore, OutingStore, SQLiteOutingStore
+from tests import examples
+from tests.services.test_ledger import random_bills
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request: pytest.FixtureRequest, tmp_path: Path) -> OutingStore:
+    match request.param:
+        case "memory":
+            return InMemoryOutingStore()
+        case "sqlite":
+            return SQLiteOutingStore(path=tmp_path / "outings.sqlite3")
+    raise ValueError(request.param)
+
+
+@pytest.fixture
+def split_calls(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    calls = []
+
+    def counting_split(people, balances, strategy="greedy"):
+        calls.append(strategy)
+        return settle_balances(people, balances, strategy)
+
+    monkeypatch.setattr("app.services.outing_store.settle_balances", counting_split)
+    monkeypatch.setattr("app.services.ledger.settle_balances", counting_split)
+    return calls
+
+
+class TestOutingStore:
+    def test_lifecycle(self, store: OutingStore):
+        outing = store.create(examples.multiple_bills.OUTING.bills[:1])
+        assert [Bill.model_validate(bill.model_dump(exclude={"id"})) for bill in outing.bills] == (
+            examples.multiple_bills.OUTING.bills[:1]
+        )
+
+        for bill in examples.multiple_bills.OUTING.bills[1:]:
+            assert store.add_bill(outing.id, bill) is not None
+        assert store.split(outing.id) == examples.multiple_bills.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS
+
+        stored = store.get(outing.id)
+        assert stored is not None
+        assert [bill.id for bill in stored.bills] == list(range(len(examples.multiple_bills.OUTING.bills)))
+        assert stored.updated_at >= stored.created_at
+
+        for bill in stored.bills:
+            assert store.remove_bill(outing.id, bill.id)
+        assert store.split(outing.id) == OutingSplit(payment_plans=[])
+        assert store.get(outing.id).bills == []
+
+    def test_update_bill(self, store: OutingStore):
+        outing = store.create([examples.simple_bill.OUTING.bills[0]])
+
+        updated = store.update_bill(outing.id, 0, BillUpdate(paid_by="Charlie", amount_paid=100.0))
+
+        assert updated is not None
+        assert (updated.paid_by, updated.amount_paid) == ("charlie", 100.0)
+        assert updated.items == examples.simple_bill.OUTING.bills[0].items
+        assert store.get(outing.id).bills == [updated]
+        ledger = OutingLedger()
+        ledger.add_bill(Bill.model_validate(updated.model_dump(exclude={"id"})))
+        assert store.split(outing.id) == ledger.split()
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_matches_ledger(self, store: OutingStore, seed: int):
+        rng = random.Random(seed)
+        candidates = random_bills(seed, 20)
+        outing = store.create([])
+        ledger = OutingLedger()
+        bill_ids: list[int] = []
+
+        for _ in range(30):
+            operation = rng.choice(["add", "add", "update", "remove"]) if bill_ids else "add"
+            if operation == "add":
+                bill = rng.choice(candidates)
+                stored_bill = store.add_bill(outing.id, bill)
+                assert stored_bill is not None and stored_bill.id == ledger.add_bill(bill)
+                bill_ids.append(stored_bill.id)
+            elif operation == "update":
+                bill_id, bill = rng.choice(bill_ids), rng.choice(candidates)
+                assert store.update_bill(outing.id, bill_id, BillUpdate(**bill.model_dump())) is not None
+                ledger.replace_bill(bill_id, bill)
+            else:
+                bill_id = rng.choice(bill_ids)
+                assert store.remove_bill(outing.id, bill_id)
+                ledger.remove_bill(bill_id)
+                bill_ids.remove(bill_id)
+
+            assert store.split(outing.id) == ledger.split()
+            assert store.split(outing.id, "exact") == ledger.split("exact")
+
+    def test_split_is_cached_until_balances_change(self, store: OutingStore, split_calls: list[str]):
+        outing = store.create(examples.multiple_bills.OUTING.bills)
+
+        first = store.split(outing.id)
+        assert store.split(outing.id) == first
+        assert split_calls == ["greedy"]
+        store.split(outing.id, "exact")
+        store.split(outing.id, "exact")
+        assert split_calls == ["greedy", "exact"]
+
+        # Same balances
+        items = examples.multiple_bills.OUTING.bills[0].items
+        store.update_bill(
+            outing.id, 0, BillUpdate(items=[item.model_copy(update={"name": "renamed"}) for item in items])
+        )
+        store.split(outing.id)
+        assert split_calls == ["greedy", "exact"]
+
+        store.add_bill(outing.id, examples.simple_bill.OUTING.bills[0])
+        assert store.split(outing.id) != first
+        assert split_calls == ["greedy", "exact", "greedy"]
+
+    def test_unknown_outing_or_bill(self, store: OutingStore):
+        bill = examples.simple_bill.OUTING.bills[0]
+        assert store.get("unknown") is None
+        assert store.add_bill("unknown", bill) is None
+        assert store.split("unknown") is None
+
+        outing = store.create([bill])
+        assert store.update_bill(outing.id, 1, BillUpdate(amount_paid=1.0)) is None
+        assert store.update_bill("unknown", 0, BillUpdate(amount_paid=1.0)) is None
+        assert not store.remove_bill(outing.id, 1)
+        assert not store.remove_bill("unknown", 0)
+
+
+def test_sqlite_outings_persist(tmp_path: Path):
+    path = tmp_path / "outings.sqlite3"
+    outing = SQLiteOutingStore(path).create(examples.multiple_bills.OUTING.bills)
+    split = SQLiteOutingStore(path).split(outing.id)
+
+    reopened = SQLiteOutingStore(path)
+
+    assert reopened.get(outing.id) == outing
+    assert (
+        reopened.split(outing.id)
+        == split
+        == calculate_outing_split_with_minimal_transactions(
+            OutingLedger.from_outing(Outing(bills=examples.multiple_bills.OUTING.bills)).balance()
+        )
+    )
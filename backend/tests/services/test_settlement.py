@@ -0,0 +1,71 @@
+import random
+from functools import cache
+
+import pytest
+
+from app.services.settlement import zero_sum_groups
+
+
+def most_zero_sum_groups(balances: tuple[int, ...]) -> int:
+    """
+    Count the groups of the best split by trying every way of splitting the balances.
+    """
+
+    @cache
+    def best(people: frozenset[int]) -> int:
+        if not people:
+            return 0
+        first = min(people)
+        others = sorted(people - {first})
+        result = 0
+        for mask in range(1 << len(others)):
+            group = {first, *(others[bit] for bit in range(len(others)) if mask >> bit & 1)}
+            if sum(balances[index] for index in group) == 0:
+                result = max(result, 1 + best(people - group))
+        return result
+
+    return best(frozenset(index for index, balance in enumerate(balances) if balance))
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_groups_are_optimal(seed: int):
+    rng = random.Random(seed)
+    balances = [rng.randint(-6, 6) for _ in range(rng.randint(1, 9))]
+    balances.append(-sum(balances))
+
+    groups = zero_sum_groups(balances)
+
+    assert groups is not None
+    assert sorted(index for group in groups for index in group) == [
+        index for index, balance in enumerate(balances) if balance
+    ]
+    assert all(sum(balances[index] for index in group) == 0 for group in groups)
+    assert len(groups) == most_zero_sum_groups(tuple(balances))
+
+
+def test_groups_are_in_order():
+    assert zero_sum_groups([7, 3, -5, -3, -2, 0]) == [[0, 2, 4], [1, 3]]
+    assert zero_sum_groups([0, 0]) == []
+
+
+def test_too_many_people():
+    balances = [2**index for index in range(10)]
+    balances.append(-sum(balances))
+
+    assert zero_sum_groups(balances, max_people=10) is None
+    assert zero_sum_groups(balances, max_people=11) == [list(range(11))]
+
+
+def test_opposite_pairs_do_not_count_towards_max_people():
+    balances = [5, -5, 3, -3, 1, -1]
+
+    assert zero_sum_groups(balances, max_people=0) == [[0, 1], [2, 3], [4, 5]]
+
+
+def test_time_budget():
+    rng = random.Random(0)
+    balances = [rng.randint(-1000, 1000) for _ in range(17)]
+    balances.append(-sum(balances))
+
+    assert zero_sum_groups(balances, time_budget_seconds=0) is None
+    assert zero_sum_groups(balances, time_budget_seconds=10) is not None
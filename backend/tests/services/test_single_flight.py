@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.services.single_flight import SingleFlight
+
+
+class TestSingleFlight:
+    def test_coalesces_concurrent_calls(self):
+        single_flight: SingleFlight[int] = SingleFlight()
+        calls = []
+
+        def slow_call() -> int:
+            calls.append(1)
+            time.sleep(0.1)
+            return 42
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: single_flight.do("key", slow_call), range(4)))
+
+        assert results == [42] * 4
+        assert len(calls) == 1
+        assert single_flight.stats().model_dump() == {"in_flight": 0, "calls": 1, "coalesced": 3}
+
+    def test_sequential_calls_are_not_coalesced(self):
+        single_flight: SingleFlight[int] = SingleFlight()
+
+        assert single_flight.do("key", lambda: 1) == 1
+        assert single_flight.do("key", lambda: 2) == 2
+        assert single_flight.do("other", lambda: 3) == 3
+        assert single_flight.stats().coalesced == 0
+
+    def test_error_is_raised_to_every_caller(self):
+        single_flight: SingleFlight[int] = SingleFlight()
+        started = threading.Event()
+
+        def failing_call() -> int:
+            started.set()
+            time.sleep(0.1)
+            raise ValueError("No content in LiteLLM response")
+
+        def call() -> str:
+            try:
+                single_flight.do("key", failing_call)
+            except ValueError as e:
+                return str(e)
+            return "no error"
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(call)
+            started.wait()
+            follower = executor.submit(call)
+            results = [leader.result(), follower.result()]
+
+        assert results == ["No content in LiteLLM response"] * 2
+        assert single_flight.stats().model_dump() == {"in_flight": 0, "calls": 1, "coalesced": 1}
+
+    @pytest.mark.anyio
+    async def test_async_coalesces_concurrent_calls(self):
+        single_flight: SingleFlight[int] = SingleFlight()
+        calls = []
+
+        async def slow_call() -> int:
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return 42
+
+        results = await asyncio.gather(*(single_flight.ado("key", slow_call()) for _ in range(4)))
+
+        assert results == [42] * 4
+        assert len(calls) == 1
+        assert single_flight.stats().model_dump() == {"in_flight": 0, "calls": 1, "coalesced": 3}
+
+    @pytest.mark.anyio
+    async def test_async_error_is_raised_to_every_caller(self):
+        single_flight: SingleFlight[int] = SingleFlight()
+
+        async def failing_call() -> int:
+            await asyncio.sleep(0.1)
+            raise ValueError("No content in LiteLLM response")
+
+        results = await asyncio.gather(
+            *(single_flight.ado("key", failing_call()) for _ in range(2)), return_exceptions=True
+        )
+
+        assert [str(result) for result in results] == ["No content in LiteLLM response"] * 2
+
+    @pytest.mark.anyio
+    async def test_cancelled_caller_does_not_cancel_the_others(self):
+        single_flight: SingleFlight[int] = SingleFlight()
+
+        async def slow_call() -> int:
+            await asyncio.sleep(0.1)
+            return 42
+
+        leader = asyncio.create_task(single_flight.ado("key", slow_call()))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(single_flight.ado("key", slow_call()))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        assert await follower == 42
+        assert leader.cancelled()
@@ -0,0 +1,81 @@
+import asyncio
+import os
+from collections.abc import AsyncIterator
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from app.schemas.bill import SplitBatchResult
+from app.services.split_pool import SplitPool, split_outing
+from tests import examples
+
+EXAMPLES = [examples.simple_bill, examples.multiple_bills, examples.simple_bill_discounted]
+
+
+def test_split_outing():
+    for example in EXAMPLES:
+        result = split_outing(example.OUTING.model_dump(), "greedy")
+        assert result == SplitBatchResult(split=example.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS)
+
+
+@pytest.mark.parametrize(
+    "data, error",
+    [
+        ({"bills": []}, "Invalid outing: bills: List should have at least 1 item after validation, not 0"),
+        ([], "Invalid outing: outing: Input should be a valid dictionary or instance of Outing"),
+        (
+            {"bills": [{**examples.simple_bill.OUTING.bills[0].model_dump(), "amount_paid": 0}]},
+            "Invalid outing: bills.0.amount_paid: Input should be greater than 0",
+        ),
+    ],
+)
+def test_split_invalid_outing(data, error: str):
+    assert split_outing(data, "greedy") == SplitBatchResult(error=error)
+
+
+def test_split_outing_failure(monkeypatch: pytest.MonkeyPatch):
+    def failing_split(*_):
+        raise OverflowError("Amounts too large")
+
+    monkeypatch.setattr("app.services.split_pool.calculate_outing_split", failing_split)
+
+    result = split_outing(examples.simple_bill.OUTING.model_dump(), "greedy")
+
+    assert result == SplitBatchResult(error="Could not split outing: Amounts too large")
+
+
+class TestSplitPool:
+    @pytest.fixture
+    async def pool(self) -> AsyncIterator[SplitPool]:
+        pool = SplitPool(workers=2)
+        pool.start()
+        yield pool
+        await pool.stop()
+
+    @pytest.mark.anyio
+    async def test_results_in_order(self, pool: SplitPool):
+        outings = [example.OUTING.model_dump() for example in EXAMPLES] * 5
+        outings.insert(7, {"bills": []})
+
+        results = [SplitBatchResult.model_validate_json(result) for result in await pool.split(outings, "exact")]
+
+        expected = [SplitBatchResult(split=example.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS) for example in EXAMPLES] * 5
+        assert results[:7] + results[8:] == expected
+        assert results[7].error is not None and results[7].error.startswith("Invalid outing")
+
+    @pytest.mark.anyio
+    async def test_recovers_from_dead_worker(self, pool: SplitPool):
+        assert await pool.split([examples.simple_bill.OUTING.model_dump()]) != []
+        with pytest.raises(BrokenProcessPool):
+            await asyncio.wrap_future(pool._executor.submit(os._exit, 1))
+
+        results = await pool.split([examples.simple_bill.OUTING.model_dump()] * 3)
+
+        assert all(SplitBatchResult.model_validate_json(result).error is not None for result in results)
+        result = SplitBatchResult.model_validate_json((await pool.split([examples.simple_bill.OUTING.model_dump()]))[0])
+        assert result == SplitBatchResult(split=examples.simple_bill.OUTING_SPLIT_WITH_MINIMAL_TRANSACTIONS)
+
+    @pytest.mark.anyio
+    async def test_not_started(self):
+        with pytest.raises(RuntimeError):
+            await SplitPool(workers=1).split([])
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from app.services.stage_timing import StageTiming, server_timing_header
+
+
+@pytest.fixture
+def timing() -> StageTiming:
+    return StageTiming(enabled=True)
+
+
+class TestStageTiming:
+    def test_stage(self, timing: StageTiming):
+        with timing.track_request() as stages:
+            with timing.stage("balances"):
+                pass
+            with timing.stage("settlement"):
+                pass
+            with timing.stage("balances"):
+                pass
+
+        assert stages is not None
+        assert list(stages.durations) == ["balances", "settlement"]
+        assert all(seconds >= 0 for seconds in stages.durations.values())
+        stats = timing.stats()
+        assert stats.enabled
+        assert stats.stages["balances"].count == 2
+        assert stats.stages["settlement"].count == 1
+        assert stats.stages["balances"].total_seconds == pytest.approx(stages.durations["balances"])
+        assert stats.stages["balances"].max_seconds <= stats.stages["balances"].total_seconds
+
+    def test_stage_error(self, timing: StageTiming):
+        with pytest.raises(ValueError):
+            with timing.stage("llm"):
+                raise ValueError("No response from LiteLLM")
+        assert timing.stats().stages["llm"].count == 1
+
+    def test_stage_outside_request(self, timing: StageTiming):
+        with timing.stage("settlement"):
+            pass
+        assert timing.stats().stages["settlement"].count == 1
+
+    def test_timed(self, timing: StageTiming):
+        @timing.timed("settlement")
+        def settle(amount: int) -> int:
+            return -amount
+
+        @timing.timed("llm")
+        async def complete(prompt: str) -> str:
+            await asyncio.sleep(0)
+            return prompt.upper()
+
+        async def serve() -> str:
+            return await complete("bill")
+
+        with timing.track_request() as stages:
+            assert settle(5) == -5
+            assert asyncio.run(serve()) == "BILL"
+
+        assert stages is not None
+        assert list(stages.durations) == ["settlement", "llm"]
+        assert settle.__name__ == "settle"
+
+    def test_stages_of_threads(self, timing: StageTiming):
+        def balances() -> None:
+            with timing.stage("balances"):
+                pass
+
+        async def serve() -> None:
+            with timing.track_request() as stages:
+                await asyncio.gather(asyncio.to_thread(balances), asyncio.to_thread(balances))
+            assert stages is not None
+            assert list(stages.durations) == ["balances"]
+
+        asyncio.run(serve())
+        assert timing.stats().stages["balances"].count == 2
+
+    def test_endpoint(self, timing: StageTiming):
+        @timing.endpoint
+        async def split(outing: str) -> str:
+            return outing
+
+        async def serve() -> None:
+            with timing.track_request() as stages:
+                assert await split("outing") == "outing"
+            assert stages is not None
+            assert list(stages.durations) == ["parse"]
+            assert stages.endpoint_returned is not None
+            assert stages.started <= stages.endpoint_returned
+
+        asyncio.run(serve())
+
+    def test_endpoint_parse_excludes_stages_of_dependencies(self, timing: StageTiming):
+        @timing.endpoint
+        async def extract(image: bytes) -> bytes:
+            return image
+
+        async def serve() -> None:
+            with timing.track_request() as stages:
+                assert stages is not None
+                with timing.stage("queue"):
+                    await asyncio.sleep(0.05)
+                assert await extract(b"image") == b"image"
+            assert stages is not None
+            assert list(stages.durations) == ["queue", "parse"]
+            assert stages.durations["queue"] >= 0.05
+            assert 0 <= stages.durations["parse"] < 0.05
+
+        asyncio.run(serve())
+
+    def test_disabled(self):
+        timing = StageTiming(enabled=False)
+
+        @timing.timed("settlement")
+        def settle(amount: int) -> int:
+            return -amount
+
+        @timing.endpoint
+        async def split(outing: str) -> str:
+            return outing
+
+        with timing.track_request() as stages:
+            with timing.stage("balances"):
+                pass
+            assert settle(5) == -5
+            assert asyncio.run(split("outing")) == "outing"
+
+        assert stages is None
+        assert timing.stats().model_dump() == {"enabled": False, "stages": {}}
+
+
+def test_server_timing_header():
+    assert server_timing_header({}) == ""
+    assert server_timing_header({"parse": 0.0012, "llm": 1.5}) == "parse;dur=1.200, llm;dur=1500.000"
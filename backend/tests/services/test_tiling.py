@@ -0,0 +1,71 @@
+import itertools
+import json
+
+import pytest
+
+from app.schemas.bill import OCRBill, OCRBillItem
+from app.services.tiling import merge_tiles, tile_boxes
+
+
+def item(name: str, price: float = 1.0, quantity: int = 1) -> dict:
+    return {"name": name, "price": price, "quantity": quantity}
+
+
+def tile(*names: str, amount_paid: float = 0.0) -> str:
+    return json.dumps({"items": [item(name) for name in names], "tax_rate": 0.1, "amount_paid": amount_paid})
+
+
+class TestTileBoxes:
+    def test_short_image_is_not_split(self):
+        assert tile_boxes(1000, 1500, tile_aspect_ratio=1.5, overlap=0.15, max_tiles=6) == [(0, 0, 1000, 1500)]
+
+    def test_tiles_overlap_and_cover_the_image(self):
+        boxes = tile_boxes(1000, 5000, tile_aspect_ratio=1.5, overlap=0.2, max_tiles=6)
+
+        assert len(boxes) == 4
+        assert boxes[0][1] == 0
+        assert boxes[-1][3] == 5000
+        for (_, _, _, bottom), (_, top, _, next_bottom) in itertools.pairwise(boxes):
+            assert bottom - top == pytest.approx(0.2 * (next_bottom - top), abs=2)
+        assert all(bottom - top <= 1500 for _, top, _, bottom in boxes)
+
+    def test_max_tiles(self):
+        boxes = tile_boxes(1000, 20_000, tile_aspect_ratio=1.5, overlap=0.1, max_tiles=3)
+
+        assert len(boxes) == 3
+        assert boxes[-1][3] == 20_000
+        assert boxes[1][1] < boxes[0][3]
+
+
+class TestMergeTiles:
+    def test_items_read_twice_at_overlaps_are_merged(self):
+        bill = merge_tiles([tile("a", "b", "c"), tile("c", "d", "e"), tile("e", "f", amount_paid=6.6)])
+
+        assert [item.name for item in bill.items] == ["a", "b", "c", "d", "e", "f"]
+
+    def test_overlap_match_ignores_case_and_spaces(self):
+        bill = merge_tiles([tile("Fried  Rice", "Iced Tea"), tile("fried rice", "iced tea", "Cake", amount_paid=3)])
+
+        assert [item.name for item in bill.items] == ["Fried  Rice", "Iced Tea", "Cake"]
+
+    def test_items_repeated_away_from_overlaps_are_kept(self):
+        bill = merge_tiles([tile("a", "b"), tile("a", "c", amount_paid=3)])
+
+        assert [item.name for item in bill.items] == ["a", "b", "a", "c"]
+
+    def test_totals_are_taken_from_the_last_tile(self):
+        last_tile = json.dumps(
+            {"items": [item("c", price=2.5, quantity=2)], "tax_rate": 0.07, "service_charge": 0.1, "amount_paid": 9.9}
+        )
+        bill = merge_tiles([tile("a", amount_paid=0), last_tile])
+
+        assert bill == OCRBill(
+            items=[OCRBillItem(name="a", price=1.0, quantity=1), OCRBillItem(name="c", price=2.5, quantity=2)],
+            tax_rate=0.07,
+            service_charge=0.1,
+            amount_paid=9.9,
+        )
+
+    def test_invalid_items(self):
+        with pytest.raises(ValueError, match="Invalid bill details extracted from a tile"):
+            merge_tiles([json.dumps({"items": [item("a", price=-1)]}), tile("b", amount_paid=1)])
@@ -0,0 +1,71 @@
+import pytest
+
+from app.schemas.bill import Bill, Item, Outing
+from app.services.bill import _net_balances, calculate_balance
+from app.services.compact_outing import CompactOuting
+from app.services.vectorized_balance import net_balances
+from tests import examples
+
+
+def vectorized_net_balances(outing: Outing) -> dict[str, int]:
+    compact = CompactOuting.from_outing(outing)
+    return dict(zip(compact.people, net_balances(compact)))
+
+
+@pytest.mark.parametrize(
+    "outing",
+    [
+        examples.simple_bill.OUTING,
+        examples.multiple_bills.OUTING,
+        examples.simple_bill_discounted.OUTING,
+        examples.multiple_bills_discounted.OUTING,
+    ],
+)
+def test_examples(outing):
+    assert vectorized_net_balances(outing) == _net_balances(outing)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_outings_are_identical(seed: int):
+    outing = examples.random_outings.random_outing(seed, bills=1 + seed * 5, items_per_bill=15, people=2 + seed * 10)
+
+    vectorized, loop = vectorized_net_balances(outing), _net_balances(outing)
+
+    # Identical, to the cent and in the same order
+    assert list(vectorized.items()) == list(loop.items())
+
+
+def test_large_outings_use_vectorized_engine(monkeypatch: pytest.MonkeyPatch):
+    outing = examples.random_outings.random_outing(0, bills=20, items_per_bill=10, people=30)
+    expected = calculate_balance(outing)
+
+    monkeypatch.setattr("app.services.bill._net_balances", None)
+    monkeypatch.setattr("app.services.bill.settings.BALANCE_VECTORIZED_MIN_ITEMS", 1)
+
+    assert calculate_balance(outing) == expected
+
+
+def test_free_items():
+    outing = Outing(
+        bills=[
+            Bill(
+                paid_by="alice",
+                amount_paid=1,
+                items=[Item(name="Water", price=0.001, quantity=1, consumed_by=["alice", "bob"])],
+            )
+        ]
+    )
+
+    assert vectorized_net_balances(outing) == _net_balances(outing) == {"alice": 50, "bob": -50}
+
+
+def test_amounts_too_large_use_loop_engine(monkeypatch: pytest.MonkeyPatch):
+    item = Item(name="Yacht", price=1e12, quantity=1, consumed_by=["alice", "bob"])
+    outing = Outing(bills=[Bill(paid_by="alice", amount_paid=1e12, items=[item])])
+    with pytest.raises(OverflowError):
+        vectorized_net_balances(outing)
+
+    monkeypatch.setattr("app.services.bill.settings.BALANCE_VECTORIZED_MIN_ITEMS", 1)
+    balance = calculate_balance(outing)
+
+    assert balance.creditors[0].amount == balance.debtors[0].amount == 50_000_000_000_000